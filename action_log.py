@@ -0,0 +1,200 @@
+"""
+Tick indexed log of the actions of all the game's instances.
+
+Ticks which weren't executed yet (the live window) are kept as dicts in memory.
+Once a tick is executed it can't change anymore, so it is confirmed:
+encoded compactly to an append-only buffer (optionally a memory-mapped temporary file)
+where it stays available for the replay, until it's discarded after the replay.
+"""
+
+import array
+import mmap
+import tempfile
+
+import wire
+
+
+def put_tick(out, acts, instance_index, instance_ids):
+    """
+    Encode a tick's actions (dict of instance id to actions).
+    Instance ids are encoded as indices into `instance_ids`, to which new ones are added.
+    """
+    wire.put_uint(out, len(acts))
+    for instance_id, actions in acts.items():
+        index = instance_index.get(instance_id)
+        if index is None:
+            index = instance_index[instance_id] = len(instance_ids)
+            instance_ids.append(instance_id)
+        wire.put_uint(out, index)
+        wire.put_actions(out, actions)
+
+
+def read_tick(reader, instance_ids):
+    acts = {}
+    for _ in range(reader.uint()):
+        index = reader.uint()
+        if index >= len(instance_ids):
+            raise wire.WireError('bad instance index')
+        acts[instance_ids[index]] = reader.actions()
+    return acts
+
+
+class _MemoryStore(object):
+    def __init__(self):
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data)
+
+    def append(self, data):
+        self.data += data
+
+    def view(self):
+        return memoryview(self.data)
+
+    def nbytes(self):
+        return len(self.data)
+
+
+class _FileStore(object):
+    """Appends to a temporary file which is read through a memory map"""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.map = None
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        self.file.seek(self.size)
+        self.file.write(data)
+        self.size += len(data)
+
+    def view(self):
+        if self.map is None or len(self.map) < self.size:
+            # The previous map is closed when its views are released
+            self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return memoryview(self.map)
+
+    def nbytes(self):
+        # The file's pages aren't in our heap
+        return 0
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class ActionLog(object):
+    """
+    Actions of all instances for each tick (as dicts of instance id to its list of actions).
+    """
+
+    def __init__(self, use_file=False):
+        self.use_file = use_file
+        self.live = {}
+        # Instance ids are stored as indices into this list
+        self.instance_ids = []
+        self.instance_index = {}
+        self.clear()
+
+    def clear(self):
+        """Forget all ticks"""
+        self.live.clear()
+        self._reset_store(0)
+
+    def _reset_store(self, first):
+        if getattr(self, 'store', None) is not None and self.use_file:
+            self.store.close()
+        self.store = _FileStore() if self.use_file else _MemoryStore()
+        # Confirmed ticks are first, first+1, ..., each starting at its offset in the store
+        self.first = first
+        self.offsets = array.array('I')
+
+    def confirmed_upto(self):
+        """Ticks up to this one are confirmed (or discarded)"""
+        return self.first + len(self.offsets) - 1
+
+    def _confirmed(self, tick):
+        """Decode a confirmed tick, or None if it isn't confirmed"""
+        i = tick - self.first
+        if not 0 <= i < len(self.offsets):
+            return None
+        data = self.store.view()
+        end = self.offsets[i+1] if i+1 < len(self.offsets) else len(self.store)
+        return read_tick(wire.Reader(data, self.offsets[i], end), self.instance_ids)
+
+    def actions(self, tick):
+        """All instances' actions for the tick (a copy for confirmed ticks)"""
+        acts = self.live.get(tick)
+        if acts is None:
+            acts = self._confirmed(tick)
+        return {} if acts is None else acts
+
+    def has(self, tick, instance_id):
+        acts = self.live.get(tick)
+        if acts is not None:
+            return instance_id in acts
+        return instance_id in self.actions(tick)
+
+    def count(self, tick):
+        """Number of instances whose actions for the tick we have"""
+        acts = self.live.get(tick)
+        if acts is not None:
+            return len(acts)
+        return len(self.actions(tick))
+
+    def add(self, tick, instance_id, actions):
+        """
+        Add an instance's actions for a tick.
+        If we already have them, the existing actions are returned and nothing changes.
+        Ticks which were already discarded are ignored.
+        """
+        if tick < self.first:
+            return None
+        if tick <= self.confirmed_upto():
+            return self.actions(tick).get(instance_id)
+        acts = self.live.setdefault(tick, {})
+        existing = acts.get(instance_id)
+        if existing is None:
+            acts[instance_id] = actions
+        return existing
+
+    def confirm(self, tick):
+        """The tick was executed, so it won't change anymore and can be stored compactly"""
+        if tick <= self.confirmed_upto():
+            return
+        if tick < self.first or not self.offsets:
+            self._reset_store(tick)
+        while self.confirmed_upto() < tick:
+            i = self.confirmed_upto() + 1
+            out = bytearray()
+            put_tick(out, self.live.pop(i, {}), self.instance_index, self.instance_ids)
+            self.offsets.append(len(self.store))
+            self.store.append(out)
+
+    def discard_before(self, tick):
+        """Drop the ticks before the given one (once they are no longer needed for the replay)"""
+        for i in [i for i in self.live if i < tick]:
+            del self.live[i]
+        if tick > self.confirmed_upto():
+            self._reset_store(tick)
+        elif tick > self.first:
+            keep = [bytes(self._raw(i)) for i in range(tick, self.confirmed_upto()+1)]
+            self._reset_store(tick)
+            for data in keep:
+                self.offsets.append(len(self.store))
+                self.store.append(data)
+
+    def _raw(self, tick):
+        i = tick - self.first
+        end = self.offsets[i+1] if i+1 < len(self.offsets) else len(self.store)
+        return self.store.view()[self.offsets[i]:end]
+
+    def nbytes(self):
+        """Approximate heap memory used by the confirmed ticks"""
+        return self.store.nbytes() + self.offsets.itemsize * len(self.offsets)
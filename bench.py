@@ -0,0 +1,386 @@
+"""
+Performance benchmarks.
+
+Usage: python bench.py [--json RESULTS] [--compare BASELINE [--threshold PERCENT]] [benchmark ...]
+
+Each benchmark prints its results and returns them as a dict of metric name to value.
+--json saves them (with the commit they were measured at), and --compare compares them to a saved run,
+failing if a metric got worse by more than the threshold.
+Metrics ending with _us, _bytes or _mb are better lower, and the others (rates) are better higher.
+The positions and actions come from fixed seeds, so that runs on different commits measure the same work.
+"""
+
+import argparse
+import json
+import marshal
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+import chess
+import wire
+from action_log import ActionLog
+from game_model import headless_game, random_move
+from net_engine import NetEngine
+from relay import Relay
+from sight_map import SightMap
+from square_colors import SquareColors
+from transport import UdpTransport
+
+try:
+    import vector_sight
+except ImportError:
+    # NumPy is optional
+    vector_sight = None
+
+
+def sample_ticks(rnd, first_tick=1000, num_ticks=10, moves_ratio=0.2):
+    """A window of ticks like the network engine sends, with some moves and chat"""
+    ticks = []
+    for tick in range(first_tick, first_tick+num_ticks):
+        actions = []
+        if rnd.random() < moves_ratio:
+            src = (rnd.randrange(16), rnd.randrange(8))
+            dst = (rnd.randrange(16), rnd.randrange(8))
+            actions.append(('move', (src, dst)))
+        if rnd.random() < 0.01:
+            actions.append(('msg', ('good game',)))
+        ticks.append((tick, actions))
+    return ticks
+
+
+def time_per_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def midgame(num_boards=1, seed=0, num_ticks=900, moves_ratio=0.5):
+    """A game after a while of random moves, with pieces spread out, captured and frozen"""
+    rnd = random.Random(seed)
+    game = headless_game(num_boards)
+    for _ in range(num_ticks):
+        if rnd.random() < moves_ratio:
+            move = random_move(game, rnd)
+            if move is not None:
+                game.action_move('You', *move)
+        game.counter += 1
+    return game
+
+
+def headless_engine(game):
+    """A network engine playing over the loopback interface, without STUN or the matching server"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    net_engine = NetEngine(game, UdpTransport(sock))
+    net_engine.replay_dir = None
+    return net_engine
+
+
+def bench_pieces():
+    """Move and sight generation (without the move cache) per piece type, in mid-game positions"""
+    results = {}
+    games = [midgame(seed=seed) for seed in range(3)]
+    for piece_type in chess.piece_types:
+        name = piece_type.__name__
+        pieces = [piece for game in games for piece in game.board.values() if type(piece) is piece_type]
+        for kind in ['moves', 'sight']:
+            generate = [getattr(piece, '_base_moves' if kind == 'moves' else '_sight') for piece in pieces]
+            duration = time_per_call(lambda: [list(func()) for func in generate], 200) / len(pieces)
+            results['%s.%s_us' % (kind, name)] = duration * 1e6
+        print('%-6s (%2d pieces): moves %5.2f us, sight %5.2f us' % (
+            name, len(pieces), results['moves.%s_us' % name], results['sight.%s_us' % name]))
+    return results
+
+
+def bench_board_info():
+    """Computing the squares' colors for a frame (BoardView.board_info), headless"""
+    results = {}
+    for num_boards in [1, 2]:
+        game = midgame(num_boards)
+        colors = SquareColors(game)
+        rnd = random.Random(0)
+        own_positions = [pos for pos, piece in game.board.items() if piece.player == game.player]
+        mouse_positions = [rnd.choice(own_positions) for _ in range(100)]
+
+        def frame():
+            for pos in mouse_positions:
+                colors.board_info(pos)
+
+        def recolor():
+            for pos in mouse_positions:
+                colors.key = None
+                colors.board_info(pos)
+
+        frame_time = time_per_call(frame, 20) / len(mouse_positions)
+        recolor_time = time_per_call(recolor, 20) / len(mouse_positions)
+        results['board_info.%dboards.frame_us' % num_boards] = frame_time * 1e6
+        results['board_info.%dboards.recolor_us' % num_boards] = recolor_time * 1e6
+        print('%d boards: frame %6.1f us, frame after the sight changed %6.1f us' % (
+            num_boards, frame_time * 1e6, recolor_time * 1e6))
+    return results
+
+
+def bench_sight(num_moves=50):
+    """All the pieces' sight and coverage: SightMap (from scratch and after a move) vs vector_sight.py"""
+    if vector_sight is None:
+        print('NumPy is not installed')
+        return {}
+    results = {}
+    for num_boards in [1, 2, 4, 8]:
+        game = midgame(num_boards)
+        size = '%dx%d' % game.board_size
+
+        def python_full():
+            # Without the memoized moves, which a new position doesn't have
+            game.move_cache.clear()
+            sight_map = SightMap(game)
+            sight_map.visible(0)
+            sight_map.coverage(0)
+
+        def vector_full():
+            sight = vector_sight.VectorSight(game)
+            sight.visible(0)
+            sight.coverage(0)
+
+        python_time = time_per_call(python_full, 20)
+        vector_time = time_per_call(vector_full, 20)
+        # Moves change few pieces' sight, which SightMap updates incrementally
+        rnd = random.Random(0)
+        sight_map = SightMap(game)
+        sight_map.coverage(0)
+        update_time = 0
+        vector_update_time = 0
+        for _ in range(num_moves):
+            move = random_move(game, rnd)
+            if move is not None:
+                game.action_move('You', *move)
+            game.counter += 10
+            start = time.perf_counter()
+            sight_map.visible(0)
+            sight_map.coverage(0)
+            lap = time.perf_counter()
+            vector_full()
+            update_time += lap - start
+            vector_update_time += time.perf_counter() - lap
+        results['sight.%s.python_us' % size] = python_time * 1e6
+        results['sight.%s.numpy_us' % size] = vector_time * 1e6
+        results['sight.%s.python_update_us' % size] = update_time / num_moves * 1e6
+        results['sight.%s.numpy_update_us' % size] = vector_update_time / num_moves * 1e6
+        print('%5s: from scratch %7.1f us, numpy %7.1f us (x%.1f), after a move %7.1f us, numpy %7.1f us (x%.1f)' % (
+            size, python_time * 1e6, vector_time * 1e6, python_time / vector_time,
+            update_time / num_moves * 1e6, vector_update_time / num_moves * 1e6, update_time / vector_update_time))
+    return results
+
+
+def bench_wire():
+    """Packet sizes and encode/decode times of the wire format vs marshal"""
+    results = {}
+    rnd = random.Random(0)
+    sender = rnd.randrange(2**64)
+    for moves_ratio in [0, 0.2, 1]:
+        ticks = sample_ticks(rnd, moves_ratio=moves_ratio)
+        marshalled = marshal.dumps((sender, ticks))
+        encoded = wire.encode(sender, ticks)
+        for name, size, encode_time, decode_time in [
+                ('marshal', len(marshalled),
+                    time_per_call(lambda: marshal.dumps((sender, ticks)), 2000),
+                    time_per_call(lambda: marshal.loads(marshalled), 2000)),
+                ('wire', len(encoded),
+                    time_per_call(lambda: wire.encode(sender, ticks), 2000),
+                    time_per_call(lambda: wire.decode(encoded), 2000)),
+                ]:
+            prefix = '%s.moves%g.' % (name, moves_ratio)
+            results[prefix + 'packet_bytes'] = size
+            results[prefix + 'encode_us'] = encode_time * 1e6
+            results[prefix + 'decode_us'] = decode_time * 1e6
+            print('%-8s moves/tick=%.1f: %4d bytes, encode %6.1f us, decode %6.1f us' % (
+                name, moves_ratio, size, encode_time*1e6, decode_time*1e6))
+    return results
+
+
+def bench_communicate(window=30):
+    """A NetEngine.communicate() round: encoding, sending, receiving and decoding a window of unacked ticks"""
+    rnd = random.Random(0)
+    net_engines = [headless_engine(headless_game()) for _ in range(2)]
+    for i, net_engine in enumerate(net_engines):
+        net_engine.peers = [net_engines[1-i].transport.address]
+        for tick, actions in sample_ticks(rnd, first_tick=0, num_ticks=window):
+            net_engine.set_own_actions(tick, actions)
+    a, b = net_engines
+
+    def round_trip():
+        # Forget the acks, so that each round sends the whole window
+        a.links.clear()
+        b.links.clear()
+        a.communicate()
+        b.communicate()
+
+    duration = time_per_call(round_trip, 200) / 2
+    for net_engine in net_engines:
+        net_engine.stop()
+    print('%d unacked ticks: %.1f us per communicate()' % (window, duration * 1e6))
+    return {'communicate_us': duration * 1e6}
+
+
+def bench_ticks(num_ticks=600):
+    """End to end iteration() of full games, with random moves, in ticks per second"""
+    results = {}
+    for players in [1, 2, 4]:
+        rnd = random.Random(0)
+        net_engines = [headless_engine(headless_game((players + 1) // 2)) for _ in range(players)]
+        relay = None
+        if players > 2:
+            relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            relay_socket.bind(('127.0.0.1', 0))
+            relay = Relay(UdpTransport(relay_socket), players)
+            for net_engine in net_engines:
+                net_engine.join_relay(relay_socket.getsockname())
+        else:
+            for player, net_engine in enumerate(net_engines):
+                net_engine.game.player = player
+                net_engine.peers = [other.transport.address for other in net_engines if other is not net_engine]
+        iterations = 0
+        start = time.perf_counter()
+        while min(net_engine.game.counter for net_engine in net_engines) < num_ticks:
+            if relay is not None:
+                relay.step()
+            for net_engine in net_engines:
+                game = net_engine.game
+                if rnd.random() < 0.2 and len(game.cur_actions) < 3:
+                    move = random_move(game, rnd, game.player)
+                    if move is not None:
+                        game.add_action('move', *move)
+                net_engine.iteration()
+                iterations += 1
+        duration = time.perf_counter() - start
+        for net_engine in net_engines:
+            net_engine.stop()
+        if relay is not None:
+            relay.close()
+        results['ticks.%dplayers.ticks_per_second' % players] = num_ticks / duration
+        results['ticks.%dplayers.iteration_us' % players] = duration / iterations * 1e6
+        print('%d players: %5.0f ticks/s, %6.1f us per iteration()' % (
+            players, num_ticks / duration, duration / iterations * 1e6))
+    return results
+
+
+def bench_action_log(num_ticks=100000, instance_ids=(1, 2)):
+    """Memory and lookup time of a long game's actions: dict of dicts vs the action log"""
+    results = {}
+    rnd = random.Random(0)
+    ticks = sample_ticks(rnd, first_tick=0, num_ticks=num_ticks)
+
+    def fill_dict():
+        store = {}
+        for tick, actions in ticks:
+            for instance_id in instance_ids:
+                store.setdefault(tick, {})[instance_id] = actions
+        return store
+
+    def fill_log(use_file):
+        log = ActionLog(use_file)
+        for tick, actions in ticks:
+            for instance_id in instance_ids:
+                log.add(tick, instance_id, actions)
+            log.confirm(tick)
+        return log
+
+    lookups = [rnd.randrange(num_ticks) for _ in range(1000)]
+    for name, fill, lookup in [
+            ('dict', fill_dict, lambda store, tick: store[tick]),
+            ('log', lambda: fill_log(False), lambda store, tick: store.actions(tick)),
+            ('log+file', lambda: fill_log(True), lambda store, tick: store.actions(tick)),
+            ]:
+        tracemalloc.start()
+        store = fill()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        lookup_time = time_per_call(lambda: [lookup(store, tick) for tick in lookups], 5) / len(lookups)
+        results['action_log.%s.heap_mb' % name] = size / 2**20
+        results['action_log.%s.lookup_us' % name] = lookup_time * 1e6
+        print('%-8s %d ticks: %6.2f MB heap, lookup %5.1f us' % (
+            name, num_ticks, size / 2**20, lookup_time*1e6))
+    return results
+
+
+benchmarks = {
+    'pieces': bench_pieces,
+    'board_info': bench_board_info,
+    'sight': bench_sight,
+    'wire': bench_wire,
+    'communicate': bench_communicate,
+    'ticks': bench_ticks,
+    'action_log': bench_action_log,
+    }
+
+
+def lower_is_better(metric):
+    return metric.endswith(('_us', '_bytes', '_mb'))
+
+
+def compare(results, baseline, threshold):
+    """Print the changes from the baseline run, returning the metrics which regressed by more than threshold"""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in sorted(metrics.items()):
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+            change = (value - old) / old * 100
+            worse = change > threshold if lower_is_better(metric) else change < -threshold
+            if worse:
+                regressions.append('%s/%s' % (name, metric))
+            print('%-45s %10.2f -> %10.2f (%+6.1f%%)%s' % (
+                '%s/%s' % (name, metric), old, value, change, ' REGRESSION' if worse else ''))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run the performance benchmarks.')
+    parser.add_argument('names', nargs='*', metavar='benchmark', help=', '.join(benchmarks))
+    parser.add_argument('--json', metavar='RESULTS', help='save the results to a JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare to the results saved by an earlier run')
+    parser.add_argument('--threshold', type=float, default=10, help='percent change counted as a regression')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error('no such benchmark: %s' % name)
+
+    results = {}
+    for name in args.names or benchmarks:
+        print('== %s: %s' % (name, benchmarks[name].__doc__))
+        results[name] = benchmarks[name]()
+
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump({
+                'commit': git_commit(),
+                'time': time.time(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+                }, results_file, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print('== compared to %s' % (baseline.get('commit') or args.compare))
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print('%d regressions' % len(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,163 @@
+import collections.abc
+import typing
+
+import zobrist
+
+
+class Geometry(object):
+    """
+    Move geometry of a board size.
+
+    Ray tables are computed once per size and kept for as long as the board size stays the same,
+    so move generation only walks precomputed lists of square indices.
+    """
+
+    def __init__(self, size):
+        self.width, self.height = size
+        self.size = (self.width, self.height)
+        self.num_squares = self.width * self.height
+        self.positions = [(sq % self.width, sq // self.width) for sq in range(self.num_squares)]
+        self._rays = {}
+
+    def rays(self, directions, slides):
+        """
+        For each square, the rays going out of it in the given directions.
+        Sliding pieces go on in each direction until the edge of the board, others do just one step.
+        """
+        key = (directions, slides)
+        table = self._rays.get(key)
+        if table is None:
+            table = self._rays[key] = [
+                tuple(ray for ray in (self._ray(pos, direction, slides) for direction in directions) if ray)
+                for pos in self.positions]
+        return table
+
+    def _ray(self, pos, direction, slides):
+        (x, y), (dx, dy) = pos, direction
+        ray = []
+        while True:
+            x += dx
+            y += dy
+            if not (0 <= x < self.width and 0 <= y < self.height):
+                break
+            ray.append(x + y * self.width)
+            if not slides:
+                break
+        return tuple(ray)
+
+
+class Board(collections.abc.MutableMapping):
+    """
+    Array backed game board.
+
+    Squares are addressed by flat integer indices (x + y*width).
+    Each square holds its piece in `squares`, the side occupying it (1 + side, or 0 when empty)
+    in `side_at`, and each side's occupied squares are also kept as a bit mask in `occupied`.
+    Squares changed since the last time someone looked are accumulated in the `dirty` bit mask.
+    The pieces' Zobrist hash is kept in `hash` (pieces must not change while on the board, see Piece.freeze).
+
+    For code that thinks in (x, y) positions (the views, the network engine),
+    the board also acts as a mapping from position tuples to pieces.
+    """
+    squares: typing.List[typing.Any]
+    side_at: bytearray
+    occupied: typing.List[int]
+
+    def __init__(self, size, geometry=None):
+        self.width, self.height = size
+        self.size = (self.width, self.height)
+        self.num_squares = self.width * self.height
+        if geometry is None or geometry.size != self.size:
+            geometry = Geometry(self.size)
+        self.geometry = geometry
+        # Shared position tuples, so that walking the board doesn't allocate them
+        self.positions = geometry.positions
+        self.squares = [None] * self.num_squares
+        self.side_at = bytearray(self.num_squares)
+        self.occupied = [0, 0]
+        self.dirty = 0
+        self.hash = 0
+
+    def index(self, pos):
+        """Square index of a position, or None if it is out of the board"""
+        try:
+            x, y = pos
+        except (TypeError, ValueError):
+            return None
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return x + y * self.width
+        return None
+
+    def in_bounds(self, pos):
+        return self.index(pos) is not None
+
+    def place(self, sq, piece):
+        if self.squares[sq] is not None:
+            self.remove(sq)
+        side = piece.side()
+        self.squares[sq] = piece
+        self.side_at[sq] = side + 1
+        self.occupied[side] |= 1 << sq
+        self.dirty |= 1 << sq
+        self.hash ^= zobrist.piece_key(piece, sq)
+
+    def remove(self, sq):
+        piece = self.squares[sq]
+        self.squares[sq] = None
+        self.side_at[sq] = 0
+        self.occupied[piece.side()] &= ~(1 << sq)
+        self.dirty |= 1 << sq
+        self.hash ^= zobrist.piece_key(piece, sq)
+        return piece
+
+    def rehash(self):
+        """Recompute the hash (after changing pieces directly)"""
+        self.hash = 0
+        for sq, piece in enumerate(self.squares):
+            if piece is not None:
+                self.hash ^= zobrist.piece_key(piece, sq)
+
+    def pieces(self):
+        return [piece for piece in self.squares if piece is not None]
+
+    # Mapping from (x, y) positions
+
+    def __getitem__(self, pos):
+        sq = self.index(pos)
+        piece = None if sq is None else self.squares[sq]
+        if piece is None:
+            raise KeyError(pos)
+        return piece
+
+    def get(self, pos, default=None):
+        sq = self.index(pos)
+        piece = None if sq is None else self.squares[sq]
+        return default if piece is None else piece
+
+    def __contains__(self, pos):
+        sq = self.index(pos)
+        return sq is not None and self.side_at[sq] != 0
+
+    def __setitem__(self, pos, piece):
+        sq = self.index(pos)
+        if sq is None:
+            raise KeyError(pos)
+        self.place(sq, piece)
+
+    def __delitem__(self, pos):
+        sq = self.index(pos)
+        if sq is None or self.squares[sq] is None:
+            raise KeyError(pos)
+        self.remove(sq)
+
+    def __iter__(self):
+        return (self.positions[sq] for sq, piece in enumerate(self.squares) if piece is not None)
+
+    def __len__(self):
+        return bin(self.occupied[0] | self.occupied[1]).count('1')
+
+    def values(self):
+        return self.pieces()
+
+    def items(self):
+        return [(self.positions[sq], piece) for sq, piece in enumerate(self.squares) if piece is not None]
@@ -1,14 +1,109 @@
-import itertools
-import operator
 import random
+import time
 import typing
 
 from kivy.core.window import Window
-from kivy.graphics import Color, Rectangle
+from kivy.graphics import Color, InstructionGroup, Rectangle
 from kivy.uix.widget import Widget
 
-import env
+import profiler
 from chess import Piece
+from piece_images import init_pieces_images
+from square_colors import SquareColors
+
+
+class SquareSprite(object):
+    """Persistent instructions of a board square: its color and its piece's freeze bar"""
+
+    def __init__(self, layer):
+        self.color = Color(0, 0, 0, 0)
+        self.rect = Rectangle()
+        self.freeze_color = Color(.7, .7, .7, 0)
+        self.freeze_rect = Rectangle()
+        self.group = InstructionGroup()
+        for instruction in [self.color, self.rect, self.freeze_color, self.freeze_rect]:
+            self.group.add(instruction)
+        layer.add(self.group)
+        self.state = None
+
+    def update(self, state):
+        if state == self.state:
+            return
+        col, freeze_ratio, pos, square_size = state
+        old_col, old_freeze_ratio, old_pos, old_square_size = self.state or (None, None, None, None)
+        self.state = state
+        if col != old_col:
+            self.color.rgba = (0, 0, 0, 0) if col is None else [x/255 for x in col] + [1]
+        if (pos, square_size) != (old_pos, old_square_size):
+            self.rect.pos = pos
+            self.rect.size = (square_size-1, square_size-1)
+            self.freeze_rect.pos = pos
+        if (freeze_ratio, square_size) != (old_freeze_ratio, old_square_size):
+            self.freeze_color.a = 1 if freeze_ratio else 0
+            self.freeze_rect.size = (square_size * freeze_ratio, square_size)
+
+
+class PieceSprite(object):
+    """Persistent instructions of a piece: its image, and its image moving from its last position"""
+
+    def __init__(self, layer):
+        self.moving_color = Color(1, 1, 1, 0)
+        self.moving_rect = Rectangle()
+        self.color = Color(1, 1, 1, 1)
+        self.rect = Rectangle()
+        self.group = InstructionGroup()
+        for instruction in [self.moving_color, self.moving_rect, self.color, self.rect]:
+            self.group.add(instruction)
+        self.layer = layer
+        layer.add(self.group)
+        self.state = None
+
+    def update(self, state):
+        if state == self.state:
+            return
+        texture, pos, size, alpha, moving_pos = state
+        old_texture, old_pos, old_size, old_alpha, old_moving_pos = self.state or (None, None, None, None, None)
+        self.state = state
+        if texture is not old_texture:
+            self.rect.texture = texture
+            self.moving_rect.texture = texture
+        if (pos, size) != (old_pos, old_size):
+            self.rect.pos = pos
+            self.rect.size = size
+        if alpha != old_alpha:
+            self.color.a = alpha
+        if (moving_pos, size) != (old_moving_pos, old_size):
+            self.moving_color.a = 0 if moving_pos is None else 1
+            if moving_pos is not None:
+                self.moving_rect.pos = moving_pos
+                self.moving_rect.size = size
+
+    def remove(self):
+        self.layer.remove(self.group)
+
+
+class GhostSprite(object):
+    """A half transparent piece image, hidden when there's nothing to show"""
+
+    def __init__(self, layer):
+        self.color = Color(1, 1, 1, 0)
+        self.rect = Rectangle()
+        layer.add(self.color)
+        layer.add(self.rect)
+        self.state = None
+
+    def update(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        if state is None:
+            self.color.a = 0
+            return
+        texture, pos, size = state
+        self.color.a = .5
+        self.rect.texture = texture
+        self.rect.pos = pos
+        self.rect.size = size
 
 
 class BoardView(Widget):
@@ -20,10 +115,25 @@ class BoardView(Widget):
 
     def __init__(self, game, **kwargs):
         super(BoardView, self).__init__(**kwargs)
+        init_pieces_images()
         self.game = game
         Window.bind(mouse_pos=self.mouse_motion)
         self.bind(size=self.resized)
         self.mouse_pos = None
+        self.square_colors = SquareColors(game)
+
+        # Retained scene: the canvas instructions persist and are only updated when they change
+        self.squares_layer = InstructionGroup()
+        self.pieces_layer = InstructionGroup()
+        overlay = InstructionGroup()
+        for layer in [self.squares_layer, self.pieces_layer, overlay]:
+            self.canvas.add(layer)
+        self.scene_size = None
+        self.squares = {}
+        self.sprites = {}
+        self.dst_ghost = GhostSprite(overlay)
+        self.drag_ghost = GhostSprite(overlay)
+
         self.reset()
 
     def resized(self, a, b):
@@ -43,98 +153,72 @@ class BoardView(Widget):
         self.chess_sets_perm = [[a, b][i % 2][i//2] for i in range(6)]
 
     def show_board(self):
+        start = time.perf_counter()
         cols, see = self.board_info()
-
-        self.canvas.clear()
+        start = profiler.frames.lap('board_info', start)
+        board = self.game.board
+        counter = self.game.counter
         sq = (self.square_size-1, self.square_size-1)
-        with self.canvas:
-            for (x, y), col in cols.items():
-                sx, sy = self.screen_pos((x, y))
-                Color(*[x/255 for x in col])
-                Rectangle(pos=(sx, sy), size=sq)
-                if (x, y) in self.game.board:
-                    piece = self.game.board[x, y]
-                    if self.game.board[x, y].freeze_until > self.game.counter:
-                        freeze_ratio = (piece.freeze_until - self.game.counter) / piece.freeze_time
-                        Color(.7, .7, .7)
-                        Rectangle(pos=(sx, sy), size=(self.square_size * freeze_ratio, self.square_size))
-
-            for pos, piece in self.game.board.items():
-                if pos not in see:
-                    continue
-                transparent = False
-                if piece.last_move_time is not None:
-                    move_time = (self.game.counter - piece.last_move_time)*0.1
-                    if move_time < 1:
-                        pos_between = move_time
-                        if piece.last_pos is not None:
-                            last_screen_pos = self.screen_pos(piece.last_pos)
-                            new_screen_pos = self.screen_pos(pos)
-                            Rectangle(
-                                texture=piece.image(self.chess_sets_perm),
-                                pos=[int(last_screen_pos[i]+(new_screen_pos[i]-last_screen_pos[i])*pos_between)
-                                     for i in range(2)],
-                                size=sq)
-                if piece is self.selected and self.game.active():
-                    transparent = True
-                Color(1, 1, 1, .5 if transparent else 1)
-                Rectangle(
-                    texture=piece.image(self.chess_sets_perm),
-                    pos=self.screen_pos(pos),
-                    size=sq)
-
-            if self.selected is not None and self.dst_pos is not None and self.game.active():
-                Color(1, 1, 1, .5)
-                Rectangle(
-                    texture=self.selected.image(self.chess_sets_perm),
-                    pos=self.screen_pos(self.dst_pos),
-                    size=sq)
-
-            if self.is_dragging:
-                x, y = self.raw_mouse_pos
-                Color(1, 1, 1, .5)
-                Rectangle(
-                    texture=self.selected.image(self.chess_sets_perm),
-                    pos=(x-self.square_size//2, y-self.square_size//2),
-                    size=sq)
 
-    def board_info(self):
-        player = None if self.game.mode == 'replay' else self.game.player
-        flash = {}
-        if not env.is_mobile and not self.is_dragging:
-            flashy = self.game.board.get(self.mouse_pos)
-            if flashy is not None and flashy.player == player:
-                for pos in flashy.moves():
-                    flash[pos] = flashy.sight_color
-
-        movesee = {}
-        see = set()
-        for piece in self.game.board.values():
-            if player is not None and piece.side() != player % 2:
+        if self.scene_size != board.size:
+            self.build_scene(board)
+
+        for pos, square in self.squares.items():
+            col = cols.get(pos)
+            freeze_ratio = 0
+            if col is not None:
+                piece = board.get(pos)
+                if piece is not None and piece.freeze_until > counter:
+                    freeze_ratio = (piece.freeze_until - counter) / piece.freeze_time
+            square.update((col, freeze_ratio, self.screen_pos(pos), self.square_size))
+
+        shown = set()
+        for pos, piece in board.items():
+            if pos not in see:
                 continue
-            see.add(piece.pos)
-            if piece.player == player:
-                moves = set(piece.moves())
-                if self.mouse_pos in moves and not self.is_dragging and piece == self.selected:
-                    flash[piece.pos] = piece.sight_color
-                else:
-                    movesee[piece.pos] = piece.sight_color
-            else:
-                moves = set()
-            for dst in itertools.chain(piece.sight()):
-                see.add(dst)
-                if dst in moves:
-                    movesee[dst] = list(map(operator.add, movesee.get(dst, [0]*3), piece.sight_color))
-
-        cols = {}
-        for pos in see:
-            cols[pos] = (240, 240, 240)
-        for pos, col in movesee.items():
-            cols[pos] = [128+a*127./max(col) for a in col]
-        for pos, col in flash.items():
-            cols[pos] = [255*x for x in col]
-
-        return cols, see
+            shown.add(piece)
+            sprite = self.sprites.get(piece)
+            if sprite is None:
+                sprite = self.sprites[piece] = PieceSprite(self.pieces_layer)
+            moving_pos = None
+            if piece.last_move_time is not None and piece.last_pos is not None:
+                pos_between = (counter - piece.last_move_time)*0.1
+                if pos_between < 1:
+                    last_screen_pos = self.screen_pos(piece.last_pos)
+                    new_screen_pos = self.screen_pos(pos)
+                    moving_pos = tuple(
+                        int(last_screen_pos[i]+(new_screen_pos[i]-last_screen_pos[i])*pos_between)
+                        for i in range(2))
+            transparent = piece is self.selected and self.game.active()
+            sprite.update((
+                piece.image(self.chess_sets_perm), self.screen_pos(pos), sq,
+                .5 if transparent else 1, moving_pos))
+        for piece in list(self.sprites):
+            if piece not in shown:
+                self.sprites.pop(piece).remove()
+
+        dst_ghost = None
+        if self.selected is not None and self.dst_pos is not None and self.game.active():
+            dst_ghost = (self.selected.image(self.chess_sets_perm), self.screen_pos(self.dst_pos), sq)
+        self.dst_ghost.update(dst_ghost)
+
+        drag_ghost = None
+        if self.is_dragging:
+            x, y = self.raw_mouse_pos
+            drag_ghost = (
+                self.selected.image(self.chess_sets_perm),
+                (x-self.square_size//2, y-self.square_size//2), sq)
+        self.drag_ghost.update(drag_ghost)
+        profiler.frames.lap('canvas', start)
+
+    def build_scene(self, board):
+        """Create the retained canvas instructions for the board's squares"""
+        self.scene_size = board.size
+        self.squares_layer.clear()
+        self.squares = {pos: SquareSprite(self.squares_layer) for pos in board.positions}
+
+    def board_info(self):
+        return self.square_colors.board_info(self.mouse_pos, self.selected, self.is_dragging)
 
     def on_touch_down(self, event):
         if not self.game.active():
@@ -0,0 +1,300 @@
+"""
+A computer opponent.
+
+It plays by queuing actions like a player does (GameModel.add_action), so it can play the other side locally
+(the practice game in main.py) or join a game as a headless peer:
+
+Usage: python bot.py IDENTIFIER | --relay HOST:PORT [--budget MS] [--worker]
+
+The bot only knows what its side sees: the enemy pieces outside of its sight are removed from the position
+it searches. It searches the moves the pieces can make now (frozen pieces can't move) for a limited time each tick,
+continuing over the following ticks, so that it never delays a frame by more than its budget.
+With a worker the search runs in another process instead, and the tick only sends it the position and polls.
+"""
+
+import argparse
+import multiprocessing
+import random
+import sys
+import time
+
+import chess
+import profiler
+from game_model import headless_game
+from net_engine import NetEngine
+
+values = {chess.Pawn: 1, chess.Knight: 3, chess.Bishop: 3, chess.Rook: 5, chess.Queen: 9, chess.King: 100}
+
+
+def new_belief():
+    """A game model for positions restored from snapshots, without the UI's callbacks"""
+    return headless_game(mode=None)
+
+
+def sighted_position(game, player, belief=None):
+    """
+    Snapshot of the game with the enemy pieces the player can't see removed.
+    Reusing a belief (from new_belief) saves building the board's move tables again.
+    """
+    belief = belief or new_belief()
+    belief.restore(game.snapshot())
+    visible = game.sight_map.visible(player)
+    for pos, piece in list(belief.board.items()):
+        if piece.side() != player % 2 and pos not in visible:
+            del belief.board[pos]
+    belief.version += 1
+    return belief.snapshot()
+
+
+class Search(object):
+    """
+    Scores each move of the player's pieces (and waiting) by the position it leads to,
+    a node per move, stepping in slices of time until all the moves are scored.
+    """
+
+    # How much a threatened piece counts as lost, and an attack on an enemy piece as won
+    threat_weight = 0.9
+    attack_weight = 0.2
+
+    def __init__(self, position, player, rnd, belief=None):
+        self.position = position
+        self.player = player
+        self.rnd = rnd
+        self.belief = belief or new_belief()
+        self.belief.restore(position)
+        # The candidate moves as (src, dst), with None for waiting. Captures are searched first.
+        board = self.belief.board
+        moves = [
+            (piece.pos, dst) for piece in board.pieces() if piece.player == player for dst in piece.moves()]
+        moves.sort(key=lambda move: -values[type(board[move[1]])] if move[1] in board else 0)
+        self.candidates = [None] + moves
+        self.scores = {}
+        self.nodes = 0
+        self.seconds = 0
+        # Whether the belief was moved away from the position
+        self.moved = False
+
+    def done(self):
+        return len(self.scores) == len(self.candidates)
+
+    def step(self, deadline):
+        """
+        Score moves until the deadline (a time.perf_counter() value, or None for no deadline),
+        returning whether all are scored
+        """
+        start = time.perf_counter()
+        while not self.done() and (deadline is None or time.perf_counter() < deadline):
+            move = self.candidates[len(self.scores)]
+            self.scores[move] = self.evaluate(move)
+            self.nodes += 1
+        self.seconds += time.perf_counter() - start
+        return self.done()
+
+    def best(self):
+        """The best scored move as (src, dst), or None if waiting is better"""
+        return max(self.scores, key=self.scores.get) if self.scores else None
+
+    def evaluate(self, move):
+        game = self.belief
+        if move is not None:
+            if self.moved:
+                game.restore(self.position)
+            src, dst = move
+            game.board[src].move(dst)
+            self.moved = True
+        side = self.player % 2
+        # A moved piece is frozen for this long, so enemy pieces which can move before then threaten it
+        horizon = game.counter + chess.Piece.freeze_time
+        score = self.rnd.random() * 0.01
+        threat = 0
+        attack = 0
+        for piece in game.board.pieces():
+            value = values[type(piece)]
+            own = piece.side() == side
+            score += value if own else -value
+            if isinstance(piece, chess.Pawn):
+                # Advancing pawns get closer to becoming queens
+                score += 0.02 * (piece.pos[1] if side == 0 else 7 - piece.pos[1]) * (1 if own else -1)
+            frozen_until = max(piece.freeze_until, game.player_freeze.get(piece.player, 0))
+            if frozen_until > horizon:
+                continue
+            for dst in piece.base_moves():
+                target = game.board.get(dst)
+                if target is None:
+                    continue
+                if own:
+                    attack = max(attack, values[type(target)])
+                else:
+                    threat = max(threat, values[type(target)])
+        return score - self.threat_weight * threat + self.attack_weight * attack
+
+
+def search_worker(conn):
+    """Worker process: run each requested search to its end (or its time budget) and send back the result"""
+    rnd = random.Random()
+    belief = new_belief()
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        position, player, budget = request
+        search = Search(position, player, rnd, belief)
+        search.step(time.perf_counter() + budget)
+        conn.send((search.best(), search.nodes, search.seconds))
+
+
+class Bot(object):
+    """
+    Plays a player's pieces of a game: call tick() after each NetEngine.iteration().
+    player None plays the game's own player (as a headless peer does).
+    """
+
+    # Seconds of searching per tick (in process) or for a whole search (in the worker).
+    # Without a budget the search ends in the tick it starts, and the bot's moves only depend on its seed.
+    budget = 0.004
+    worker_budget = 0.1
+    # Ticks between decisions, to play at a humane pace
+    think_interval = 15
+
+    def __init__(self, game, player=None, worker=False, seed=None):
+        self.game = game
+        self.player = player
+        self.rnd = random.Random(seed)
+        # The game model the searched positions are restored into
+        self.belief = new_belief()
+        self.search = None
+        self.search_started_at = None
+        self.next_think = 0
+        self.conn = None
+        self.process = None
+        if worker:
+            self.conn, child_conn = multiprocessing.Pipe()
+            self.process = multiprocessing.Process(target=search_worker, args=(child_conn, ), daemon=True)
+            self.process.start()
+        self.waiting_for_worker = False
+        # Statistics
+        self.nodes = 0
+        self.search_seconds = 0
+        self.decisions = 0
+        self.moves = 0
+        self.decision_times = profiler.Histogram(window=100)
+
+    def own_player(self):
+        return self.game.player if self.player is None else self.player
+
+    def tick(self):
+        # Preparing the search's position counts toward the budget too
+        deadline = None if self.budget is None else time.perf_counter() + self.budget
+        game = self.game
+        player = self.own_player()
+        if not game.active() or player is None:
+            self.search = None
+            return
+        if self.search is None and not self.waiting_for_worker:
+            if game.counter < max(self.next_think, game.player_freeze.get(player, 0)):
+                return
+            self.search_started_at = time.perf_counter()
+            position = sighted_position(game, player, self.belief)
+            if self.conn is not None:
+                self.conn.send((position, player, self.worker_budget))
+                self.waiting_for_worker = True
+                return
+            self.search = Search(position, player, self.rnd, self.belief)
+        if self.conn is not None:
+            if not self.conn.poll():
+                return
+            move, nodes, seconds = self.conn.recv()
+            self.waiting_for_worker = False
+        else:
+            if not self.search.step(deadline):
+                return
+            move, nodes, seconds = self.search.best(), self.search.nodes, self.search.seconds
+            self.search = None
+        self.nodes += nodes
+        self.search_seconds += seconds
+        self.decisions += 1
+        self.decision_times.add(time.perf_counter() - self.search_started_at)
+        self.next_think = game.counter + self.think_interval
+        if move is not None:
+            self.play(player, *move)
+
+    def play(self, player, src, dst):
+        # The game went on during the search, so check that the move is still possible
+        piece = self.game.board.get(src)
+        if piece is None or piece.player != player or dst not in piece.moves():
+            return
+        self.game.add_action('move', src, dst)
+        self.moves += 1
+
+    def stats(self):
+        return {
+            'nodes': self.nodes,
+            'nodes_per_second': self.nodes / self.search_seconds if self.search_seconds else None,
+            'decisions': self.decisions,
+            'moves': self.moves,
+            'decision_latency': self.decision_times.summary(),
+            }
+
+    def stats_line(self):
+        stats = self.stats()
+        latency = stats['decision_latency']
+        return 'bot: %d decisions, %d moves, %.0f nodes/s, decision latency p50 %.1fms p95 %.1fms' % (
+            stats['decisions'], stats['moves'], stats['nodes_per_second'] or 0,
+            latency.get('p50_ms', 0), latency.get('p95_ms', 0))
+
+    def close(self):
+        if self.process is not None:
+            self.conn.send(None)
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.conn.close()
+            self.process = None
+            self.conn = None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Join a game as a computer player.')
+    parser.add_argument('identifier', nargs='?', help="the game's identifier at the matching server")
+    parser.add_argument('--relay', metavar='HOST:PORT', help='join a game at a relay instead')
+    parser.add_argument('--budget', type=float, default=Bot.budget * 1000, help='milliseconds of search per tick')
+    parser.add_argument('--worker', action='store_true', help='search in a worker process')
+    args = parser.parse_args(argv)
+    if (args.identifier is None) == (args.relay is None):
+        parser.error('give either an identifier or a relay')
+
+    game = new_belief()
+    game.add_message = print
+    net_engine = NetEngine(game)
+    game.king_captured = lambda who: net_engine.start_replay()
+    game.mode = 'connect'
+    game.init()
+    net_engine.start()
+    if args.relay is not None:
+        host, _, port = args.relay.rpartition(':')
+        net_engine.connect_relay((host, int(port)))
+    else:
+        net_engine.connect(args.identifier)
+    bot = Bot(game, worker=args.worker)
+    bot.budget = args.budget / 1000
+    stats_at = time.perf_counter()
+    try:
+        while True:
+            start = time.perf_counter()
+            net_engine.iteration()
+            bot.tick()
+            if start - stats_at > 30:
+                stats_at = start
+                print(bot.stats_line())
+            time.sleep(max(0, NetEngine.tick_time - (time.perf_counter() - start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(bot.stats_line())
+        bot.close()
+        net_engine.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,19 @@
 import itertools
-from itertools import count
 import typing
 
-from kivy.uix.image import Image
-from kivy.graphics.texture import Texture
-
 import env
+import zobrist
 
 
 class Piece(object):
     freeze_time = 0 if env.dev_mode else 80
     last_move_time = None
     last_pos = None
-    _images: typing.List[Texture]
+    # Move geometry: step directions, and whether the piece slides along them until blocked
+    directions: typing.Tuple[typing.Tuple[int, int], ...] = ()
+    slides = False
+    # Textures for each chess set, attached by the UI (see piece_images.py)
+    _images: typing.List[typing.Any]
 
     def __init__(self, player, pos, game):
         self.player = player
@@ -20,6 +21,7 @@ class Piece(object):
         self.freeze_until = 0
         self.game = game
         game.board[pos] = self
+        game.version += 1
 
     def image(self, chess_sets_perm):
         """Get image for piece"""
@@ -31,6 +33,7 @@ class Piece(object):
     def die(self):
         if self.game.board[self.pos] == self:
             del self.game.board[self.pos]
+        self.game.version += 1
         self.on_die()
 
     def on_die(self):
@@ -48,93 +51,110 @@ class Piece(object):
         self.pos = pos
         if pos in self.game.board:
             self.game.board[pos].die()
-        self.game.board[self.pos] = self
         self.freeze_until = self.game.counter+self.freeze_time
+        self.game.board[self.pos] = self
         self.game.player_freeze[self.player] = self.game.counter+self.game.player_freeze_time
+        self.game.version += 1
         return True
 
+    def freeze(self, until):
+        """Set freeze_until, keeping the board's hash up to date"""
+        board = self.game.board
+        sq = board.index(self.pos)
+        on_board = board.squares[sq] is self
+        if on_board:
+            board.hash ^= zobrist.piece_key(self, sq)
+        self.freeze_until = until
+        if on_board:
+            board.hash ^= zobrist.piece_key(self, sq)
+
     def moves(self):
         if self.game.counter < max(
                 self.freeze_until, self.game.player_freeze.get(self.player, 0)):
-            return
-        yield from self.base_moves()
+            return ()
+        return self.base_moves()
+
+    def base_moves(self):
+        return self.game.move_cache.lookup(self, 'moves', self._base_moves)
 
     def sight(self):
-        """What squares can this piece see (overridden for Pawn)"""
+        """What squares can this piece see"""
+        return self.game.move_cache.lookup(self, 'sight', self._sight)
+
+    def _sight(self):
+        """Generate sight (overridden for Pawn and King)"""
         yield from self.base_moves()
 
-    def base_moves(self):
-        for streak in self._moves(*self.pos):
-            for dst in streak:
-                if dst in self.game.board and self.game.board[dst].side() == self.side():
-                    break
-                if self.game.in_bounds(dst):
-                    yield dst
-                else:
+    def _base_moves(self):
+        board = self.game.board
+        own = self.side() + 1
+        side_at = board.side_at
+        positions = board.positions
+        for ray in self.rays(board, board.index(self.pos)):
+            for sq in ray:
+                occupant = side_at[sq]
+                if occupant == own:
                     break
-                if dst in self.game.board:
+                yield positions[sq]
+                if occupant:
                     break
 
-    @staticmethod
-    def _moves(x, y):
-        raise NotImplementedError()
+    def rays(self, board, sq):
+        """The rays of squares the piece moves along, each blocked by the first piece on it"""
+        return board.geometry.rays(self.directions, self.slides)[sq]
+
+    def watched(self, board, sq):
+        """Bit mask of the squares whose contents the piece's moves and sight depend on"""
+        mask = 1 << sq
+        side_at = board.side_at
+        for ray in self.rays(board, sq):
+            for dst in ray:
+                mask |= 1 << dst
+                if side_at[dst]:
+                    break
+        return mask
 
 
 class Rook(Piece):
     sight_color = (0.5, 0.5, 1)
-
-    @staticmethod
-    def _moves(x, y):
-        yield ((x+d, y) for d in count(1))
-        yield ((x-d, y) for d in count(1))
-        yield ((x, y+d) for d in count(1))
-        yield ((x, y-d) for d in count(1))
+    directions = ((1, 0), (-1, 0), (0, 1), (0, -1))
+    slides = True
 
 
 class Bishop(Piece):
     sight_color = (0, 0, 1)
-
-    @staticmethod
-    def _moves(x, y):
-        yield ((x+d, y+d) for d in count(1))
-        yield ((x-d, y-d) for d in count(1))
-        yield ((x+d, y-d) for d in count(1))
-        yield ((x-d, y+d) for d in count(1))
+    directions = ((1, 1), (-1, -1), (1, -1), (-1, 1))
+    slides = True
 
 
 class Queen(Rook, Bishop):
     sight_color = (1, 0, 0)
-
-    @staticmethod
-    def _moves(x, y):
-        return itertools.chain(Rook._moves(x, y), Bishop._moves(x, y))
+    directions = Rook.directions + Bishop.directions
 
 
 class Knight(Piece):
     sight_color = (0, 1, 0)
-
-    @staticmethod
-    def _moves(x, y):
-        for a in [-1, 1]:
-            for b in [-2, 2]:
-                yield [(x+a, y+b)]
-                yield [(x+b, y+a)]
+    directions = tuple(d for a in [-1, 1] for b in [-2, 2] for d in [(a, b), (b, a)])
 
 
 class King(Piece):
     sight_color = (0, 1, 1)
     freeze_time = 60
+    directions = tuple((a, b) for a in [-1, 0, 1] for b in [-1, 0, 1] if (a, b) != (0, 0))
 
-    # noinspection PyProtectedMember
-    def sight(self):
+    def _sight(self):
         yield from self.base_moves()
-        for streak in itertools.chain(Knight._moves(*self.pos), Queen._moves(*self.pos)):
-            for pos in streak:
-                if not self.game.in_bounds(pos):
-                    break
-                if pos in self.game.board:
-                    if self.pos in self.game.board[pos].base_moves():
-                        yield pos
+        board = self.game.board
+        sq = board.index(self.pos)
+        geometry = board.geometry
+        for ray in itertools.chain(
+                geometry.rays(Knight.directions, Knight.slides)[sq],
+                geometry.rays(Queen.directions, Queen.slides)[sq]):
+            for dst in ray:
+                piece = board.squares[dst]
+                if piece is not None:
+                    if self.pos in piece.base_moves():
+                        yield board.positions[dst]
                     break
 
     def move(self, pos):
@@ -154,22 +174,47 @@ class King(Piece):
         del self.game.board[piece.pos]
         piece.pos = (sx + direction, sy)
         self.game.board[piece.pos] = piece
+        self.game.version += 1
 
-    def _moves(self, x, y):
-        for a in range(x-1, x+2):
-            for b in range(y-1, y+2):
-                if (a, b) != (x, y):
-                    yield [(a, b)]
+    def rays(self, board, sq):
+        rays = super(King, self).rays(board, sq)
         if self.last_move_time is not None:
-            return
+            return rays
+        x, y = self.pos
+        return rays + tuple(
+            (sq + direction*2, ) for direction in [-1, 1] if self.castling(x, y, direction))
+
+    def watched(self, board, sq):
+        mask = super(King, self).watched(board, sq)
+        x, y = self.pos
+        row = y * board.width
+        # The castling scans
         for direction in [-1, 1]:
-            if self.castling(x, y, direction):
-                yield [(x+direction*2, y)]
+            dest = x + direction
+            while 0 <= dest < board.width:
+                mask |= 1 << (row + dest)
+                if board.side_at[row + dest]:
+                    break
+                dest += direction
+        # Pieces threatening the king
+        geometry = board.geometry
+        for ray in itertools.chain(
+                geometry.rays(Knight.directions, Knight.slides)[sq],
+                geometry.rays(Queen.directions, Queen.slides)[sq]):
+            for dst in ray:
+                mask |= 1 << dst
+                if board.side_at[dst]:
+                    break
+        return mask
 
     def castling(self, x, y, direction):
+        board = self.game.board
+        if not 0 <= y < board.height:
+            return
+        row = y * board.width
         dest = x + direction
-        while self.game.in_bounds((dest, y)):
-            piece = self.game.board.get((dest, y))
+        while 0 <= dest < board.width:
+            piece = board.squares[row + dest]
             if piece is not None:
                 if abs(dest-x) > 2 and type(piece) == Rook and piece.last_move_time is None:
                     return piece
@@ -187,45 +232,58 @@ class Pawn(Piece):
         if (self.side() == 0 and pos[1] == 7) or (self.side() == 1 and pos[1] == 0):
             self.die()
             new_piece = Queen(self.player, pos, self.game)
-            new_piece.freeze_until = self.game.counter+self.egg_time
+            new_piece.freeze(self.game.counter+self.egg_time)
         return True
 
-    def sight(self):
+    def _sight(self):
         yield from self.base_moves()
+        board = self.game.board
         delta = -1 if self.side() else 1
         x, y = self.pos
         for a in [x-1, x+1]:
-            dst = a, y+delta
-            if self.game.in_bounds(dst):
-                yield dst
+            sq = board.index((a, y+delta))
+            if sq is not None:
+                yield board.positions[sq]
+
+    def rays(self, board, sq):
+        x, y = self.pos
+        start_row, delta = (6, -1) if self.side() else (1, 1)
+        forward = []
+        for d in [delta, 2*delta] if y == start_row else [delta]:
+            dst = board.index((x, y+d))
+            if dst is None or board.side_at[dst]:
+                break
+            forward.append(dst)
+        yield forward
+        for a in [x-1, x+1]:
+            dst = board.index((a, y+delta))
+            if dst is not None and board.side_at[dst]:
+                yield (dst, )
 
-    def _moves(self, x, y):
+    def watched(self, board, sq):
+        x, y = self.pos
         start_row, delta = (6, -1) if self.side() else (1, 1)
-        m = [(x, y+delta)]
-        if y == start_row:
-            m.append((x, y+2*delta))
-        for c, p in enumerate(m):
-            if p in self.game.board:
-                m = m[:c]
+        mask = 1 << sq
+        for d in [delta, 2*delta] if y == start_row else [delta]:
+            dst = board.index((x, y+d))
+            if dst is None:
+                break
+            mask |= 1 << dst
+            if board.side_at[dst]:
                 break
-        yield m
         for a in [x-1, x+1]:
-            if (a, y+delta) in self.game.board:
-                yield [(a, y+delta)]
+            dst = board.index((a, y+delta))
+            if dst is not None:
+                mask |= 1 << dst
+        return mask
 
 
 first_row = [Rook, Knight, Bishop, Queen, King, Bishop, Knight, Rook]
 
 
-def init_pieces_images():
-    s = 45
-    pieces_image = Image(source='chess.png').texture
-
-    for x, piece in enumerate([King, Queen, Rook, Bishop, Knight, Pawn]):
-        piece._images = [pieces_image.get_region(s*x, s*y, s, s) for y in range(6)][::-1]
-
-    for preference, piece in enumerate([King, Pawn, Knight, Bishop, Rook, Queen]):
-        piece.move_preference = preference
-
+# All piece types, also giving each its code in game snapshots and hashes
+piece_types = [King, Pawn, Knight, Bishop, Rook, Queen]
 
-init_pieces_images()
+for preference, piece in enumerate(piece_types):
+    piece.move_preference = preference
+    piece.type_code = preference
@@ -0,0 +1,122 @@
+"""
+Asyncio helpers for the network engine's control plane (matching server requests).
+
+The event loop isn't run in a thread of its own - the network engine steps it every frame.
+"""
+
+import asyncio
+import urllib.parse
+
+
+class HTTPError(Exception):
+    def __init__(self, url, code, reason):
+        super().__init__('%s: %d %s' % (url, code, reason))
+        self.url = url
+        self.code = code
+        self.reason = reason
+
+
+def step(loop):
+    """Run the callbacks that are ready in the loop, without blocking"""
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+
+
+class HTTPClient(object):
+    """GET requests over HTTP/1.1 connections which are kept open for the next requests to the same server"""
+
+    def __init__(self):
+        # (host, port, secure) to (reader, writer) of idle connections
+        self.connections = {}
+        self.connections_opened = 0
+
+    async def get(self, url, timeout):
+        """GET the url's body, raising HTTPError for unsuccessful responses and asyncio.TimeoutError on timeout"""
+        return await asyncio.wait_for(self._get(url), timeout)
+
+    async def _get(self, url):
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme == 'https'
+        key = (parts.hostname, parts.port or (443 if secure else 80), secure)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request = ('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (path, parts.netloc)).encode('latin-1')
+        while True:
+            connection = self.connections.pop(key, None)
+            reused = connection is not None
+            if connection is None:
+                connection = await asyncio.open_connection(key[0], key[1], ssl=secure or None)
+                self.connections_opened += 1
+            reader, writer = connection
+            try:
+                writer.write(request)
+                await writer.drain()
+                keep_alive, code, reason, headers = await read_response_head(reader)
+                body = await read_body(reader, headers)
+            except (OSError, EOFError) as err:
+                writer.close()
+                if reused:
+                    # The server closed the idle connection, try a new one
+                    continue
+                if isinstance(err, EOFError):
+                    raise ConnectionError('connection closed') from err
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive and key not in self.connections and (
+                    'content-length' in headers or 'transfer-encoding' in headers):
+                self.connections[key] = connection
+            else:
+                writer.close()
+            break
+        if code != 200:
+            raise HTTPError(url, code, reason)
+        return body
+
+    def close(self):
+        for _, writer in self.connections.values():
+            writer.close()
+        self.connections.clear()
+
+
+async def http_get(url, timeout):
+    """GET the url's body over a new connection (see HTTPClient.get)"""
+    client = HTTPClient()
+    try:
+        return await client.get(url, timeout)
+    finally:
+        client.close()
+
+
+async def read_response_head(reader):
+    """Read the status and headers, returning (whether the connection stays open, code, reason, headers)"""
+    status = (await reader.readline()).decode('latin-1').split(None, 2)
+    if len(status) < 2 or not status[1].isdigit():
+        raise ConnectionError('bad HTTP response')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    connection = headers.get('connection', '').lower()
+    keep_alive = connection == 'keep-alive' or (status[0] == 'HTTP/1.1' and connection != 'close')
+    return keep_alive, int(status[1]), status[2].strip() if len(status) > 2 else '', headers
+
+
+async def read_body(reader, headers):
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = b''
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                return body
+            body += await reader.readexactly(size)
+            await reader.readline()
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    return await reader.read()
@@ -1,6 +1,19 @@
 import os
 
-from kivy.utils import platform
-
 dev_mode = os.environ.get('CHESS2_DEV')
-is_mobile = platform in ['ios', 'android']
+# Directory to record the replays of played games in
+replay_dir = os.environ.get('CHESS2_REPLAY_DIR')
+# File to cache our external address in, to reuse it if the game restarts soon after (see stun_probe.py)
+stun_cache = os.environ.get('CHESS2_STUN_CACHE')
+# Seconds between network statistics lines in the log (see NetEngine.stats), unset for none
+net_stats_interval = float(os.environ.get('CHESS2_NET_STATS', 0)) or None
+# Have the computer opponent search in a worker process (see bot.py)
+bot_worker = bool(os.environ.get('CHESS2_BOT_WORKER'))
+# Compute the sight map with NumPy (see vector_sight.py)
+vector_sight = bool(os.environ.get('CHESS2_VECTOR_SIGHT'))
+# Base URL of the matching server (see match_server.py to host one)
+match_url = os.environ.get('CHESS2_MATCH_URL', 'http://game-match.herokuapp.com/')
+# Same detection as kivy.utils.platform, without importing Kivy so that the game core runs headless
+is_mobile = (
+    os.environ.get('KIVY_BUILD', '') in ['android', 'ios'] or
+    'P4A_BOOTSTRAP' in os.environ or 'ANDROID_ARGUMENT' in os.environ)
@@ -1,6 +1,12 @@
 import typing
+
 import chess
 import env
+import wire
+import zobrist
+from board import Board
+from move_cache import MoveCache
+from sight_map import SightMap
 
 
 class GameModel(object):
@@ -9,7 +15,7 @@ class GameModel(object):
     player_freeze: dict
     num_players: int
     king_captured: typing.Callable[[int], None]
-    board: typing.Dict[typing.Tuple[int, int], chess.Piece]
+    board: Board
     init: typing.List[typing.Callable]
 
     player_freeze_time = 0 if env.dev_mode else 20
@@ -17,10 +23,22 @@ class GameModel(object):
     def __init__(self):
         self.player = 0
         self.mode = None
-        self.board = {}
-        self.board_size = [4, 4]
+        self.board_size = (4, 4)
+        self.board = Board(self.board_size)
+        self.player_freeze = {}
+        # Bumped on every change to the board, to invalidate memoized moves
+        self.version = 0
+        self.move_cache = MoveCache(self)
+        if env.vector_sight:
+            # NumPy is only needed for this backend
+            import vector_sight
+            self.sight_map = vector_sight.VectorSightMap(self)
+        else:
+            self.sight_map = SightMap(self)
         self.num_boards = 1
         self.messages = []
+        # Set while re-running ticks which were already shown (see NetEngine.seek)
+        self.muted = False
         self.on_message = []
         self.on_init = []
         self.reset()
@@ -31,6 +49,8 @@ class GameModel(object):
         self.cur_actions = []
 
     def add_message(self, msg):
+        if self.muted:
+            return
         self.messages.append(msg)
         for x in self.on_message:
             x()
@@ -47,8 +67,11 @@ class GameModel(object):
         if num_boards is not None:
             self.num_boards = num_boards
         self.player_freeze = {}
-        self.board = {}
+        self.version += 1
+        self.move_cache.clear()
         self.board_size = (8*self.num_boards, 8)
+        # The board's geometry (with its move tables) is only rebuilt when the number of boards changes
+        self.board = Board(self.board_size, self.board.geometry)
         self.num_players = self.num_boards * 2
 
         # Create all the pieces in an over sophisticated way. Basically, for two players, the loop will
@@ -63,13 +86,106 @@ class GameModel(object):
         for x in self.on_init:
             x()
 
+    def snapshot(self):
+        """
+        The game's state as compact bytes, which restore() brings back.
+        Messages, callbacks and the mode aren't part of the state.
+        """
+        out = bytearray()
+        wire.put_uint(out, self.counter)
+        wire.put_uint(out, self.num_boards)
+        wire.put_int(out, -1 if self.player is None else self.player)
+        wire.put_uint(out, len(self.player_freeze))
+        for player, until in sorted(self.player_freeze.items()):
+            wire.put_uint(out, player)
+            wire.put_int(out, until)
+        pieces = self.board.pieces()
+        wire.put_uint(out, len(pieces))
+        for piece in pieces:
+            wire.put_uint(out, chess.piece_types.index(type(piece)))
+            wire.put_uint(out, piece.player)
+            wire.put_uint(out, self.board.index(piece.pos))
+            wire.put_int(out, piece.freeze_until)
+            # Positions and times which may be None are shifted by one, with zero for None
+            wire.put_uint(out, 0 if piece.last_move_time is None else piece.last_move_time + 1)
+            wire.put_uint(out, 0 if piece.last_pos is None else self.board.index(piece.last_pos) + 1)
+        return bytes(out)
+
+    def restore(self, data):
+        """Go back to a state from snapshot()"""
+        reader = wire.Reader(memoryview(data), 0, len(data))
+        self.counter = reader.uint()
+        self.num_boards = reader.uint()
+        self.player = reader.int()
+        if self.player < 0:
+            self.player = None
+        self.player_freeze = {}
+        for _ in range(reader.uint()):
+            player = reader.uint()
+            self.player_freeze[player] = reader.int()
+        self.version += 1
+        self.move_cache.clear()
+        self.board_size = (8*self.num_boards, 8)
+        self.board = Board(self.board_size, self.board.geometry)
+        self.num_players = self.num_boards * 2
+        positions = self.board.positions
+        for _ in range(reader.uint()):
+            piece_type = chess.piece_types[reader.uint()]
+            who = reader.uint()
+            piece = piece_type(who, positions[reader.uint()], self)
+            if piece_type == chess.King:
+                piece.on_die = lambda who_=who: self.king_captured(who_)
+            piece.freeze_until = reader.int()
+            last_move_time = reader.uint()
+            if last_move_time:
+                piece.last_move_time = last_move_time - 1
+            last_pos = reader.uint()
+            if last_pos:
+                piece.last_pos = positions[last_pos - 1]
+        self.board.rehash()
+        for x in self.on_init:
+            x()
+
+    def state_hash(self):
+        """Zobrist hash of the pieces and freezes"""
+        result = self.board.hash
+        for player, until in self.player_freeze.items():
+            result ^= zobrist.player_freeze_key(player, until)
+        return result
+
     def in_bounds(self, pos):
         # position needs to be within board size in both dimensions
-        return all(0 <= x < s for x, s in zip(pos, self.board_size))
+        return self.board.in_bounds(pos)
 
     def add_action(self, act_type, *params):
-        """Queue an action to be executed"""
-        self.cur_actions.append((act_type, params))
+        """Queue an action to be executed (unless it wouldn't fit in the network packets)"""
+        action = (act_type, params)
+        if wire.actions_size(self.cur_actions + [action]) > wire.MAX_TICK_BYTES:
+            self.add_message(act_type + ': too long')
+            return
+        self.cur_actions.append(action)
+
+    def execute(self, all_actions, own_id=None):
+        """
+        Execute a tick's actions (list of (instance id, actions)).
+        The actions of the instance `own_id` are executed as the local player's.
+        """
+        for i, actions in all_actions:
+            nick = 'You' if i == own_id else 'Friend'
+            for action_type, params in actions:
+                action_func = getattr(self, 'action_'+action_type, None)
+                if action_func is None:
+                    self.add_message(action_type + ': no such action')
+                else:
+                    if not hasattr(action_func, 'quiet'):
+                        self.add_message(action_type.upper())
+                    if env.dev_mode:
+                        action_func(nick, *params)
+                    else:
+                        try:
+                            action_func(nick, *params)
+                        except:
+                            self.add_message('action ' + action_type + ' failed')
 
     def action_msg(self, nick, *txt):
         self.add_message('%s: %s' % (nick, ' '.join(txt)))
@@ -106,6 +222,10 @@ class GameModel(object):
                 x()
     action_become.quiet = True
 
+    def action_delay(self, _nick, _delay):
+        """The input delay is agreed on by the network engine (NetEngine.agree_delay)"""
+    action_delay.quiet = True
+
     def action_credits(self, _nick):
         self.add_message('''
             Programming: Yair Chuchem
@@ -113,3 +233,28 @@ class GameModel(object):
             Logic/Concept: Ancient People, Yair Chuchem, and fellow Play-Testers
             Programming Infrastructure: Python (Guido van Rossum and friends), Pygame/SDL (Pete Shinners and friends)
             ''')
+
+
+def headless_game(num_boards=None, mode='play', king_captured=None):
+    """
+    A game model without the UI's callbacks, for tools, tests and bots.
+    Initialized with num_boards boards and set to mode, unless mode is None
+    (for games that are set up with GameModel.restore or by their first actions).
+    """
+    game = GameModel()
+    game.king_captured = king_captured or (lambda who: None)
+    game.add_message = lambda msg: None
+    if mode is not None:
+        game.init(num_boards)
+        game.mode = mode
+    return game
+
+
+def random_move(game, rnd, player=None):
+    """A random possible move (of the player's pieces, if given) as (src, dst), or None"""
+    pieces = [(pos, piece) for pos, piece in game.board.items() if player is None or piece.player == player]
+    if not pieces:
+        return None
+    src, piece = rnd.choice(pieces)
+    opts = list(piece.moves())
+    return (src, rnd.choice(opts)) if opts else None
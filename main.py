@@ -2,6 +2,8 @@
 A networked real-time strategy game based on Chess
 """
 
+import os
+import time
 import typing
 from kivy.app import App
 from kivy.clock import Clock
@@ -10,7 +12,9 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.textinput import TextInput
 
 import env
+import profiler
 from board_view import BoardView
+from bot import Bot
 from game_model import GameModel
 from net_engine import NetEngine
 from widgets import WrappedLabel, WrappedButton
@@ -28,6 +32,8 @@ class Game(BoxLayout):
         self.game_model.king_captured = self.king_captured
         self.game_model.on_message.append(self.update_label)
         self.net_engine = NetEngine(self.game_model)
+        # The computer opponent of practice games
+        self.bot = None
 
         self.score = [0, 0]
 
@@ -43,6 +49,14 @@ class Game(BoxLayout):
         if not env.is_mobile:
             self.info_pane.add_widget(WrappedLabel(halign='center', text=self.game_title, **row_args))
 
+        self.timing_label = None
+        if env.dev_mode:
+            # Frame timings overlay
+            self.timing_label = WrappedLabel(
+                halign='left', font_name='RobotoMono-Regular', font_size='11sp',
+                size_hint=(1, 0), size_hint_min_y=140)
+            self.info_pane.add_widget(self.timing_label)
+
         self.button_pane = BoxLayout(orientation='vertical', size_hint=(1, .4))
         self.info_pane.add_widget(self.button_pane)
 
@@ -50,6 +64,10 @@ class Game(BoxLayout):
             halign='center',
             text='Tutorial: How to play',
             on_press=self.start_tutorial))
+        self.button_pane.add_widget(WrappedButton(
+            halign='center',
+            text='Practice' if env.is_mobile else 'Practice: Play against the computer',
+            on_press=self.start_practice))
         self.button_pane.add_widget(WrappedButton(
             halign='center',
             text='Start Game' if env.is_mobile else 'Start Game: Play with friends',
@@ -84,12 +102,19 @@ class Game(BoxLayout):
     def stop_net_engine(self):
         if not self.net_engine:
             return
-        self.net_engine.should_stop = True
+        self.net_engine.stop()
 
     def restart_net_engine(self):
         self.stop_net_engine()
+        self.stop_bot()
         self.net_engine = NetEngine(self.game_model)
 
+    def stop_bot(self):
+        if self.bot is not None:
+            print(self.bot.stats_line())
+            self.bot.close()
+            self.bot = None
+
     def start_game(self, _):
         self.game_model.mode = 'connect'
         self.score = [0, 0]
@@ -119,7 +144,19 @@ class Game(BoxLayout):
             'This concludes our tutorial!',
             ]
         self.game_model.init()
-        self.net_engine.iter_actions = {}
+        self.net_engine.clear_history()
+
+    def start_practice(self, _i):
+        self.game_model.mode = 'tutorial'
+        self.score = [0, 0]
+        self.restart_net_engine()
+        self.game_model.messages.clear()
+        self.game_model.add_message('You play White against the computer. Capture its king!')
+        self.game_model.tutorial_messages = []
+        self.game_model.player = 0
+        self.game_model.init()
+        self.net_engine.clear_history()
+        self.bot = Bot(self.game_model, player=1, worker=env.bot_worker)
 
     def update_label(self):
         self.score_label.text = 'White: %d   Black: %d' % tuple(self.score)
@@ -145,7 +182,24 @@ class Game(BoxLayout):
             return
         if command[:1] == '/':
             if command == '/help':
-                self.game_model.add_message('commands: /help | /reset | /credits')
+                self.game_model.add_message('commands: /help | /reset | /credits | /profile [file]')
+                self.game_model.add_message('in replays: /speed <multiplier> | /seek <seconds>')
+                return
+            name, *args = command.split()
+            if name == '/profile' and len(args) <= 1:
+                self.dump_profile(*args)
+                return
+            if name in ['/speed', '/seek'] and len(args) == 1 and self.game_model.mode == 'replay':
+                # Replay controls are local, not lockstep actions
+                try:
+                    value = float(args[0])
+                except ValueError:
+                    self.game_model.add_message('%s: not a number' % args[0])
+                    return
+                if name == '/speed':
+                    self.net_engine.replay_speed = max(0.0, value)
+                else:
+                    self.net_engine.seek(self.game_model.last_start + int(value / self.net_engine.tick_time))
                 return
             self.game_model.add_action(*command[1:].split())
             return
@@ -153,8 +207,31 @@ class Game(BoxLayout):
             # Chat
             self.game_model.add_action('msg', command)
             return
+        words = command.split()
+        if len(words) in [2, 3] and words[0].lower() == 'relay':
+            # "relay <host>:<port>" joins a game at a relay, and "relay <players> [<port>]" hosts one
+            host, _, port = words[1].rpartition(':')
+            if all(word.isdigit() for word in words[1:]):
+                self.net_engine.host_relay(*map(int, words[1:]))
+            elif len(words) == 2 and host and port.isdigit():
+                self.net_engine.connect_relay((host, int(port)))
+            else:
+                self.game_model.add_message('usage: relay <host>:<port> | relay <number of players> [<port>]')
+            return
         self.net_engine.connect(command)
 
+    def dump_profile(self, path=None):
+        """Save the frame timings, for diagnosing stutter"""
+        if path is None:
+            path = os.path.join(
+                env.replay_dir or os.getcwd(), time.strftime('chess2-profile-%Y%m%d-%H%M%S.json'))
+        try:
+            profiler.frames.dump(path)
+        except OSError as err:
+            self.game_model.add_message('Failed saving the profile: %s' % err)
+            return
+        self.game_model.add_message('Frame timings saved to %s' % path)
+
     def king_captured(self, who):
         if self.game_model.mode == 'replay':
             return
@@ -165,10 +242,22 @@ class Game(BoxLayout):
         self.game_model.add_message('%s wins!' % self.game_model.player_str(winner))
         self.net_engine.start_replay()
 
-    def on_clock(self, _interval):
+    def on_clock(self, interval):
+        frames = profiler.frames
+        # The time since the last frame, which also shows stalls outside of on_clock (such as in drawing)
+        frames.add('interval', interval)
+        start = time.perf_counter()
         self.net_engine.iteration()
+        lap = time.perf_counter()
+        if self.bot is not None:
+            self.bot.tick()
+            lap = frames.lap('bot', lap)
         self.board_view.update_dst()
+        frames.lap('update_dst', lap)
         self.board_view.show_board()
+        frames.end_frame(start)
+        if self.timing_label is not None and frames.frames % 15 == 0:
+            self.timing_label.text = frames.overlay_text()
 
 
 class Chess2App(App):
@@ -179,6 +268,7 @@ class Chess2App(App):
 
     def stop(self):
         self.game.stop_net_engine()
+        self.game.stop_bot()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,163 @@
+"""
+Matching server, to self-host instead of game-match.herokuapp.com (set CHESS2_MATCH_URL to its URL).
+
+Implements the same endpoints:
+    /register/APP/HOST/PORT/   assigns the game at HOST:PORT a three word address, and returns it
+    /lookup/APP/ADDRESS/       the external addresses of the game's players (space separated),
+                               or nothing if nobody connected to it yet
+    /connect/APP/ME/ADDRESS/   joins the game at ADDRESS as the player registered as ME,
+                               and returns the game's players (404 for unknown games)
+
+Lookups take an optional ?wait=SECONDS, for which the server holds the request until someone connects,
+so the host learns of its peer as soon as it connects instead of on its next poll.
+Connections are kept alive between requests (HTTP/1.1).
+
+Usage: python match_server.py [--port PORT]
+"""
+
+import argparse
+import http.server
+import random
+import threading
+import time
+import urllib.parse
+
+WORDS = '''
+    able acid aged also area army away baby back ball band bank base bask bath bear beat been beer bell belt
+    best bird blow blue boat body bomb bond bone book boom born boss both bowl bulk burn bush busy cake call
+    calm came camp card care case cash cast cell chat chip city club coal coat code cold come cook cool cope
+    copy core cost crew crop dark data date dawn days dead deal dean dear debt deep deny desk dial diet disk
+    door dose down draw drew drop drug dual duke dust duty each earn ease east easy edge else even ever evil
+    exit face fact fail fair fall farm fast fate fear feed feel feet fell felt file fill film find fine fire
+    firm fish five flat flow food foot ford form fort four free from fuel full fund gain game gate gave gear
+    gene gift girl give glad goal goes gold golf gone good gray grew grey grow gulf hair half hall hand hang
+    hard harm hate have head hear heat held hell help here hero high hill hire hold hole holy home hope host
+    hour huge hung hunt hurt idea inch into iron item jack jane jean john join jump jury just keen keep kent
+    kept kick kind king knee knew know lack lady laid lake land lane last late lead left less life lift like
+    line link list live load loan lock logo long look lord lose loss lost love luck made mail main make male
+    many mark mass matt meal mean meat meet menu mere mike mile milk mill mind mine miss mode mood moon more
+    most move much must name navy near neck need news next nice nick nine none nose note okay once only open
+    oral over pace pack page paid pain pair palm park part pass past path peak pick pink pipe plan play plot
+    plug plus poll pool poor port post pull pure push race rail rain rank rare rate read real rear rely rent
+    rest rice rich ride ring rise risk road rock role roll roof room root rose rule rush ruth safe said sake
+    sale salt same sand save seat seed seek seem seen self sell send sent sept ship shop shot show shut sick
+    side sign site size skin slip slow snow soft soil sold sole some song soon sort soul spot star stay step
+    stop such suit sure take tale talk tall tank tape task team tech tell tend term test text than that them
+    then they thin this thus till time tiny told toll tone tony took tool tour town tree trip true tune turn
+    twin type unit upon used user vary vast very vice view vote wage wait wake walk wall want ward warm wash
+    wave ways weak wear week well went were west what when whom wide wife wild will wind wine wing wire wise
+    wish with wood word wore work yard yeah year your zero zone
+    '''.split()
+
+
+class Registry(object):
+    """The registered games, shared by the request threads"""
+
+    # Forget games this many seconds after they registered
+    expiry = 3600
+
+    def __init__(self):
+        self.changed = threading.Condition()
+        # (app, address) to list of the players' "host:port", the registering host first
+        self.games = {}
+        self.registered_at = {}
+
+    def _expire(self):
+        now = time.time()
+        for key in [key for key, at in self.registered_at.items() if now - at > self.expiry]:
+            del self.games[key]
+            del self.registered_at[key]
+
+    def register(self, app, host, port):
+        with self.changed:
+            self._expire()
+            while True:
+                address = ' '.join(random.choice(WORDS) for _ in range(3))
+                if (app, address) not in self.games:
+                    break
+            self.games[app, address] = ['%s:%s' % (host, port)]
+            self.registered_at[app, address] = time.time()
+            return address
+
+    def connect(self, app, me, address):
+        """Raises KeyError if either game isn't registered"""
+        with self.changed:
+            players = self.games[app, address]
+            host = self.games[app, me][0]
+            if host not in players:
+                players.append(host)
+                self.changed.notify_all()
+            return ' '.join(players)
+
+    def lookup(self, app, address, wait=0):
+        """Raises KeyError if the game isn't registered"""
+        deadline = time.time() + wait
+        with self.changed:
+            while True:
+                players = self.games[app, address]
+                remaining = deadline - time.time()
+                if len(players) > 1 or remaining <= 0:
+                    return ' '.join(players) if len(players) > 1 else ''
+                self.changed.wait(remaining)
+
+
+class MatchHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    max_wait = 60
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        path = [urllib.parse.unquote(x) for x in parts.path.strip('/').split('/')]
+        query = urllib.parse.parse_qs(parts.query)
+        registry = self.server.registry
+        try:
+            if path[0] == 'register' and len(path) == 4:
+                body = registry.register(path[1], path[2], path[3])
+            elif path[0] == 'lookup' and len(path) == 3:
+                wait = min(float(query.get('wait', ['0'])[0]), self.max_wait)
+                body = registry.lookup(path[1], path[2].lower(), wait)
+            elif path[0] == 'connect' and len(path) == 4:
+                body = registry.connect(path[1], path[2].lower(), path[3].lower())
+            else:
+                self.respond(404, b'')
+                return
+        except KeyError:
+            self.respond(404, b'No such game')
+            return
+        except ValueError:
+            self.respond(400, b'Bad request')
+            return
+        self.respond(200, body.encode('utf-8'))
+
+    def respond(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            super().log_message(*args)
+
+
+class MatchServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, verbose=False):
+        super().__init__(address, MatchHandler)
+        self.registry = Registry()
+        self.verbose = verbose
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Match players of the game.')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    server = MatchServer(('', args.port), verbose=True)
+    print('matching on port %d' % server.server_address[1])
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
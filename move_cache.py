@@ -0,0 +1,35 @@
+class MoveCache(object):
+    """
+    Memoized move generation.
+
+    Results are valid for one version of the game's board (bumped on every mutation of it).
+    The cache is bounded, evicting the oldest entries first.
+    """
+    max_size = 512
+
+    def __init__(self, game):
+        self.game = game
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, piece, kind, generate):
+        key = (piece, kind)
+        version = self.game.version
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        result = tuple(generate())
+        # Generating may have looked up (and evicted) other entries, so re-check
+        if self.entries.pop(key, None) is None and len(self.entries) >= self.max_size:
+            del self.entries[next(iter(self.entries))]
+        self.entries[key] = (version, result)
+        return result
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
@@ -1,32 +1,82 @@
-import marshal
+import asyncio
+import math
+import os
 import random
-import select
 import socket
-import threading
 import time
-import urllib.error
-import urllib.request
-
-import stun
+import urllib.parse
 
+from action_log import ActionLog
+import control
 import env
-
-def poll(sock):
-    return select.select([sock], [], [], 0)[0] != []
+import profiler
+import stun_probe
+import wire
+from peer_link import PeerLink
+from relay import Relay
+from replay_file import ReplayWriter
+from transport import MAX_DATAGRAM, UdpTransport
 
 def any_actions(actions):
     return any(acts for _, acts in actions)
 
+
 class NetEngine:
-    latency = 5
+    # Input delay (in ticks) at the start of a game. The peers then agree on delays based on their connection.
+    initial_latency = 5
+    min_latency = 2
+    max_latency = 30
+    # Every this many ticks, propose a new input delay if the connection calls for one
+    delay_epoch = 90
+    # Fraction of ticks stalled waiting for peers, above which to increase the input delay
+    stall_target = 0.02
+    tick_time = 1/30
     replay_max_wait = 30
+    match_url = env.match_url
+    http_timeout = 10
+    # STUN servers to ask for our external address (all at once), and for how long before starting over
+    stun_servers = stun_probe.SERVERS
+    stun_timeout = 5
+    # Recently discovered external address, reused by the next engine that starts soon enough
+    stun_cache = stun_probe.MappingCache(env.stun_cache)
+    retry_delay = 2
+    lookup_interval = 5
+    # How long the matching server may hold a lookup until a peer connects (see match_server.py)
+    lookup_wait = 20
+    # Resend unacknowledged ticks after this many frames (until the round trip time is known)
+    resend_frames = 4
+    max_packet_ticks = 60
+    # Bytes of ticks in a packet, leaving room for its other sections
+    max_packet_bytes = MAX_DATAGRAM - 400
+    # Keep the executed ticks' actions (for the replay) in a memory-mapped temporary file
+    action_log_file = False
+    # Snapshot the game every this many ticks, so the replay can seek without re-running the whole game
+    checkpoint_interval = 300
+    # Exchange game state hashes every this many ticks, to detect desyncs
+    hash_interval = 30
+    # Directory to record the played games' replay files in (None to not record them)
+    replay_dir = env.replay_dir
+    # Print the network statistics every this many seconds (None to not print them)
+    stats_log_interval = env.net_stats_interval
 
-    def __init__(self, game_model):
+    def __init__(self, game_model, transport=None, clock=time.time):
+        """
+        Without a transport, start() sets up a UDP socket and finds peers through the matching server.
+        The clock times the communication and the stalls, and may be virtual (see transport.SimNetwork).
+        """
         self.game = game_model
-        self.socket = None
-        self.threads = []
+        self.transport = transport
+        self.clock = clock
+        self.loop = None
+        self.tasks = set()
+        self.recorder = None
+        # Our external address as discovered by setup_socket (a stun_probe.Mapping)
+        self.mapping = None
+        # A relay we host for the other players (see host_relay)
+        self.relay = None
         self.reset()
         self.instance_id = random.randrange(2**64)
+        self.started_at = self.clock()
 
     def reset(self):
         self.peers = []
@@ -34,87 +84,188 @@ class NetEngine:
         self.last_comm_time = None
         self.comm_gap_msg_at = 10
         self.should_start_replay = False
-        self.iter_actions = {}
+        self.iter_actions = ActionLog(self.action_log_file)
+        # Game snapshots by tick (taken before executing the tick)
+        self.checkpoints = {}
+        # Replay ticks per frame (may be fractional), and the fraction of a tick accumulated
+        self.replay_speed = 1
+        self.replay_progress = 0
+        # Our game state hash after each of the recent ticks, and the last tick hashed
+        self.state_hashes = {}
+        self.hashed_upto = -1
+        # Hashes peers sent for ticks we didn't execute yet, by tick, as lists of (instance id, hash)
+        self.peer_hashes = {}
+        # Our hashes that the packets carry until the frame send_hashes_until
+        self.hashes_to_send = []
+        self.send_hashes_until = 0
+        # Up to which tick we know that the peers' game states are the same as ours,
+        # and the first tick we know that they aren't
+        self.synced_upto = -1
+        self.desync_tick = None
+        # Our actions are in iter_actions up to this tick
+        self.own_upto = -1
+        # Up to which tick we have all the actions of each peer instance
+        self.received_upto = {}
+        self.links = {}
+        # In relay mode our only peer is the relay, which tells us the ids of all the players
+        self.relay_mode = False
+        self.members = None
+        self.frame = 0
+        self.latency = self.initial_latency
+        # Each instance's last proposed input delay, and ours which may be pending
+        self.delay_proposals = {}
+        self.proposed_delay = None
+        # Frames in which act() waited for peers, and number of such streaks
+        self.stall_frames = 0
+        self.stalls = 0
+        self.stalled = False
+        self.epoch_stall_frames = 0
+        # How long the recent stalls were, in seconds, and when the current one started
+        self.stall_lengths = profiler.Histogram(window=100)
+        self.stalled_at = None
+        # Per peer instance, ticks we got again and ticks we got after stalling for them
+        self.duplicate_ticks = {}
+        self.late_ticks = {}
+        # Packets which didn't decode
+        self.bad_packets = 0
+        self.stats_logged_at = self.clock()
 
     def start(self):
         self.game.player = 0
         self.game.reset()
-        self.should_stop = False
-        net_thread = threading.Thread(target=self.net_thread_go)
-        self.threads.append(net_thread)
         if not env.dev_mode:
-            net_thread.start()
+            self.spawn(self.setup_net())
 
-    def net_thread_go(self):
-        self.setup_socket()
-        if self.should_stop:
-            return
-        self.setup_addr_name()
-        if self.should_stop:
-            return
-        self.wait_for_connections()
+    def spawn(self, coro):
+        """Run a control plane task (on our event loop, which iteration() steps every frame)"""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.socket_ready = self.loop.create_future()
+            self.address_ready = self.loop.create_future()
+            # Keeps the connection to the matching server open between requests
+            self.http = control.HTTPClient()
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
 
-    def setup_socket(self):
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print('network task failed: %r' % task.exception())
+
+    def stop(self):
+        """Cancel the control plane tasks and release the network resources"""
+        if self.loop is not None:
+            for task in list(self.tasks):
+                task.cancel()
+            if self.tasks:
+                self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+            self.http.close()
+            self.loop.close()
+            self.loop = None
+        if self.transport is not None:
+            if self.mapping is not None:
+                # The mapping was in use until now
+                self.stun_cache.put(self.mapping)
+            self.transport.close()
+            self.transport = None
+        if self.relay is not None:
+            self.relay.close()
+            self.relay = None
+        self.stop_recording()
+
+    async def setup_net(self):
+        await self.setup_socket()
+        await self.setup_addr_name()
+        await self.wait_for_connections()
+
+    async def setup_socket(self):
         while True:
-            local_port = random.randint(1024, 65535)
+            mapping = self.stun_cache.get()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             try:
-                if self.should_stop:
-                    return
-                _nat_type, gamehost, gameport = stun.get_ip_info('0.0.0.0', local_port)
-                if gameport is None:
-                    print('retrying stun connection')
-                    continue
-                self.my_addr = (gamehost, gameport)
-                print('external host %s:%d' % self.my_addr)
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.bind(('', local_port))
-                print('listening on port %d' % local_port)
-            except socket.error:
+                sock.bind(('', 0 if mapping is None else mapping.local_port))
+                if mapping is None:
+                    mapping = await stun_probe.discover(sock, self.stun_servers, self.stun_timeout)
+                    self.stun_cache.put(mapping)
+            except asyncio.TimeoutError:
+                sock.close()
+                print('retrying stun connection')
+                continue
+            except OSError:
+                sock.close()
+                # The cached mapping's port is taken
+                self.stun_cache.clear()
                 print('retrying establishing server')
+                await asyncio.sleep(self.retry_delay)
                 continue
+            except BaseException:
+                sock.close()
+                raise
             break
-        self.socket = sock
+        self.mapping = mapping
+        self.my_addr = mapping.address
+        if mapping.cached:
+            print('external host %s:%d (cached)' % self.my_addr)
+        else:
+            print('external host %s:%d (from %s in %.0fms)' % (
+                mapping.address[0], mapping.address[1], mapping.server[0], mapping.elapsed * 1000))
+        print('listening on port %d' % mapping.local_port)
+        self.transport = UdpTransport(sock)
+        self.socket_ready.set_result(self.transport)
 
-    def setup_addr_name(self):
-        url = 'http://game-match.herokuapp.com/register/chess2/%s/%d/' % self.my_addr
-        print('registering at %s' % url)
-        self.address = urllib.request.urlopen(url).read().decode('utf-8')
+    async def match_request(self, *path, wait=None):
+        """
+        Request from the matching server, retrying on failures other than HTTP errors.
+        wait is how many seconds the server may hold the request before answering (for long-polling lookups).
+        """
+        url = self.match_url + '/'.join(urllib.parse.quote(x) for x in path) + '/'
+        timeout = self.http_timeout
+        if wait is not None:
+            url += '?wait=%d' % wait
+            timeout += wait
+        while True:
+            print('requesting %s' % url)
+            try:
+                return (await self.http.get(url, timeout)).decode('utf-8')
+            except (OSError, asyncio.TimeoutError) as err:
+                print('request failed (%r), retrying' % err)
+            await asyncio.sleep(self.retry_delay)
+
+    async def setup_addr_name(self):
+        self.address = await self.match_request('register', 'chess2', self.my_addr[0], str(self.my_addr[1]))
+        self.address_ready.set_result(self.address)
         self.game.add_message('')
         self.game.add_message('Your address is:')
         self.game.add_message(self.address.upper())
         self.game.add_message('')
         self.game.add_message('Type the address of a friend to play with them')
 
-    def wait_for_connections(self):
+    async def wait_for_connections(self):
         while not self.peers:
-            time.sleep(5)
-            if self.should_stop:
-                return
-            url = 'http://game-match.herokuapp.com/lookup/chess2/%s/' % self.address.replace(' ', '%20')
-            print('checking game at %s' % url)
-            self.add_peers(urllib.request.urlopen(url).read().decode('utf-8'))
+            start = time.time()
+            self.add_peers(await self.match_request('lookup', 'chess2', self.address, wait=self.lookup_wait))
+            # Servers which don't hold lookups until someone connects answer right away, so poll them periodically
+            if not self.peers and time.time() - start < self.lookup_wait / 2:
+                await asyncio.sleep(self.lookup_interval)
 
     def connect(self, address):
-        connect_thread = threading.Thread(target=self.connect_thread_go, args=(address, ))
-        self.threads.append(connect_thread)
-        connect_thread.start()
+        self.spawn(self.connect_to(address))
 
-    def connect_thread_go(self, addr):
+    async def connect_to(self, addr):
         self.game.add_message('Establishing connection with: %s' % addr)
-        while self.address is None:
-            # Net thread didn't finish
-            time.sleep(1)
-        url = 'http://game-match.herokuapp.com/connect/chess2/%s/%s/' % (self.address.replace(' ', '%20'), addr.lower().replace(' ', '%20'))
-        print('looking up host at %s' % url)
+        # Wait for our own registration to finish
+        await self.address_ready
         try:
-            response = urllib.request.urlopen(url).read()
-        except urllib.error.HTTPError as err:
+            response = await self.match_request('connect', 'chess2', self.address, addr.lower())
+        except control.HTTPError as err:
             if err.code == 404:
                 self.game.add_message('No such game: %s' % addr)
             else:
                 self.game.add_message('Server error when looking up game: %s' % addr)
             return
-        self.add_peers(response.decode('utf-8'))
+        self.add_peers(response)
         self.game.player = 1
 
     def add_peers(self, peers_str):
@@ -132,110 +283,427 @@ class NetEngine:
             self.game.add_message('Connection successful!')
             self.game.add_message('THE GAME BEGINS!')
             self.game.mode = 'play'
-            self.last_comm_time = time.time()
+            self.last_comm_time = self.clock()
             self.comm_gap_msg_at = 10
 
+    def host_relay(self, players, port=0):
+        """
+        Run a relay for a game of the given number of players, and play through it.
+        The relay has its own port, which STUN didn't map, so behind a NAT the port must be forwarded.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', port))
+        self.relay = Relay(UdpTransport(sock), players)
+        port = sock.getsockname()[1]
+        self.game.add_message('Hosting a relay for %d players on UDP port %d' % (players, port))
+        self.game.add_message('The other players must be able to reach this port (forward it if behind a NAT)')
+        self.connect_relay(('127.0.0.1', port))
+
+    def connect_relay(self, address):
+        if self.transport is not None:
+            self.join_relay(address)
+        else:
+            self.spawn(self.connect_relay_when_ready(address))
+
+    async def connect_relay_when_ready(self, address):
+        await self.socket_ready
+        self.join_relay(address)
+
+    def join_relay(self, address):
+        """Play through a relay (see relay.py) rather than sending our actions to each of the peers"""
+        print('joining relay at %s:%d' % address)
+        self.relay_mode = True
+        self.peers = [address]
+        self.game.add_message('Waiting for all the players to join the relay...')
+        self.game.mode = 'play'
+        self.last_comm_time = self.clock()
+        self.comm_gap_msg_at = 10
+
+    def set_members(self, members):
+        """
+        All the players joined the relay. We all start a game with a board for each two players.
+        This happens before any tick is executed as act() waits for the members.
+        """
+        if self.instance_id not in members:
+            self.game.add_message('The game at the relay already started')
+            return
+        self.members = sorted(members)
+        self.game.player = self.members.index(self.instance_id)
+        self.game.init((len(self.members) + 1) // 2)
+        self.game.messages.clear()
+        self.game.add_message('')
+        self.game.add_message('All %d players joined!' % len(self.members))
+        self.game.add_message('THE GAME BEGINS!')
+
+    def num_instances(self):
+        """Number of instances playing, or None when we don't know yet"""
+        if not self.relay_mode:
+            return len(self.peers) + 1
+        return None if self.members is None else len(self.members)
+
+    def set_own_actions(self, tick, actions):
+        for i in range(self.own_upto+1, tick):
+            self.iter_actions.add(i, self.instance_id, [])
+        self.iter_actions.add(tick, self.instance_id, actions)
+        self.own_upto = max(self.own_upto, tick)
+
+    def millis(self, now):
+        """Time stamp for the packets' timing section"""
+        return int((now - self.started_at) * 1000) & 0xffffffff
+
+    def ticks_to_send(self, link):
+        """Our ticks which the peer didn't acknowledge and that we didn't send it recently"""
+        resend_after = link.resend_after(self.tick_time, self.resend_frames)
+        return link.take_ticks(
+            lambda i: self.iter_actions.actions(i)[self.instance_id], self.own_upto, self.frame, resend_after,
+            self.max_packet_ticks, self.max_packet_bytes)
+
     def communicate(self):
-        if self.socket is None:
+        if self.transport is None:
             return
-        packet = marshal.dumps((
-            self.instance_id,
-            [(i, self.iter_actions.setdefault(i, {}).setdefault(self.instance_id, []))
-                for i in
-                range(
-                    max(0, self.game.counter-self.latency),
-                    self.game.counter+self.latency)]))
+        self.frame += 1
+        if self.own_upto < self.game.counter+self.latency-1:
+            self.set_own_actions(self.game.counter+self.latency-1, [])
+        now = self.clock()
         for peer in self.peers:
-            self.socket.sendto(packet, 0, peer)
-        while poll(self.socket):
-            self.last_comm_time = time.time()
-            packet, peer = self.socket.recvfrom(0x1000)
-            peer_id, peer_iter_actions = marshal.loads(packet)
-            for i, actions in peer_iter_actions:
-                acts = self.iter_actions.setdefault(i, {})
-                if peer_id in acts:
-                    assert acts[peer_id] == actions, '%s %s' % (acts[peer_id], actions)
-                else:
-                    acts[peer_id] = actions
+            link = self.links.setdefault(peer, PeerLink())
+            hashes = self.hashes_to_send if self.frame < self.send_hashes_until else ()
+            packet = wire.encode(
+                self.instance_id, self.ticks_to_send(link), self.received_upto,
+                link.stamps(now, self.millis(now)), hashes)
+            self.transport.send(packet, peer)
+            link.sent(len(packet))
+            link.sample(now)
+        while True:
+            received = self.transport.receive()
+            if received is None:
+                break
+            data, peer = received
+            self.last_comm_time = self.clock()
+            link = self.links.get(peer)
+            if link is not None:
+                link.received(len(data))
+            try:
+                packet = wire.decode(data)
+            except wire.WireError as err:
+                self.bad_packets += 1
+                print('dropping packet from %s:%d: %s' % (peer[0], peer[1], err))
+                continue
+            if self.relay_mode:
+                # The relay's packets carry the other players' ticks
+                for source_id, ticks, hashes in packet.relayed:
+                    self.receive(source_id, ticks, hashes)
+                if packet.members is not None and self.members is None:
+                    self.set_members(packet.members)
+            else:
+                self.receive(packet.sender, packet.ticks, packet.hashes)
+            if link is not None:
+                link.got_ack(packet.acks.get(self.instance_id))
+                if packet.timing is not None:
+                    link.got_stamps(packet.timing, self.last_comm_time, self.millis(self.last_comm_time))
 
         if self.last_comm_time is None:
             return
-        time_since_comm = time.time() - self.last_comm_time
+        time_since_comm = self.clock() - self.last_comm_time
         if time_since_comm >= self.comm_gap_msg_at:
             self.game.add_message('No communication for %d seconds' % self.comm_gap_msg_at)
             self.comm_gap_msg_at += 5
         elif time_since_comm < 5:
             self.comm_gap_msg_at = 5
 
+    def receive(self, peer_id, ticks, hashes):
+        """Process a peer instance's ticks and state hashes"""
+        # Ticks before the log's first (skipped for the initial latency, or discarded) count as received,
+        # otherwise the peer would keep resending them and never get past them
+        upto = max(self.received_upto.get(peer_id, -1), self.iter_actions.first - 1)
+        for i, actions in ticks:
+            existing = self.iter_actions.add(i, peer_id, actions)
+            assert existing is None or existing == actions, '%s %s' % (existing, actions)
+            if existing is not None or i <= upto:
+                self.duplicate_ticks[peer_id] = self.duplicate_ticks.get(peer_id, 0) + 1
+            elif i == self.game.counter and self.stalled:
+                self.late_ticks[peer_id] = self.late_ticks.get(peer_id, 0) + 1
+        while self.iter_actions.has(upto+1, peer_id):
+            upto += 1
+        self.received_upto[peer_id] = upto
+        for tick, state_hash in hashes:
+            if tick > self.hashed_upto:
+                self.peer_hashes.setdefault(tick, []).append((peer_id, state_hash))
+            elif tick in self.state_hashes:
+                self.check_hash(tick, state_hash)
+
     def get_replay_actions(self):
-        return sorted(self.iter_actions.get(self.game.counter, {}).items())
+        return sorted(self.iter_actions.actions(self.game.counter).items())
 
     def act(self):
         if self.game.mode == 'replay':
-            all_actions = self.get_replay_actions()
-            if any_actions(all_actions):
-                self.replay_wait = 0
-            else:
-                self.replay_wait += 1
-                if self.replay_wait == self.replay_max_wait:
-                    self.replay_wait = 0
-                    while not any_actions(all_actions) and self.game.counter+1 < self.replay_stop:
-                        self.game.counter += 1
-                        all_actions = self.get_replay_actions()
+            self.replay_progress += self.replay_speed
+            steps = int(self.replay_progress)
+            self.replay_progress -= steps
+            for _ in range(steps):
+                if self.game.mode != 'replay':
+                    break
+                self.replay_tick()
         elif self.game.active():
-            if self.game.counter < self.latency:
+            if self.game.counter < self.initial_latency:
                 self.game.counter += 1
                 return
-            if len(self.iter_actions.get(self.game.counter, {})) <= len(self.peers):
+            num_instances = self.num_instances()
+            if num_instances is None:
+                # Waiting for the relay's list of players, which isn't a lockstep stall
+                return
+            if self.iter_actions.count(self.game.counter) < num_instances:
                 # We haven't got communications from all peers for this iteration.
                 # So we'll wait.
+                self.stall_frames += 1
+                self.epoch_stall_frames += 1
+                if not self.stalled:
+                    self.stalled = True
+                    self.stalled_at = self.clock()
+                    self.stalls += 1
                 return
-            all_actions = sorted(self.iter_actions[self.game.counter].items())
+            if self.stalled:
+                self.stalled = False
+                self.stall_lengths.add(self.clock() - self.stalled_at)
+            checkpoint = None
+            if self.game.counter % self.checkpoint_interval == 0:
+                checkpoint = self.checkpoints[self.game.counter] = self.game.snapshot()
+            if self.recorder is None and self.replay_dir is not None and self.game.mode == 'play':
+                self.start_recording()
+                # The file starts from the current state
+                checkpoint = checkpoint or self.game.snapshot()
+            acts = self.iter_actions.actions(self.game.counter)
+            self.execute(sorted(acts.items()))
+            # Executed ticks can't change, they are only kept for the replay
+            self.iter_actions.confirm(self.game.counter)
+            if self.recorder is not None:
+                self.recorder.add(self.game.counter, acts, checkpoint)
+            self.record_hash(self.game.counter)
+            self.game.counter += 1
+            if self.game.mode == 'play' and self.peers and self.game.counter % self.delay_epoch == 0:
+                self.propose_delay()
         else:
             return
 
-        for i, actions in all_actions:
-            nick = 'You' if i == self.instance_id else 'Friend'
-            for action_type, params in actions:
-                action_func = getattr(self.game, 'action_'+action_type, None)
-                if action_func is None:
-                    self.game.add_message(action_type + ': no such action')
-                else:
-                    if not hasattr(action_func, 'quiet'):
-                        self.game.add_message(action_type.upper())
-                    if env.dev_mode:
-                        action_func(nick, *params)
-                    else:
-                        try:
-                            action_func(nick, *params)
-                        except:
-                            self.game.add_message('action ' + action_type + ' failed')
+        if self.should_start_replay:
+            self.should_start_replay = False
+            print('start replay!')
+            self.stop_recording()
+            self.game.mode = 'replay'
+            self.replay_stop = self.game.counter
+            self.game.counter = self.game.last_start
+            self.replay_wait = 0
+            self.replay_progress = 0
+            self.game.init()
 
+    def replay_tick(self):
+        all_actions = self.get_replay_actions()
+        if any_actions(all_actions):
+            self.replay_wait = 0
+        else:
+            self.replay_wait += 1
+            if self.replay_wait == self.replay_max_wait:
+                self.replay_wait = 0
+                while not any_actions(all_actions) and self.game.counter+1 < self.replay_stop:
+                    self.game.counter += 1
+                    all_actions = self.get_replay_actions()
+        self.execute(all_actions)
         self.game.counter += 1
 
-        if self.game.mode == 'replay' and self.game.counter == self.replay_stop:
+        if self.game.counter == self.replay_stop:
             self.game.mode = 'play'
             self.game.last_start = self.game.counter
+            # The next replay starts from here
+            self.iter_actions.discard_before(self.game.last_start)
             self.game.init()
+            self.checkpoints = {self.game.counter: self.game.snapshot()}
         assert not self.game.mode == 'replay' or self.game.counter < self.replay_stop
 
-        if self.should_start_replay:
-            self.should_start_replay = False
-            print('start replay!')
-            self.game.mode = 'replay'
-            self.replay_stop = self.game.counter
+    def seek(self, tick):
+        """
+        Jump to a tick of the replay,
+        by restoring the last checkpoint before it and re-running the ticks from there.
+        """
+        tick = max(self.game.last_start, min(self.replay_stop-1, tick))
+        start = max((i for i in self.checkpoints if self.game.last_start <= i <= tick), default=None)
+        if start is None:
             self.game.counter = self.game.last_start
-            self.replay_wait = 0
             self.game.init()
+        else:
+            self.game.restore(self.checkpoints[start])
+        # The messages of these ticks were already shown
+        self.game.muted = True
+        try:
+            while self.game.counter < tick:
+                self.execute(self.get_replay_actions())
+                self.game.counter += 1
+        finally:
+            self.game.muted = False
+        self.replay_wait = 0
+
+    def record_hash(self, tick):
+        """Hash the game state after executing the tick, and check it against the peers' hashes"""
+        state_hash = self.game.state_hash()
+        self.state_hashes[tick] = state_hash
+        self.state_hashes.pop(tick - 4*self.hash_interval, None)
+        self.hashed_upto = tick
+        if tick % self.hash_interval == 0 and self.desync_tick is None:
+            self.send_hashes([(tick, state_hash)])
+        for _, peer_hash in self.peer_hashes.pop(tick, ()):
+            self.check_hash(tick, peer_hash)
+
+    def send_hashes(self, hashes):
+        self.hashes_to_send = hashes
+        self.send_hashes_until = self.frame + self.resend_frames
+
+    def check_hash(self, tick, peer_hash):
+        if peer_hash == self.state_hashes[tick]:
+            self.synced_upto = max(self.synced_upto, tick)
+            if self.desync_tick is not None and self.desync_tick == self.synced_upto + 1:
+                self.report_desync()
+            return
+        if self.desync_tick is not None and tick >= self.desync_tick:
+            return
+        if self.desync_tick is None:
+            # Send the hashes of all the ticks since the last periodic check so the peers can find the exact tick
+            self.send_hashes([
+                (i, self.state_hashes[i]) for i in range(tick - self.hash_interval + 1, tick + 1)
+                if i in self.state_hashes])
+        self.desync_tick = tick
+        if self.desync_tick == self.synced_upto + 1:
+            self.report_desync()
+
+    def report_desync(self):
+        print('desync: game state differs from a peer\'s after tick %d' % self.desync_tick)
+        self.game.add_message('Out of sync with friend since tick %d!' % self.desync_tick)
+
+    def start_recording(self):
+        path = os.path.join(self.replay_dir, 'chess2-%s-%04x.c2r' % (
+            time.strftime('%Y%m%d-%H%M%S'), self.instance_id & 0xffff))
+        print('recording replay to %s' % path)
+        self.recorder = ReplayWriter(path, self.instance_id)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def clear_history(self):
+        """Forget the actions and checkpoints of the past ticks"""
+        self.iter_actions.clear()
+        self.checkpoints.clear()
+
+    def execute(self, all_actions):
+        """Execute a tick's actions (list of (instance id, actions))"""
+        if self.game.mode != 'replay':
+            for i, actions in all_actions:
+                for action_type, params in actions:
+                    if action_type == 'delay':
+                        self.agree_delay(i, *params)
+        self.game.execute(all_actions, self.instance_id)
+
+    def propose_delay(self):
+        """
+        Propose the smallest input delay which covers the time for our actions to reach the peers,
+        raised when we stalled waiting for peers too often.
+        The proposal goes through the lockstep actions so all peers switch delays at the same tick.
+        """
+        stall_ratio = self.epoch_stall_frames / self.delay_epoch
+        self.epoch_stall_frames = 0
+        links = [link for link in self.links.values() if link.srtt is not None]
+        if not links:
+            return
+        # Through a relay our actions go over our link and then the other players' links,
+        # which we approximate as the same as ours
+        legs = 2 if self.relay_mode else 1
+        one_way = max(legs*link.srtt/2 + 4*link.rttvar for link in links)
+        delay = math.ceil(one_way / self.tick_time) + 1
+        if stall_ratio > self.stall_target:
+            delay = max(delay, self.latency+1)
+        else:
+            # Step down gradually to avoid oscillating
+            delay = max(delay, self.latency-1)
+        delay = max(self.min_latency, min(self.max_latency, delay))
+        if delay != self.delay_proposals.get(self.instance_id, self.proposed_delay):
+            self.proposed_delay = delay
+            self.game.add_action('delay', delay)
+
+    def agree_delay(self, instance_id, delay):
+        """All peers use the largest of the delays proposed"""
+        self.delay_proposals[instance_id] = int(delay)
+        self.latency = max(self.min_latency, min(self.max_latency, max(self.delay_proposals.values())))
+
+    def delay_stats(self):
+        return {
+            'latency': self.latency,
+            'proposals': dict(self.delay_proposals),
+            'stalls': self.stalls,
+            'stall_frames': self.stall_frames,
+            'rtt': {peer: link.srtt for peer, link in self.links.items()},
+            }
+
+    def stats(self):
+        """
+        Network and lockstep statistics: the input delay, the stalls waiting for peers,
+        and per peer address (the relay's in relay mode) the round trip time and traffic.
+        """
+        now = self.clock()
+        stall_lengths = self.stall_lengths.summary()
+        return {
+            'tick': self.game.counter,
+            'latency': self.latency,
+            'stalls': self.stalls,
+            'stall_frames': self.stall_frames,
+            'stalled_seconds': now - self.stalled_at if self.stalled else 0,
+            'stall_lengths': stall_lengths,
+            'bad_packets': self.bad_packets,
+            'peers': {'%s:%d' % peer: link.stats(now) for peer, link in self.links.items()},
+            'instances': {
+                '%016x' % instance_id: {
+                    'received_upto': upto,
+                    'duplicate_ticks': self.duplicate_ticks.get(instance_id, 0),
+                    'late_ticks': self.late_ticks.get(instance_id, 0),
+                    }
+                for instance_id, upto in self.received_upto.items()},
+            }
+
+    def stats_line(self):
+        """The statistics as a line for the log"""
+        now = self.clock()
+        parts = ['net: tick %d delay %d stalls %d (%d frames, max %.2fs)' % (
+            self.game.counter, self.latency, self.stalls, self.stall_frames,
+            max(self.stall_lengths.samples, default=0))]
+        for peer, link in self.links.items():
+            packets_out, bytes_out, packets_in, bytes_in = link.rates(now)
+            parts.append('%s:%d rtt %s out %.0fp/s %.1fkB/s in %.0fp/s %.1fkB/s reordered %d' % (
+                peer[0], peer[1], '?' if link.srtt is None else '%.0f±%.0fms' % (link.srtt*1000, link.rttvar*1000),
+                packets_out, bytes_out / 1000, packets_in, bytes_in / 1000, link.reordered))
+        duplicates = sum(self.duplicate_ticks.values())
+        late = sum(self.late_ticks.values())
+        if duplicates or late:
+            parts.append('ticks duplicate %d late %d' % (duplicates, late))
+        return ' | '.join(parts)
 
     def iteration(self):
+        frames = profiler.frames
+        start = time.perf_counter()
+        if self.loop is not None:
+            control.step(self.loop)
+        if self.relay is not None:
+            self.relay.step()
+        start = frames.lap('control', start)
         self.communicate()
+        start = frames.lap('communicate', start)
+        if self.stats_log_interval and self.clock() - self.stats_logged_at >= self.stats_log_interval:
+            self.stats_logged_at = self.clock()
+            print(self.stats_line())
 
-        if self.game.mode != 'replay' and self.instance_id not in self.iter_actions.setdefault(self.game.counter+self.latency, {}):
-            self.iter_actions[self.game.counter+self.latency][self.instance_id] = self.game.cur_actions
+        if self.game.mode != 'replay' and not self.iter_actions.has(self.game.counter+self.latency, self.instance_id):
+            self.set_own_actions(self.game.counter+self.latency, self.game.cur_actions)
             self.game.cur_actions = []
 
         self.act()
+        frames.lap('act', start)
 
     def start_replay(self):
         self.should_start_replay = True
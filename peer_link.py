@@ -0,0 +1,153 @@
+"""
+Per peer state of the UDP transport: acknowledgements, resends and round trip time.
+"""
+
+import collections
+import math
+
+import wire
+
+
+class PeerLink:
+    """
+    Which of our ticks a peer has acknowledged, and when we last sent it the others.
+    Also measures the round trip time to the peer from the timing stamps in the packets,
+    and counts the traffic with it.
+    (Relays keep one per player for the timing and one per player and source instance for the ticks.)
+    """
+
+    # Seconds over which rates are measured
+    rate_window = 5
+
+    def __init__(self):
+        self.acked = -1
+        self.sent_at = {}
+        self.redundant_until = 0
+        # Smoothed round trip time and its variation (in seconds), as in TCP (RFC 6298)
+        self.srtt = None
+        self.rttvar = None
+        # The peer's last time stamp, to echo back to it, and when we got it
+        self.peer_stamp = None
+        self.peer_stamp_at = None
+        # Traffic totals, and packets that arrived after a newer one
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.reordered = 0
+        # The totals once a second, to compute recent rates from
+        self.traffic_samples = collections.deque(maxlen=self.rate_window+1)
+
+    def measure_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+            self.srtt = 0.875*self.srtt + 0.125*rtt
+
+    def resend_after(self, tick_time, default_frames):
+        """Frames to wait for an acknowledgement before deciding that a packet was lost"""
+        if self.srtt is None:
+            return default_frames
+        return max(2, math.ceil((self.srtt + 4*self.rttvar) / tick_time))
+
+    def unacked_ticks(self, upto, frame, resend_after):
+        """
+        Ticks up to `upto` which the peer didn't acknowledge and that we didn't send it recently.
+        After a loss was detected we send all the unacknowledged ticks for a while.
+        """
+        redundant = frame < self.redundant_until
+        for i in range(self.acked+1, upto+1):
+            sent_at = self.sent_at.get(i)
+            if sent_at is not None and not redundant:
+                if frame - sent_at < resend_after:
+                    continue
+                # Lost (or very late)
+                self.redundant_until = frame + resend_after
+            self.sent_at[i] = frame
+            yield i
+
+    def take_ticks(self, actions_of, upto, frame, resend_after, max_ticks, max_bytes, at_least_one=True):
+        """
+        The unacknowledged ticks to send now (see unacked_ticks) as (tick, actions),
+        at most max_ticks of them and max_bytes of encoded actions (but at least one tick, unless at_least_one is False).
+        The ticks that didn't fit are left for the next packets.
+        """
+        result = []
+        size = 0
+        for i in self.unacked_ticks(upto, frame, resend_after):
+            actions = actions_of(i)
+            size += wire.actions_size(actions)
+            if size > max_bytes and (result or not at_least_one):
+                # Not sent after all
+                del self.sent_at[i]
+                break
+            result.append((i, actions))
+            if len(result) >= max_ticks:
+                break
+        return result
+
+    def got_ack(self, acked):
+        if acked is not None and acked > self.acked:
+            for i in range(self.acked+1, acked+1):
+                self.sent_at.pop(i, None)
+            self.acked = acked
+
+    def stamps(self, now, millis):
+        """The timing section for a packet to the peer (see wire.Packet.timing)"""
+        if self.peer_stamp is None:
+            return (millis, 0, wire.NO_ECHO)
+        hold = int((now - self.peer_stamp_at) * 1000)
+        return (millis, self.peer_stamp, min(hold, wire.NO_ECHO-1))
+
+    def got_stamps(self, timing, now, millis):
+        stamp, echo, hold = timing
+        if self.peer_stamp is not None and (stamp - self.peer_stamp) & 0xffffffff >= 0x80000000:
+            self.reordered += 1
+        self.peer_stamp = stamp
+        self.peer_stamp_at = now
+        if hold != wire.NO_ECHO:
+            rtt = (millis - echo - hold) & 0xffffffff
+            if rtt < 10000:
+                self.measure_rtt(rtt / 1000)
+
+    def sent(self, size):
+        self.packets_sent += 1
+        self.bytes_sent += size
+
+    def received(self, size):
+        self.packets_received += 1
+        self.bytes_received += size
+
+    def totals(self):
+        return (self.packets_sent, self.bytes_sent, self.packets_received, self.bytes_received)
+
+    def sample(self, now):
+        """Note the traffic totals, at most once a second"""
+        if not self.traffic_samples or now - self.traffic_samples[-1][0] >= 1:
+            self.traffic_samples.append((now, self.totals()))
+
+    def rates(self, now):
+        """Packets and bytes per second sent and received, over the last rate_window seconds"""
+        if not self.traffic_samples or now <= self.traffic_samples[0][0]:
+            return (0, 0, 0, 0)
+        since, old_totals = self.traffic_samples[0]
+        return tuple((new - old) / (now - since) for new, old in zip(self.totals(), old_totals))
+
+    def stats(self, now):
+        packets_sent_rate, bytes_sent_rate, packets_received_rate, bytes_received_rate = self.rates(now)
+        return {
+            'rtt_ms': None if self.srtt is None else self.srtt * 1000,
+            'rttvar_ms': None if self.rttvar is None else self.rttvar * 1000,
+            'packets_sent': self.packets_sent,
+            'bytes_sent': self.bytes_sent,
+            'packets_received': self.packets_received,
+            'bytes_received': self.bytes_received,
+            'packets_sent_per_second': packets_sent_rate,
+            'bytes_sent_per_second': bytes_sent_rate,
+            'packets_received_per_second': packets_received_rate,
+            'bytes_received_per_second': bytes_received_rate,
+            'reordered': self.reordered,
+            'acked': self.acked,
+            }
@@ -0,0 +1,14 @@
+from kivy.uix.image import Image
+
+import chess
+
+
+def init_pieces_images():
+    """Attach the chess sets' textures to the piece classes (only needed when there's a display)"""
+    if hasattr(chess.King, '_images'):
+        return
+    s = 45
+    pieces_image = Image(source='chess.png').texture
+
+    for x, piece in enumerate([chess.King, chess.Queen, chess.Rook, chess.Bishop, chess.Knight, chess.Pawn]):
+        piece._images = [pieces_image.get_region(s*x, s*y, s, s) for y in range(6)][::-1]
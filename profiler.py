@@ -0,0 +1,118 @@
+"""
+Timings of the phases of each frame (network, game logic, drawing), to find what makes frames miss their budget.
+
+Each phase keeps a rolling window of its last timings, from which it reports percentiles and a histogram.
+Recording a timing is cheap, so it's always on and a dump can be taken when players report stutter.
+"""
+
+import bisect
+import collections
+import json
+import time
+
+# Histogram bucket upper bounds, in milliseconds
+BUCKETS_MS = [1, 2, 4, 8, 16, 33, 66, 133]
+
+
+class Histogram(object):
+    def __init__(self, window):
+        self.samples = collections.deque(maxlen=window)
+        self.total_count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.total_count += 1
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def buckets(self):
+        """Number of samples in each bucket (the last one is for samples above all the bounds)"""
+        counts = [0] * (len(BUCKETS_MS) + 1)
+        for seconds in self.samples:
+            counts[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+        return counts
+
+    def summary(self):
+        if not self.samples:
+            return {'count': 0}
+        ordered = sorted(self.samples)
+        return {
+            'count': len(ordered),
+            'total_count': self.total_count,
+            'mean_ms': sum(ordered) / len(ordered) * 1000,
+            'p50_ms': ordered[len(ordered) // 2] * 1000,
+            'p95_ms': ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] * 1000,
+            'p99_ms': ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))] * 1000,
+            'max_ms': ordered[-1] * 1000,
+            'buckets': dict(zip(['<%gms' % bound for bound in BUCKETS_MS] + ['more'], self.buckets())),
+            }
+
+
+class Profiler(object):
+    """Rolling histograms of phase timings, and a count of the frames which went over budget"""
+
+    budget = 1/30
+
+    def __init__(self, window=900):
+        self.window = window
+        self.phases = collections.OrderedDict()
+        self.frames = 0
+        self.over_budget = 0
+        self.started_at = time.time()
+
+    def add(self, phase, seconds):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram(self.window)
+        histogram.add(seconds)
+
+    def lap(self, phase, start):
+        """Record the time since start for the phase, returning the current time as the start of the next one"""
+        now = time.perf_counter()
+        self.add(phase, now - start)
+        return now
+
+    def end_frame(self, start):
+        """Record the whole frame's time"""
+        duration = self.lap('frame', start) - start
+        self.frames += 1
+        if duration > self.budget:
+            self.over_budget += 1
+
+    def reset(self):
+        self.__init__(self.window)
+
+    def summary(self):
+        return {
+            'frames': self.frames,
+            'over_budget': self.over_budget,
+            'seconds': time.time() - self.started_at,
+            'phases': {phase: histogram.summary() for phase, histogram in self.phases.items()},
+            }
+
+    def overlay_text(self):
+        """A line per phase, for the dev mode overlay"""
+        lines = ['frames over budget: %d/%d' % (self.over_budget, self.frames)]
+        for phase, histogram in self.phases.items():
+            if histogram.samples:
+                lines.append('%-11s p50 %5.1f p99 %5.1f max %5.1f ms' % (
+                    phase, histogram.percentile(0.5) * 1000, histogram.percentile(0.99) * 1000,
+                    max(histogram.samples) * 1000))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Save the summary and the raw timings (in milliseconds) as JSON"""
+        data = self.summary()
+        data['samples_ms'] = {
+            phase: [round(seconds * 1000, 3) for seconds in histogram.samples]
+            for phase, histogram in self.phases.items()}
+        with open(path, 'w') as dump_file:
+            json.dump(data, dump_file, indent=1)
+
+
+# The frames of the app (recorded by NetEngine.iteration and the UI)
+frames = Profiler()
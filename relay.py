@@ -0,0 +1,165 @@
+"""
+Relay for games of more than two players (star topology).
+
+Instead of sending its actions to each of the other players, each player sends them only to the relay,
+which forwards every player the ticks of all the others in one packet.
+So a player's upstream traffic doesn't grow with the number of players, and it only needs to reach the relay.
+
+The relay doesn't run the game. Once all the players connected it tells them who plays,
+and from then on they run the same lockstep as when connected directly.
+
+Usage: python relay.py [--port PORT] [--players PLAYERS]
+"""
+
+import argparse
+import random
+import socket
+import time
+
+import wire
+from peer_link import PeerLink
+from transport import MAX_DATAGRAM, UdpTransport
+
+
+class _Player(object):
+    def __init__(self, instance_id, address):
+        self.instance_id = instance_id
+        self.address = address
+        # For the timing stamps, and for each other player's ticks
+        self.link = PeerLink()
+        self.source_links = {}
+
+
+class Relay(object):
+    tick_time = 1/30
+    resend_frames = 4
+    max_packet_ticks = 60
+    # Bytes of ticks in a packet, leaving room for its other sections
+    max_packet_bytes = MAX_DATAGRAM - 400
+
+    def __init__(self, transport, players=2, clock=time.time):
+        self.transport = transport
+        self.num_players = players
+        self.clock = clock
+        self.instance_id = random.randrange(2**64)
+        self.started_at = clock()
+        self.frame = 0
+        self.players = {}
+        # The ids of all the players, once they all connected
+        self.members = None
+        # Each player's ticks that some other player didn't acknowledge yet, and up to which tick we have them all
+        self.ticks = {}
+        self.received_upto = {}
+        # Each player's last state hashes, and the frame we got them in
+        self.hashes = {}
+
+    def millis(self, now):
+        return int((now - self.started_at) * 1000) & 0xffffffff
+
+    def step(self):
+        """Receive the pending packets and send each player what it's missing"""
+        self.frame += 1
+        while True:
+            received = self.transport.receive()
+            if received is None:
+                break
+            data, address = received
+            try:
+                packet = wire.decode(data)
+            except wire.WireError as err:
+                print('dropping packet from %s:%d: %s' % (address[0], address[1], err))
+                continue
+            self.receive(packet, address, self.clock())
+        now = self.clock()
+        for player in self.players.values():
+            self.transport.send(self.packet_to(player, now), player.address)
+        self.collect_garbage()
+
+    def receive(self, packet, address, now):
+        player = self.players.get(packet.sender)
+        if player is None:
+            if self.members is not None:
+                # The game already started
+                return
+            print('player %016x joined from %s:%d' % (packet.sender, address[0], address[1]))
+            player = self.players[packet.sender] = _Player(packet.sender, address)
+            self.ticks[packet.sender] = {}
+            self.received_upto[packet.sender] = -1
+            if len(self.players) == self.num_players:
+                self.members = sorted(self.players)
+                print('all %d players joined' % self.num_players)
+        # The player's address may change if its NAT remaps it
+        player.address = address
+        ticks = self.ticks[packet.sender]
+        for tick, actions in packet.ticks:
+            if tick > self.received_upto[packet.sender]:
+                ticks.setdefault(tick, actions)
+        upto = self.received_upto[packet.sender]
+        while upto+1 in ticks:
+            upto += 1
+        self.received_upto[packet.sender] = upto
+        for source_id, acked in packet.acks.items():
+            link = player.source_links.get(source_id)
+            if link is not None:
+                link.got_ack(acked)
+        if packet.timing is not None:
+            player.link.got_stamps(packet.timing, now, self.millis(now))
+        if packet.hashes:
+            self.hashes[packet.sender] = (packet.hashes, self.frame)
+
+    def packet_to(self, player, now):
+        relayed = []
+        budget = self.max_packet_bytes
+        resend_after = player.link.resend_after(self.tick_time, self.resend_frames)
+        sources = list(self.received_upto.items())
+        # Start from a different player each frame, so that a busy one doesn't take the whole budget every time
+        start = self.frame % len(sources) if sources else 0
+        for source_id, upto in sources[start:] + sources[:start]:
+            if source_id == player.instance_id:
+                continue
+            link = player.source_links.setdefault(source_id, PeerLink())
+            ticks = self.ticks[source_id]
+            ticks_to_send = link.take_ticks(
+                ticks.__getitem__, upto, self.frame, resend_after, self.max_packet_ticks, budget,
+                at_least_one=budget == self.max_packet_bytes)
+            budget -= sum(wire.actions_size(actions) for _, actions in ticks_to_send)
+            hashes, hashes_frame = self.hashes.get(source_id, ((), 0))
+            if self.frame - hashes_frame >= self.resend_frames:
+                hashes = ()
+            if ticks_to_send or hashes:
+                relayed.append((source_id, ticks_to_send, hashes))
+        return wire.encode(
+            self.instance_id, (), self.received_upto, player.link.stamps(now, self.millis(now)),
+            relayed=relayed, members=self.members)
+
+    def collect_garbage(self):
+        """Forget the ticks that all the other players acknowledged"""
+        for source_id, ticks in self.ticks.items():
+            acked = [
+                player.source_links[source_id].acked if source_id in player.source_links else -1
+                for player in self.players.values() if player.instance_id != source_id]
+            if not acked:
+                continue
+            for tick in [tick for tick in ticks if tick <= min(acked)]:
+                del ticks[tick]
+
+    def close(self):
+        self.transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Relay the actions of the players of a game.')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--players', type=int, default=4)
+    args = parser.parse_args()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', args.port))
+    print('relaying for %d players on port %d' % (args.players, sock.getsockname()[1]))
+    relay = Relay(UdpTransport(sock), args.players)
+    while True:
+        relay.step()
+        time.sleep(relay.tick_time)
+
+
+if __name__ == '__main__':
+    main()
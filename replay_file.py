@@ -0,0 +1,278 @@
+"""
+Replay files: the actions of all instances for each tick of a game, recorded as it is played.
+
+A file is a header followed by chunks of consecutive ticks, and ends with an index of the chunks.
+Each chunk is self contained: it has its own table of instance ids,
+and may start with a game checkpoint (GameModel.snapshot) so that playback can start from it.
+The writer streams the chunks as they fill up. If it didn't get to write the index
+(the app was killed), the reader rebuilds it by skipping from one chunk header to the next.
+
+The ticks' actions use the same encoding as the action log.
+"""
+
+import bisect
+import struct
+import time
+
+import wire
+from action_log import put_tick, read_tick
+
+VERSION = 1
+MAGIC = b'C2R'
+END_MAGIC = b'C2RE'
+
+HEADER = struct.Struct('!3sBQd')
+# Record type, first tick, number of ticks (of the chunk, or chunks of the index), body size
+RECORD = struct.Struct('!BIII')
+TRAILER = struct.Struct('!Q4s')
+
+RECORD_CHUNK = 1
+RECORD_INDEX = 2
+
+
+class ReplayWriter(object):
+    """Streams the confirmed ticks of a game to a replay file"""
+
+    chunk_ticks = 300
+
+    def __init__(self, path, instance_id=0):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, instance_id, time.time()))
+        # List of (first tick, file offset, whether it starts with a checkpoint)
+        self.index = []
+        self.first_tick = None
+        self.next_tick = None
+        self.ticks = []
+        self.checkpoint = None
+
+    def add(self, tick, acts, checkpoint=None):
+        """
+        Add a tick's actions (dict of instance id to actions),
+        optionally with a snapshot of the game before the tick.
+        """
+        if self.next_tick is not None:
+            if tick < self.next_tick:
+                raise ValueError('tick %d was already written' % tick)
+            # Ticks nobody acted in might be skipped
+            while self.next_tick < tick:
+                self.add(self.next_tick, {})
+        if self.ticks and (checkpoint is not None or len(self.ticks) >= self.chunk_ticks):
+            self.flush()
+        if not self.ticks:
+            self.first_tick = tick
+            self.checkpoint = checkpoint
+        self.ticks.append(acts)
+        self.next_tick = tick + 1
+
+    def flush(self):
+        """Write the pending ticks as a chunk"""
+        if not self.ticks:
+            return
+        body = bytearray()
+        instance_index = {}
+        instance_ids = []
+        ticks = bytearray()
+        for acts in self.ticks:
+            put_tick(ticks, acts, instance_index, instance_ids)
+        wire.put_uint(body, len(instance_ids))
+        for instance_id in instance_ids:
+            body += wire.ID.pack(instance_id)
+        wire.put_uint(body, 0 if self.checkpoint is None else len(self.checkpoint))
+        if self.checkpoint is not None:
+            body += self.checkpoint
+        body += ticks
+        self.index.append((self.first_tick, self.file.tell(), self.checkpoint is not None))
+        self.file.write(RECORD.pack(RECORD_CHUNK, self.first_tick, len(self.ticks), len(body)))
+        self.file.write(body)
+        self.file.flush()
+        self.ticks = []
+        self.checkpoint = None
+
+    def close(self):
+        """Write the remaining ticks and the index"""
+        if self.file.closed:
+            return
+        self.flush()
+        body = bytearray()
+        prev_tick = prev_offset = 0
+        for tick, offset, has_checkpoint in self.index:
+            wire.put_uint(body, tick - prev_tick)
+            wire.put_uint(body, offset - prev_offset)
+            body.append(has_checkpoint)
+            prev_tick, prev_offset = tick, offset
+        index_offset = self.file.tell()
+        self.file.write(RECORD.pack(RECORD_INDEX, 0, len(self.index), len(body)))
+        self.file.write(body)
+        self.file.write(TRAILER.pack(index_offset, END_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+
+class ReplayReader(object):
+    """
+    Reads a replay file one chunk at a time, so that long games open without loading them fully.
+    Raises wire.WireError for files which aren't replays or are corrupted.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self._read_header()
+            self._read_index()
+        except:
+            self.file.close()
+            raise
+        # The last chunk read, as its number in the index, first tick and list of ticks' actions
+        self._chunk = None
+
+    def _read(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise wire.WireError('truncated replay file')
+        return data
+
+    def _read_header(self):
+        magic, version, self.instance_id, self.started_at = HEADER.unpack(self._read(HEADER.size))
+        if magic != MAGIC:
+            raise wire.WireError('not a replay file')
+        if version != VERSION:
+            raise wire.WireError('unsupported replay file version %d' % version)
+
+    def _read_index(self):
+        self.file.seek(0, 2)
+        size = self.file.tell()
+        if size >= HEADER.size + RECORD.size + TRAILER.size:
+            self.file.seek(size - TRAILER.size)
+            index_offset, end_magic = TRAILER.unpack(self._read(TRAILER.size))
+            if end_magic == END_MAGIC and HEADER.size <= index_offset < size - TRAILER.size:
+                self.file.seek(index_offset)
+                record_type, _, count, body_size = RECORD.unpack(self._read(RECORD.size))
+                if record_type != RECORD_INDEX:
+                    raise wire.WireError('bad replay index')
+                reader = wire.Reader(self._read(body_size), 0, body_size)
+                tick = offset = 0
+                self.index = []
+                for _ in range(count):
+                    tick += reader.uint()
+                    offset += reader.uint()
+                    self.index.append((tick, offset, bool(reader.byte())))
+                self.end_tick = self._chunk_end(self.index)
+                return
+        self._scan(size)
+
+    def _scan(self, size):
+        """Rebuild the index of a file that wasn't closed properly"""
+        self.index = []
+        offset = HEADER.size
+        end_tick = None
+        while offset + RECORD.size <= size:
+            self.file.seek(offset)
+            record_type, tick, num_ticks, body_size = RECORD.unpack(self._read(RECORD.size))
+            end = offset + RECORD.size + body_size
+            if record_type != RECORD_CHUNK or end > size:
+                # A chunk that was cut short
+                break
+            self.index.append((tick, offset, self._chunk_body(offset)[1] is not None))
+            end_tick = tick + num_ticks
+            offset = end
+        self.end_tick = end_tick
+
+    def _chunk_end(self, index):
+        if not index:
+            return None
+        self.file.seek(index[-1][1])
+        _, tick, num_ticks, _ = RECORD.unpack(self._read(RECORD.size))
+        return tick + num_ticks
+
+    def _chunk_body(self, offset):
+        """Read a chunk as (first tick, checkpoint, reader positioned at its ticks, number of ticks, instance ids)"""
+        self.file.seek(offset)
+        record_type, tick, num_ticks, body_size = RECORD.unpack(self._read(RECORD.size))
+        if record_type != RECORD_CHUNK:
+            raise wire.WireError('bad replay chunk')
+        body = memoryview(self._read(body_size))
+        reader = wire.Reader(body, 0, body_size)
+        instance_ids = [reader.id() for _ in range(reader.uint())]
+        checkpoint = reader.bytes()
+        return tick, bytes(checkpoint) if checkpoint else None, reader, num_ticks, instance_ids
+
+    @property
+    def first_tick(self):
+        return self.index[0][0] if self.index else None
+
+    def __len__(self):
+        """Number of ticks"""
+        return 0 if not self.index else self.end_tick - self.first_tick
+
+    def _find_chunk(self, tick):
+        i = bisect.bisect_right(self.index, (tick, float('inf'))) - 1
+        if i < 0 or self.end_tick is None or tick >= self.end_tick:
+            return None
+        return i
+
+    def _load_chunk(self, i):
+        first, _, reader, num_ticks, instance_ids = self._chunk_body(self.index[i][1])
+        ticks = [read_tick(reader, instance_ids) for _ in range(num_ticks)]
+        self._chunk = (i, first, ticks)
+        return self._chunk
+
+    def actions(self, tick):
+        """All instances' actions for the tick (dict of instance id to actions)"""
+        i = self._find_chunk(tick)
+        if i is None:
+            return {}
+        chunk = self._chunk
+        if chunk is None or chunk[0] != i:
+            chunk = self._load_chunk(i)
+        _, first, ticks = chunk
+        return ticks[tick - first] if tick - first < len(ticks) else {}
+
+    def ticks(self, start=None, stop=None):
+        """Iterate over (tick, actions) from start to stop, reading a chunk at a time"""
+        if not self.index:
+            return
+        tick = self.first_tick if start is None else max(start, self.first_tick)
+        stop = self.end_tick if stop is None else min(stop, self.end_tick)
+        while tick < stop:
+            i = self._find_chunk(tick)
+            _, first, ticks = self._load_chunk(i)
+            for tick in range(tick, min(stop, first + len(ticks))):
+                yield tick, ticks[tick - first]
+            tick = first + len(ticks)
+
+    def checkpoint(self, tick):
+        """The last checkpoint at or before the tick, as (tick, GameModel.snapshot data), or None"""
+        i = bisect.bisect_right(self.index, (tick, float('inf'))) - 1
+        while i >= 0 and not self.index[i][2]:
+            i -= 1
+        if i < 0:
+            return None
+        first, checkpoint, _, _, _ = self._chunk_body(self.index[i][1])
+        return first, checkpoint
+
+    def seek(self, game, tick, own_id=None):
+        """
+        Bring the game to its state before the tick,
+        from the last checkpoint before it and running the ticks from there (see GameModel.execute).
+        """
+        checkpoint = self.checkpoint(tick)
+        if checkpoint is None:
+            raise ValueError('no checkpoint before tick %d' % tick)
+        game.restore(checkpoint[1])
+        for _, acts in self.ticks(game.counter, tick):
+            game.execute(sorted(acts.items()), own_id)
+            game.counter += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
@@ -0,0 +1,159 @@
+"""
+Batch bot-vs-bot games, for tuning the game's timings (how long pieces and players are frozen after moving).
+
+Usage: python selfplay.py [--games N] [--seed SEED] [-j JOBS] [--boards N] [--max-ticks N]
+                          [--freeze-time T] [--king-freeze-time T] [--egg-time T] [--player-freeze-time T]
+                          [--output RESULTS]
+
+Each game is played by a bot (bot.py) per player on a single game model, without the network.
+The bots search without a time budget, so a game only depends on its seed and the timings,
+and the results of a run are the same for any number of jobs.
+"""
+
+import argparse
+import collections
+import functools
+import json
+import multiprocessing
+import sys
+import time
+
+import chess
+from bot import Bot
+from game_model import GameModel, headless_game
+from net_engine import NetEngine
+
+# The tuned timings, in ticks, and the class attributes they set
+TIMINGS = {
+    'freeze_time': (chess.Piece, 'freeze_time'),
+    'king_freeze_time': (chess.King, 'freeze_time'),
+    'egg_time': (chess.Pawn, 'egg_time'),
+    'player_freeze_time': (GameModel, 'player_freeze_time'),
+    }
+
+
+def current_timings():
+    return {name: getattr(cls, attr) for name, (cls, attr) in TIMINGS.items()}
+
+
+def set_timings(timings):
+    for name, value in timings.items():
+        cls, attr = TIMINGS[name]
+        setattr(cls, attr, value)
+
+
+def play_game(seed, timings=None, num_boards=1, max_ticks=9000, input_delay=NetEngine.initial_latency):
+    """
+    Play a game to the first king capture (or max_ticks), returning its statistics.
+    The players' actions take effect input_delay ticks after they are made, like in a networked game.
+    """
+    saved_timings = current_timings()
+    set_timings(timings or {})
+    try:
+        captured = []
+        game = headless_game(num_boards, king_captured=captured.append)
+        bots = [Bot(game, player, seed='%d/%d' % (seed, player)) for player in range(game.num_players)]
+        for player_bot in bots:
+            player_bot.budget = None
+        pending = collections.defaultdict(list)
+        moves = [0] * game.num_players
+        captures = collections.Counter()
+        while not captured and game.counter < max_ticks:
+            for player_bot in bots:
+                player_bot.tick()
+                if game.cur_actions:
+                    pending[game.counter + input_delay].append((player_bot.player, game.cur_actions))
+                    game.cur_actions = []
+            actions = pending.pop(game.counter, None)
+            if actions:
+                before = set(game.board.values())
+                game.execute(actions)
+                for piece in before.difference(game.board.values()):
+                    # Promoted pawns leave the board too, but as queens
+                    if game.board.get(piece.pos) is None or game.board[piece.pos].player != piece.player:
+                        captures['%s.%s' % (['white', 'black'][piece.side()], type(piece).__name__.lower())] += 1
+                for player, player_actions in actions:
+                    moves[player] += sum(1 for action_type, _ in player_actions if action_type == 'move')
+            game.counter += 1
+        loser = captured[0] if captured else None
+        return {
+            'seed': seed,
+            'winner': None if loser is None else ['white', 'black'][1 - loser % 2],
+            'ticks': game.counter,
+            # Moves each player made (some may have failed, as the position changed during the input delay)
+            'moves': moves,
+            'captures': dict(captures),
+            'nodes': sum(player_bot.nodes for player_bot in bots),
+            'search_seconds': sum(player_bot.search_seconds for player_bot in bots),
+            }
+    finally:
+        set_timings(saved_timings)
+
+
+def summarize(results):
+    """Aggregate the games' statistics"""
+    games = len(results)
+    ticks = sorted(result['ticks'] for result in results)
+    wins = collections.Counter(result['winner'] or 'draw' for result in results)
+    captures = collections.Counter()
+    for result in results:
+        captures.update(result['captures'])
+    search_seconds = sum(result['search_seconds'] for result in results)
+    return {
+        'games': games,
+        'win_rate': {side: wins[side] / games for side in ['white', 'black', 'draw']},
+        'ticks': {
+            'mean': sum(ticks) / games,
+            'p10': ticks[int(0.1 * games)],
+            'p50': ticks[games // 2],
+            'p90': ticks[min(games - 1, int(0.9 * games))],
+            },
+        'moves_per_game': sum(sum(result['moves']) for result in results) / games,
+        'captures_per_game': {kind: count / games for kind, count in sorted(captures.items())},
+        'nodes_per_second': sum(result['nodes'] for result in results) / search_seconds if search_seconds else None,
+        }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Play bot-vs-bot games to evaluate the game timings.')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game (the others follow it)')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--boards', type=int, default=1, help='two players per board')
+    parser.add_argument('--max-ticks', type=int, default=9000, help='games lasting longer are draws')
+    for name, value in current_timings().items():
+        parser.add_argument('--' + name.replace('_', '-'), type=int, default=value, help='in ticks (default %d)' % value)
+    parser.add_argument('--output', metavar='RESULTS', help='save the summary and the games as JSON')
+    args = parser.parse_args(argv)
+
+    timings = {name: getattr(args, name) for name in TIMINGS}
+    play = functools.partial(play_game, timings=timings, num_boards=args.boards, max_ticks=args.max_ticks)
+    seeds = range(args.seed, args.seed + args.games)
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.jobs) as pool:
+        results = sorted(pool.imap_unordered(play, seeds, chunksize=4), key=lambda result: result['seed'])
+    seconds = time.perf_counter() - start
+    summary = summarize(results)
+    print('%d games in %.1fs (%.2f games/s with %d jobs)' % (len(results), seconds, len(results) / seconds, args.jobs))
+    print('wins: white %(white).1f%%, black %(black).1f%%, draws %(draw).1f%%' % {
+        side: rate * 100 for side, rate in summary['win_rate'].items()})
+    print('length: mean %(mean).0f ticks, p10 %(p10)d, p50 %(p50)d, p90 %(p90)d' % summary['ticks'])
+    print('captures per game: %s' % ', '.join(
+        '%s %.2f' % (kind, count) for kind, count in summary['captures_per_game'].items()))
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump({
+                'timings': timings,
+                'boards': args.boards,
+                'max_ticks': args.max_ticks,
+                'seed': args.seed,
+                'seconds': seconds,
+                'jobs': args.jobs,
+                'summary': summary,
+                'games': results,
+                }, results_file, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,7 @@
 from setuptools import setup
 
 OPTIONS = {
-    'packages': ['kivy', 'stun'],
+    'packages': ['kivy'],
 }
 
 setup(
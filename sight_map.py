@@ -0,0 +1,153 @@
+class _Entry(object):
+    __slots__ = ['sq', 'watched', 'seen', 'cover', 'frozen_until', 'active']
+
+
+class SightMap(object):
+    """
+    What each side sees and where each player's pieces can move, kept up to date incrementally.
+
+    Only pieces watching squares that changed on the board since the last update are recomputed.
+    A frozen piece's move coverage is added when its freeze expires.
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.board = None
+        self.version = 0
+        self._coverage_cache = {}
+
+    def reset(self):
+        """Recompute everything for a new board"""
+        self.board = self.game.board
+        self.board.dirty = 0
+        self.entries = {}
+        self.seen = [{}, {}]
+        self.covered = {}
+        self.player_freeze = dict(self.game.player_freeze)
+        self.counter = self.game.counter
+        self.next_thaw = None
+        for sq, piece in enumerate(self.board.squares):
+            if piece is not None:
+                self._add(piece, sq)
+        self.version += 1
+
+    def update(self):
+        game = self.game
+        board = game.board
+        if board is not self.board:
+            self.reset()
+            return
+        changed = False
+        dirty = board.dirty
+        if dirty:
+            board.dirty = 0
+            changed = True
+            # Remove all affected pieces before adding any back,
+            # as a square's coverage may move from a piece that left it to pieces reaching it.
+            stale = [(piece, entry.sq) for piece, entry in self.entries.items() if entry.watched & dirty]
+            for piece, _ in stale:
+                self._remove(piece)
+            for piece, sq in stale:
+                if board.squares[sq] is piece:
+                    self._add(piece, sq)
+            while dirty:
+                low = dirty & -dirty
+                dirty ^= low
+                sq = low.bit_length() - 1
+                piece = board.squares[sq]
+                if piece is not None and piece not in self.entries:
+                    self._add(piece, sq)
+        if game.player_freeze != self.player_freeze or game.counter < self.counter or (
+                self.next_thaw is not None and game.counter >= self.next_thaw):
+            self.player_freeze = dict(game.player_freeze)
+            changed = self._refreeze() or changed
+        self.counter = game.counter
+        if changed:
+            self.version += 1
+
+    def visible(self, player):
+        """Positions visible to the player (to everyone when player is None)"""
+        self.update()
+        if player is None:
+            return self.seen[0].keys() | self.seen[1].keys()
+        return self.seen[player % 2].keys()
+
+    def coverage(self, player):
+        """Positions of the player's pieces and where they can move to, with their summed sight colors"""
+        self.update()
+        key = (self.version, player)
+        result = self._coverage_cache.get(key)
+        if result is None:
+            result = {
+                pos: [sum(c[i] for c in colors) for i in range(3)]
+                for pos, colors in self.covered.get(player, {}).items()}
+            self._coverage_cache = {key: result}
+        return result
+
+    def _frozen_until(self, piece):
+        return max(piece.freeze_until, self.game.player_freeze.get(piece.player, 0))
+
+    def _add(self, piece, sq):
+        entry = _Entry()
+        entry.sq = sq
+        entry.watched = piece.watched(self.board, sq)
+        entry.seen = [piece.pos]
+        entry.seen.extend(piece.sight())
+        moves = set(piece.base_moves())
+        # Like the sight, the coverage counts squares multiple times when they are seen more than once
+        entry.cover = [dst for dst in entry.seen[1:] if dst in moves]
+        entry.frozen_until = self._frozen_until(piece)
+        entry.active = False
+        self.entries[piece] = entry
+        seen = self.seen[piece.side()]
+        for pos in entry.seen:
+            seen[pos] = seen.get(pos, 0) + 1
+        self.covered.setdefault(piece.player, {})[piece.pos] = [piece.sight_color]
+        if self.game.counter >= entry.frozen_until:
+            self._activate(piece, entry)
+        elif self.next_thaw is None or entry.frozen_until < self.next_thaw:
+            self.next_thaw = entry.frozen_until
+
+    def _remove(self, piece):
+        entry = self.entries.pop(piece)
+        if entry.active:
+            self._deactivate(piece, entry)
+        seen = self.seen[piece.side()]
+        for pos in entry.seen:
+            seen[pos] -= 1
+            if not seen[pos]:
+                del seen[pos]
+        del self.covered[piece.player][entry.seen[0]]
+
+    def _activate(self, piece, entry):
+        entry.active = True
+        covered = self.covered[piece.player]
+        for dst in entry.cover:
+            covered.setdefault(dst, []).append(piece.sight_color)
+
+    def _deactivate(self, piece, entry):
+        entry.active = False
+        covered = self.covered[piece.player]
+        for dst in entry.cover:
+            colors = covered[dst]
+            colors.remove(piece.sight_color)
+            if not colors:
+                del covered[dst]
+
+    def _refreeze(self):
+        """Update which pieces can move now after freezes changed or expired"""
+        changed = False
+        counter = self.game.counter
+        self.next_thaw = None
+        for piece, entry in self.entries.items():
+            entry.frozen_until = self._frozen_until(piece)
+            active = counter >= entry.frozen_until
+            if active != entry.active:
+                changed = True
+                if active:
+                    self._activate(piece, entry)
+                else:
+                    self._deactivate(piece, entry)
+            if not active and (self.next_thaw is None or entry.frozen_until < self.next_thaw):
+                self.next_thaw = entry.frozen_until
+        return changed
@@ -0,0 +1,43 @@
+import env
+
+
+class SquareColors(object):
+    """
+    The colors of the board's squares as the player sees them (what BoardView draws).
+    The base colors only change with the sight map, so they are recomputed only then.
+    Doesn't use Kivy, so it also runs headless (see bench.py).
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.key = None
+        self.base_cols = {}
+
+    def board_info(self, mouse_pos=None, selected=None, is_dragging=False):
+        """The squares' colors and the visible squares"""
+        player = None if self.game.mode == 'replay' else self.game.player
+        flash = {}
+        if not env.is_mobile and not is_dragging:
+            flashy = self.game.board.get(mouse_pos)
+            if flashy is not None and flashy.player == player:
+                for pos in flashy.moves():
+                    flash[pos] = flashy.sight_color
+        if not is_dragging and selected is not None and selected.player == player and \
+                self.game.board.get(selected.pos) is selected and mouse_pos in selected.moves():
+            flash[selected.pos] = selected.sight_color
+
+        sight_map = self.game.sight_map
+        see = sight_map.visible(player)
+        key = (sight_map.version, player)
+        if self.key != key:
+            self.key = key
+            self.base_cols = {pos: (240, 240, 240) for pos in see}
+            if player is not None:
+                for pos, col in sight_map.coverage(player).items():
+                    self.base_cols[pos] = [128+a*127./max(col) for a in col]
+
+        cols = dict(self.base_cols)
+        for pos, col in flash.items():
+            cols[pos] = [255*x for x in col]
+
+        return cols, see
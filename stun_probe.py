@@ -0,0 +1,189 @@
+"""
+Discovery of our external address (as the peers see it through the NAT) with STUN binding requests (RFC 5389).
+
+The requests are sent from the game's own socket, so the address found is the one the peers will reach,
+and to several servers at once: the first answer wins, so a slow or unreachable server doesn't delay startup.
+
+When two servers see the same address the NAT maps the socket to it regardless of who it talks to,
+so the mapping is cached and a restarted game can bind the same port and reuse it without asking again.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import struct
+import time
+
+MAGIC_COOKIE = 0x2112a442
+# Message type, length of the attributes, magic cookie, transaction id
+HEADER = struct.Struct('!HHI12s')
+# Attribute type and length
+ATTRIBUTE = struct.Struct('!HH')
+# Reserved byte, address family, port, IPv4 address
+ADDRESS = struct.Struct('!BBH4s')
+
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+MAPPED_ADDRESS = 0x0001
+XOR_MAPPED_ADDRESS = 0x0020
+FAMILY_IPV4 = 1
+
+SERVERS = [
+    ('stun.l.google.com', 19302),
+    ('stun1.l.google.com', 19302),
+    ('stun.cloudflare.com', 3478),
+    ('stun.ekiga.net', 3478),
+    ]
+
+
+def binding_request(transaction_id):
+    return HEADER.pack(BINDING_REQUEST, 0, MAGIC_COOKIE, transaction_id)
+
+
+def parse_response(data):
+    """The (transaction id, (host, port)) of a binding response, or None for other packets"""
+    if len(data) < HEADER.size:
+        return None
+    msg_type, length, cookie, transaction_id = HEADER.unpack_from(data)
+    if msg_type != BINDING_SUCCESS or cookie != MAGIC_COOKIE or HEADER.size + length > len(data):
+        return None
+    pos = HEADER.size
+    end = pos + length
+    mapped = None
+    while pos + ATTRIBUTE.size <= end:
+        attr_type, attr_length = ATTRIBUTE.unpack_from(data, pos)
+        pos += ATTRIBUTE.size
+        if attr_type in (MAPPED_ADDRESS, XOR_MAPPED_ADDRESS) and attr_length >= ADDRESS.size:
+            _, family, port, host = ADDRESS.unpack_from(data, pos)
+            if family == FAMILY_IPV4:
+                if attr_type == XOR_MAPPED_ADDRESS:
+                    port ^= MAGIC_COOKIE >> 16
+                    host = bytes(a ^ b for a, b in zip(host, struct.pack('!I', MAGIC_COOKIE)))
+                mapped = (socket.inet_ntoa(host), port)
+                # Some NATs rewrite addresses in packets, which the xored one is immune to
+                if attr_type == XOR_MAPPED_ADDRESS:
+                    break
+        # Attributes are padded to 4 bytes
+        pos += (attr_length + 3) // 4 * 4
+    return None if mapped is None else (transaction_id, mapped)
+
+
+class Mapping(object):
+    def __init__(self, local_port, address, server=None, elapsed=0, endpoint_independent=None, cached=False):
+        self.local_port = local_port
+        # Our external (host, port)
+        self.address = address
+        # The server that answered first, and how many seconds it took
+        self.server = server
+        self.elapsed = elapsed
+        # Whether servers at different addresses saw the same address (None if only one answered)
+        self.endpoint_independent = endpoint_independent
+        self.cached = cached
+
+
+async def discover(sock, servers=SERVERS, timeout=5, retransmit=0.25, grace=0.2):
+    """
+    Find the socket's external address, asking all the servers at once
+    and resending unanswered requests at doubling intervals.
+    After the first answer waits up to grace seconds for a second one to learn whether the mapping is cacheable.
+    Returns a Mapping, or raises asyncio.TimeoutError if no server answered in time.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    # Transaction id to server of the unanswered requests, and list of (server, address, seconds) answers
+    pending = {}
+    answers = []
+
+    async def ask(server):
+        try:
+            infos = await loop.getaddrinfo(server[0], server[1], family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        except OSError:
+            return
+        transaction_id = os.urandom(12)
+        pending[transaction_id] = server
+        request = binding_request(transaction_id)
+        delay = retransmit
+        while transaction_id in pending:
+            try:
+                sock.sendto(request, infos[0][4])
+            except OSError:
+                pass
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def receive(count):
+        while len(answers) < count:
+            try:
+                data = await loop.sock_recv(sock, 0x1000)
+            except OSError:
+                # ICMP errors of unreachable servers
+                continue
+            response = parse_response(data)
+            if response is not None and response[0] in pending:
+                answers.append((pending.pop(response[0]), response[1], time.perf_counter() - start))
+
+    blocking = sock.getblocking()
+    sock.setblocking(False)
+    requests = [loop.create_task(ask(server)) for server in servers]
+    try:
+        await asyncio.wait_for(receive(1), timeout)
+        try:
+            await asyncio.wait_for(receive(2), grace)
+        except asyncio.TimeoutError:
+            pass
+    finally:
+        for task in requests:
+            task.cancel()
+        await asyncio.gather(*requests, return_exceptions=True)
+        sock.setblocking(blocking)
+    server, address, elapsed = answers[0]
+    endpoint_independent = None if len(answers) < 2 else all(answer[1] == address for answer in answers)
+    return Mapping(sock.getsockname()[1], address, server, elapsed, endpoint_independent)
+
+
+class MappingCache(object):
+    """
+    The last discovered mapping, if cacheable.
+    Kept in a file if given one, so that it outlives the process.
+    """
+
+    # NATs commonly forget idle mappings after a minute or two
+    max_age = 60
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entry = None
+
+    def get(self):
+        """A fresh cached Mapping, or None"""
+        entry = self.entry
+        if entry is None and self.path is not None:
+            try:
+                with open(self.path) as cache_file:
+                    entry = json.load(cache_file)
+            except (OSError, ValueError):
+                return None
+        if entry is None or not 0 <= time.time() - entry['time'] < self.max_age:
+            return None
+        return Mapping(entry['local_port'], tuple(entry['address']), cached=True, endpoint_independent=True)
+
+    def put(self, mapping):
+        if not mapping.endpoint_independent:
+            self.clear()
+            return
+        self.entry = {'local_port': mapping.local_port, 'address': list(mapping.address), 'time': time.time()}
+        if self.path is not None:
+            try:
+                with open(self.path, 'w') as cache_file:
+                    json.dump(self.entry, cache_file)
+            except OSError as err:
+                print('failed saving the address cache: %s' % err)
+
+    def clear(self):
+        self.entry = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
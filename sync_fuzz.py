@@ -0,0 +1,145 @@
+"""
+Fuzz the lockstep sync: play games with random moves and chat over a simulated network (transport.SimNetwork)
+and check that all the peers end up in the same state.
+
+Usage: python sync_fuzz.py [--seeds N] [-j JOBS] [--players N] [--ticks N]
+                           [--latency S] [--jitter S] [--loss P] [--duplicate P] [--reorder P] [--json]
+
+The network runs on a virtual clock, so a game takes as long as computing it, and the same seed replays the same game.
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+from game_model import headless_game, random_move
+from net_engine import NetEngine
+from relay import Relay
+from transport import SimNetwork
+import wire
+
+
+def run_seed(seed, players=2, ticks=600, move_ratio=0.2, reset_ratio=0.0005, chat_ratio=0.02, **conditions):
+    """
+    Play a game and report whether the peers' states agree.
+    Games of more than two players go through a relay.
+    conditions are the SimNetwork's latency, jitter, loss, duplicate and reorder.
+    """
+    rnd = random.Random(seed)
+    network = SimNetwork(seed, **conditions)
+    net_engines = []
+    for _ in range(players):
+        net_engine = NetEngine(headless_game((players + 1) // 2), network.transport(), network.clock)
+        net_engine.instance_id = rnd.randrange(2**64)
+        net_engine.replay_dir = None
+        net_engines.append(net_engine)
+    relay = None
+    if players > 2:
+        relay = Relay(network.transport(), players, network.clock)
+        for net_engine in net_engines:
+            net_engine.join_relay(relay.transport.address)
+    else:
+        for player, net_engine in enumerate(net_engines):
+            net_engine.game.player = player
+            net_engine.peers = [other.transport.address for other in net_engines if other is not net_engine]
+
+    def step(target=None):
+        if relay is not None:
+            relay.step()
+        for net_engine in net_engines:
+            game = net_engine.game
+            if target is None:
+                r = rnd.random()
+                if r < reset_ratio:
+                    game.add_action('reset')
+                elif r < reset_ratio + chat_ratio:
+                    # Chat lines up to the longest that fit in a tick
+                    game.add_action('msg', 'x' * rnd.randrange(wire.MAX_TICK_BYTES - 10))
+                elif r < move_ratio and len(game.cur_actions) < 3:
+                    move = random_move(game, rnd, game.player)
+                    if move is not None:
+                        game.add_action('move', *move)
+            if target is None or game.counter < target:
+                net_engine.iteration()
+            else:
+                # Only keep the peers that are behind supplied
+                net_engine.communicate()
+        network.advance(NetEngine.tick_time)
+
+    start = time.perf_counter()
+    max_frames = ticks * 20
+    frames = 0
+    while min(net_engine.game.counter for net_engine in net_engines) < ticks and frames < max_frames:
+        step()
+        frames += 1
+    # Bring all the peers to the same tick
+    target = max(net_engine.game.counter for net_engine in net_engines)
+    while any(net_engine.game.counter < target for net_engine in net_engines) and frames < max_frames:
+        step(target)
+        frames += 1
+
+    counters = [net_engine.game.counter for net_engine in net_engines]
+    hashes = ['%016x' % net_engine.game.state_hash() for net_engine in net_engines]
+    desyncs = [net_engine.desync_tick for net_engine in net_engines if net_engine.desync_tick is not None]
+    result = {
+        'seed': seed,
+        'completed': len(set(counters)) == 1 and counters[0] >= ticks,
+        'synced': len(set(counters)) == 1 and len(set(hashes)) == 1 and not desyncs,
+        'tick': min(counters),
+        'hash': hashes[0],
+        'desync_tick': min(desyncs) if desyncs else None,
+        'moves': sum(1 for piece in net_engines[0].game.board.values() if piece.last_move_time is not None),
+        'stalls': sum(net_engine.stalls for net_engine in net_engines),
+        'latency': max(net_engine.latency for net_engine in net_engines),
+        'network': dict(network.counts),
+        'virtual_seconds': network.now,
+        'seconds': time.perf_counter() - start,
+        }
+    for net_engine in net_engines:
+        net_engine.stop()
+    if relay is not None:
+        relay.close()
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Fuzz the lockstep sync over a simulated network.')
+    parser.add_argument('--seeds', type=int, default=20, help='number of games')
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--players', type=int, default=2)
+    parser.add_argument('--ticks', type=int, default=600)
+    parser.add_argument('--latency', type=float, default=0.03, help='one way, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='in seconds')
+    parser.add_argument('--loss', type=float, default=0, help='probability of losing a packet')
+    parser.add_argument('--duplicate', type=float, default=0, help='probability of duplicating a packet')
+    parser.add_argument('--reorder', type=float, default=0, help='probability of delaying a packet past later ones')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON lines')
+    args = parser.parse_args(argv)
+
+    run = functools.partial(
+        run_seed, players=args.players, ticks=args.ticks, latency=args.latency, jitter=args.jitter,
+        loss=args.loss, duplicate=args.duplicate, reorder=args.reorder)
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    start = time.perf_counter()
+    failures = 0
+    with multiprocessing.Pool(args.jobs) as pool:
+        for result in pool.imap_unordered(run, seeds):
+            failures += not (result['synced'] and result['completed'])
+            if args.json:
+                print(json.dumps(result))
+            elif not result['synced'] or not result['completed']:
+                print('seed %d: %s at tick %d (desync at %s)' % (
+                    result['seed'], 'synced' if result['synced'] else 'NOT SYNCED', result['tick'],
+                    result['desync_tick']))
+    if not args.json:
+        print('%d games, %d out of sync or stalled, in %.1fs' % (args.seeds, failures, time.perf_counter() - start))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,9 +1,38 @@
+import functools
+import http.server
+import json
+import multiprocessing
+import os
 import random
 import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-from game_model import GameModel
-from net_engine import NetEngine
+import bot
+import chess
+import control
+import profiler
+import selfplay
+import stun_probe
+import sync_fuzz
+import wire
+from action_log import ActionLog
+from game_model import GameModel, headless_game, random_move
+from match_server import MatchServer
+from net_engine import NetEngine, PeerLink
+from relay import Relay
+from replay_file import ReplayReader, ReplayWriter
+from transport import UdpTransport
+import verify
+
+try:
+    import vector_sight
+except ImportError:
+    vector_sight = None
 
 class GameInstance:
     def __init__(self):
@@ -12,23 +41,866 @@ class GameInstance:
         self.game.init()
         self.game.mode = 'play'
         self.game.add_message = print
-        self.net_engine = NetEngine(self.game)
-        self.init_net_engine_socket()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        self.net_engine = NetEngine(self.game, UdpTransport(sock))
 
     def king_captured(self, who):
         if self.game.mode != 'replay':
             self.net_engine.start_replay()
 
-    def init_net_engine_socket(self):
+
+def random_moves(game, rnd, count):
+    for _ in range(count):
+        move = random_move(game, rnd)
+        if move is not None:
+            game.action_move('You', *move)
+
+
+class TestMoveGeneration(unittest.TestCase):
+    def position(self, pieces, num_boards=1):
+        """A game with only the given (type, player, pos) pieces"""
+        game = headless_game(num_boards)
+        game.board.clear()
+        game.version += 1
+        for kind, player, pos in pieces:
+            kind(player, pos, game)
+        return game
+
+    def check(self, game, expected):
+        """expected maps squares to the piece's moves and the squares it sees but can't move to"""
+        for pos, (moves, sight) in expected.items():
+            piece = game.board[pos]
+            self.assertEqual(sorted(piece.moves()), moves, pos)
+            self.assertEqual(sorted(set(piece.sight()) - set(moves)), sight, pos)
+
+    def test_castling(self):
+        game = self.position([
+            (chess.King, 0, (4, 0)), (chess.Rook, 0, (0, 0)), (chess.Rook, 0, (7, 0)), (chess.Knight, 0, (5, 5)),
+            (chess.King, 1, (4, 7)), (chess.Rook, 1, (0, 7)), (chess.Knight, 1, (1, 7)), (chess.Rook, 1, (5, 7))])
+        self.check(game, {
+            (4, 0): ([(2, 0), (3, 0), (3, 1), (4, 1), (5, 0), (5, 1), (6, 0)], []),
+            # Blocked by the knight on one side and the rook is too close on the other.
+            # The king sees the knight that threatens it.
+            (4, 7): ([(3, 6), (3, 7), (4, 6), (5, 6)], [(5, 5)]),
+            (0, 0): ([(0, 1), (0, 2), (0, 3), (0, 4), (0, 5), (0, 6), (0, 7), (1, 0), (2, 0), (3, 0)], []),
+            (7, 0): ([(5, 0), (6, 0), (7, 1), (7, 2), (7, 3), (7, 4), (7, 5), (7, 6), (7, 7)], []),
+            })
+        # No castling with a rook that moved
+        game.board[7, 0].last_move_time = 0
+        game.version += 1
+        self.check(game, {(4, 0): ([(2, 0), (3, 0), (3, 1), (4, 1), (5, 0), (5, 1)], [])})
+
+    def test_pawns(self):
+        game = self.position([
+            (chess.Pawn, 0, (3, 1)), (chess.Pawn, 0, (6, 1)), (chess.Pawn, 0, (4, 2)), (chess.Pawn, 0, (0, 2)),
+            (chess.Knight, 1, (2, 2)), (chess.Bishop, 1, (6, 3)), (chess.Pawn, 1, (5, 6)), (chess.Pawn, 1, (1, 3))])
+        self.check(game, {
+            # Double step and a capture, but not of its own pawn
+            (3, 1): ([(2, 2), (3, 2), (3, 3)], [(4, 2)]),
+            # Double step blocked
+            (6, 1): ([(6, 2)], [(5, 2), (7, 2)]),
+            (4, 2): ([(4, 3)], [(3, 3), (5, 3)]),
+            (0, 2): ([(0, 3), (1, 3)], []),
+            # Black pawns go down
+            (5, 6): ([(5, 4), (5, 5)], [(4, 5), (6, 5)]),
+            (1, 3): ([(0, 2), (1, 2)], [(2, 2)]),
+            })
+
+    def test_blocked_sliders(self):
+        game = self.position([
+            (chess.Rook, 0, (0, 0)), (chess.Pawn, 0, (0, 3)), (chess.Bishop, 0, (2, 2)), (chess.Knight, 1, (4, 0)),
+            (chess.Pawn, 1, (4, 4)), (chess.Queen, 1, (5, 5)), (chess.Pawn, 1, (5, 6)), (chess.King, 1, (6, 6))])
+        self.check(game, {
+            (0, 0): ([(0, 1), (0, 2), (1, 0), (2, 0), (3, 0), (4, 0)], []),
+            (2, 2): ([(0, 4), (1, 1), (1, 3), (3, 1), (3, 3), (4, 0), (4, 4)], []),
+            (5, 5): ([
+                (0, 5), (1, 5), (2, 5), (3, 5), (3, 7), (4, 5), (4, 6), (5, 0), (5, 1), (5, 2), (5, 3), (5, 4),
+                (6, 4), (6, 5), (7, 3), (7, 5)], []),
+            (5, 6): ([], [(4, 5), (6, 5)]),
+            })
+
+    def test_two_boards(self):
+        game = self.position([
+            (chess.Rook, 0, (6, 3)), (chess.Knight, 0, (7, 0)), (chess.King, 2, (9, 3)), (chess.Pawn, 2, (8, 1)),
+            (chess.Bishop, 3, (8, 6))], num_boards=2)
+        game.board[9, 3].last_move_time = 0
+        # The boards are side by side, and pieces move across
+        self.check(game, {
+            (6, 3): ([
+                (0, 3), (1, 3), (2, 3), (3, 3), (4, 3), (5, 3), (6, 0), (6, 1), (6, 2), (6, 4), (6, 5), (6, 6),
+                (6, 7), (7, 3), (8, 3)], []),
+            (7, 0): ([(5, 1), (6, 2), (8, 2), (9, 1)], []),
+            (8, 1): ([(8, 2), (8, 3)], [(7, 2), (9, 2)]),
+            (8, 6): ([
+                (2, 0), (3, 1), (4, 2), (5, 3), (6, 4), (7, 5), (7, 7), (9, 5), (9, 7), (10, 4), (11, 3), (12, 2),
+                (13, 1), (14, 0)], []),
+            (9, 3): ([(8, 2), (8, 3), (8, 4), (9, 2), (9, 4), (10, 2), (10, 3), (10, 4)], []),
+            })
+
+
+class TestSightMap(unittest.TestCase):
+    def expected(self, game, player):
+        see = set()
+        cover = {}
+        for piece in game.board.values():
+            if player is not None and piece.side() != player % 2:
+                continue
+            see.add(piece.pos)
+            moves = set(piece.moves()) if piece.player == player else set()
+            if piece.player == player:
+                cover[piece.pos] = list(piece.sight_color)
+            for dst in piece.sight():
+                see.add(dst)
+                if dst in moves:
+                    cover[dst] = [a+b for a, b in zip(cover.get(dst, [0]*3), piece.sight_color)]
+        return see, cover
+
+    def test_incremental_updates(self):
+        rnd = random.Random(0)
+        game = headless_game(2)
+        for _ in range(300):
+            for player in [None] + list(range(game.num_players)):
+                see, cover = self.expected(game, player)
+                self.assertEqual(set(game.sight_map.visible(player)), see)
+                if player is not None:
+                    actual = game.sight_map.coverage(player)
+                    self.assertEqual(actual.keys(), cover.keys())
+                    for pos, col in cover.items():
+                        for a, b in zip(actual[pos], col):
+                            self.assertAlmostEqual(a, b)
+            random_moves(game, rnd, rnd.choice([0, 1, 3]))
+            game.counter += rnd.choice([1, 1, 5])
+
+    @unittest.skipIf(vector_sight is None, 'needs NumPy')
+    def test_vector_sight(self):
+        for num_boards in [1, 2, 4]:
+            rnd = random.Random(num_boards)
+            game = headless_game(num_boards)
+            vector_map = vector_sight.VectorSightMap(game)
+            for _ in range(150):
+                for player in [None] + list(range(game.num_players)):
+                    self.assertEqual(vector_map.visible(player), set(game.sight_map.visible(player)))
+                    if player is not None:
+                        self.assertEqual(vector_map.coverage(player), game.sight_map.coverage(player))
+                sight = vector_map.sight
+                for side in range(2):
+                    attacks = {}
+                    for piece in game.board.values():
+                        if piece.side() == side:
+                            for pos in piece.base_moves():
+                                attacks[pos] = attacks.get(pos, 0) + 1
+                    counts = sight.attacks(side)
+                    self.assertEqual(
+                        {game.board.positions[sq]: counts[sq] for sq in counts.nonzero()[0]}, attacks)
+                random_moves(game, rnd, rnd.choice([0, 1, 3]))
+                game.counter += rnd.choice([1, 1, 5, 30])
+
+
+class TestMoveCache(unittest.TestCase):
+    def test_invalidation(self):
+        game = headless_game()
+        knight = game.board[1, 0]
+        self.assertEqual(set(knight.moves()), {(0, 2), (2, 2)})
+        misses = game.move_cache.misses
+        self.assertEqual(set(knight.moves()), {(0, 2), (2, 2)})
+        self.assertEqual(game.move_cache.misses, misses)
+        game.action_move('You', (0, 1), (0, 2))
+        self.assertEqual(set(knight.base_moves()), {(2, 2)})
+        # Frozen player can't move
+        self.assertEqual(knight.moves(), ())
+        game.counter = game.player_freeze[0]
+        self.assertEqual(set(knight.moves()), {(2, 2)})
+
+
+class TestStateHash(unittest.TestCase):
+    def test_incremental(self):
+        rnd = random.Random(0)
+        game = headless_game(2)
+        states = {}
+        for _ in range(500):
+            random_moves(game, rnd, 3)
+            game.counter += rnd.choice([1, 1, 30])
+            board_hash = game.board.hash
+            game.board.rehash()
+            self.assertEqual(game.board.hash, board_hash)
+            state = tuple(sorted(game.player_freeze.items())), tuple(sorted(
+                (pos, type(piece).__name__, piece.player, piece.freeze_until, piece.last_move_time is None)
+                for pos, piece in game.board.items()))
+            states.setdefault(state, set()).add(game.state_hash())
+        # The same states have the same hashes and different states have different hashes
+        self.assertEqual(len(set.union(*states.values())), len(states))
+        self.assertEqual(max(len(hashes) for hashes in states.values()), 1)
+
+
+class TestReplay(unittest.TestCase):
+    def new_game(self):
+        return headless_game(mode=None)
+
+    def state(self, game):
+        return game.counter, dict(game.player_freeze), sorted(
+            (pos, type(piece).__name__, piece.player, piece.freeze_until, piece.last_move_time, piece.last_pos)
+            for pos, piece in game.board.items())
+
+    def test_snapshot(self):
+        rnd = random.Random(0)
+        game = self.new_game()
+        game.init(2)
+        for _ in range(20):
+            random_moves(game, rnd, 5)
+            game.counter += rnd.randrange(100)
+            data = game.snapshot()
+            state = self.state(game)
+            moves = {pos: sorted(piece.moves()) for pos, piece in game.board.items()}
+            random_moves(game, rnd, 5)
+            game.restore(data)
+            self.assertEqual(self.state(game), state)
+            self.assertEqual({pos: sorted(piece.moves()) for pos, piece in game.board.items()}, moves)
+
+    def play(self, net_engine, rnd, num_ticks):
+        """Play random moves solo, returning the game's state before each tick"""
+        game = net_engine.game
+        states = {}
+        while game.counter < num_ticks:
+            states[game.counter] = self.state(game)
+            src, piece = rnd.choice(list(game.board.items()))
+            opts = list(piece.moves())
+            if opts and rnd.random() < 0.3:
+                game.add_action('move', src, rnd.choice(opts))
+            net_engine.iteration()
+        return states
+
+    def test_seek(self):
+        rnd = random.Random(1)
+        # With the model's own messages, which seeking shouldn't repeat
+        game = GameModel()
+        game.king_captured = lambda who: None
+        game.init()
+        game.mode = 'play'
+        net_engine = NetEngine(game)
+        net_engine.checkpoint_interval = 50
+        states = self.play(net_engine, rnd, 400)
+        net_engine.start_replay()
+        net_engine.iteration()
+        self.assertEqual(game.mode, 'replay')
+        inits = []
+        game.on_init.append(lambda: inits.append(game.counter))
+        messages = len(game.messages)
+        for tick in [350, 10, 199, 200, 201, 0, 399]:
+            net_engine.seek(tick)
+            self.assertEqual(self.state(game), states[tick])
+        self.assertEqual(len(game.messages), messages)
+        # The view is reset on restoring a checkpoint as on starting from scratch
+        self.assertEqual(inits, [350, 0, 150, 200, 200, 0, 350])
+        # Fast forward to the end of the replay
+        net_engine.seek(0)
+        net_engine.replay_speed = 8
+        frames = 0
+        while game.mode == 'replay':
+            net_engine.iteration()
+            frames += 1
+        self.assertLessEqual(frames, 401 // 8 + 1)
+
+
+    def test_replay_file(self):
+        with tempfile.TemporaryDirectory() as replay_dir:
+            game = self.new_game()
+            game.init()
+            game.mode = 'play'
+            net_engine = NetEngine(game)
+            net_engine.replay_dir = replay_dir
+            net_engine.checkpoint_interval = 100
+            states = self.play(net_engine, random.Random(2), 700)
+            net_engine.stop()
+            [name] = os.listdir(replay_dir)
+            with ReplayReader(os.path.join(replay_dir, name)) as reader:
+                self.assertEqual(reader.instance_id, net_engine.instance_id)
+                self.assertEqual(reader.first_tick, net_engine.initial_latency)
+                replayed = self.new_game()
+                replayed.init()
+                for tick in [650, 5, 99, 100, 101, 420]:
+                    reader.seek(replayed, tick)
+                    self.assertEqual(self.state(replayed), states[tick])
+
+
+    def test_verify(self):
+        with tempfile.TemporaryDirectory() as replay_dir:
+            game = self.new_game()
+            game.init()
+            game.mode = 'play'
+            net_engine = NetEngine(game)
+            net_engine.replay_dir = replay_dir
+            self.play(net_engine, random.Random(3), 500)
+            net_engine.stop()
+            [path] = [os.path.join(replay_dir, name) for name in os.listdir(replay_dir)]
+            game.player = None
+            result = verify.verify(path, hashes=True)
+            self.assertEqual(result['final_hash'], verify.state_hash(game))
+            self.assertEqual(len(result['hashes']), result['ticks'])
+            # A copy of the game where someone reset the board at tick 200
+            changed = os.path.join(replay_dir, 'changed.c2r')
+            with ReplayReader(path) as reader, ReplayWriter(changed) as writer:
+                for tick, acts in reader.ticks():
+                    if tick == 200:
+                        acts[1] = [('reset', ())]
+                    writer.add(tick, acts, reader.checkpoint(tick)[1] if tick == reader.first_tick else None)
+            self.assertEqual(verify.first_divergence(path, path), None)
+            self.assertEqual(verify.first_divergence(path, changed), 201)
+            self.assertEqual(verify.main(['-j', '2', '--json', path, changed]), 0)
+
+
+class TestReplayFile(unittest.TestCase):
+    def test_write_read(self):
+        rnd = random.Random(0)
+        expected = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'game.c2r')
+            with ReplayWriter(path, 7) as writer:
+                writer.chunk_ticks = 16
+                for tick in range(100, 400):
+                    if rnd.random() < 0.1:
+                        # Skipped ticks are written as empty
+                        expected[tick] = {}
+                        continue
+                    expected[tick] = {i: [('move', ((i, 1), (i, 2)))] * rnd.randrange(3) for i in [3, 2**64-1]}
+                    writer.add(tick, expected[tick], b'state%d' % tick if tick % 50 == 0 else None)
+            with ReplayReader(path) as reader:
+                self.assertEqual(len(reader), 300)
+                self.assertEqual(dict(reader.ticks()), expected)
+                self.assertEqual(list(reader.ticks(395, 1000)), [(i, expected[i]) for i in range(395, 400)])
+                for tick in rnd.sample(range(100, 400), 50):
+                    self.assertEqual(reader.actions(tick), expected[tick])
+                self.assertEqual(reader.checkpoint(99), None)
+                self.assertEqual(reader.checkpoint(249), (200, b'state200'))
+            # A file that wasn't closed properly, cut in the middle of a chunk
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data[:len(data) // 2])
+            with ReplayReader(path) as reader:
+                ticks = dict(reader.ticks())
+                self.assertGreater(len(ticks), 100)
+                self.assertEqual(ticks, {i: expected[i] for i in ticks})
+
+
+class TestWire(unittest.TestCase):
+    def random_action(self, rnd):
+        square = lambda: (rnd.randrange(-3, 40), rnd.randrange(-3, 10))
+        return rnd.choice([
+            lambda: ('move', (square(), square())),
+            lambda: ('msg', ('hello', 'w\u00f6rld')),
+            lambda: ('reset', ()),
+            lambda: ('become', (str(rnd.randrange(4)), )),
+            lambda: ('custom', (rnd.randrange(-2**40, 2**40), square())),
+            lambda: ('odd', ([1, 2], None, 1.5)),
+            # Numbers beyond 64 bits go through marshal
+            lambda: ('big', (
+                rnd.choice([2**63-1, -2**63, 2**63, -2**63-1, 10**30]), (2**63-1, -2**63), (-2**63, 2**63-1))),
+            ])()
+
+    def random_ticks(self, rnd):
+        tick = rnd.randrange(10**6)
+        return [(tick+i, [self.random_action(rnd) for _ in range(rnd.choice([0, 0, 0, 1, 2]))])
+                for i in range(rnd.randrange(12))]
+
+    def test_round_trip(self):
+        rnd = random.Random(0)
+        for _ in range(2000):
+            sender = rnd.randrange(2**64)
+            ticks = self.random_ticks(rnd)
+            hashes = [(tick, rnd.randrange(2**64)) for tick, _ in ticks[:rnd.randrange(3)]]
+            packet = wire.decode(wire.encode(sender, ticks, hashes=hashes))
+            self.assertEqual(packet.sender, sender)
+            self.assertEqual(packet.ticks, ticks)
+            self.assertEqual(list(packet.hashes), hashes)
+
+    def test_fuzz(self):
+        rnd = random.Random(1)
+        for _ in range(5000):
+            data = bytearray(wire.encode(rnd.randrange(2**64), self.random_ticks(rnd)))
+            for _ in range(rnd.randrange(1, 4)):
+                data[rnd.randrange(len(data))] = rnd.randrange(256)
+            data = data[:rnd.randrange(len(data)+1)]
+            try:
+                wire.decode(bytes(data))
+            except wire.WireError:
+                pass
+
+
+class TestActionLog(unittest.TestCase):
+    def check_log(self, log):
+        rnd = random.Random(0)
+        expected = {}
+        for tick in range(300):
+            for instance_id in [5, 2**64-1]:
+                actions = [('move', ((rnd.randrange(8), 1), (rnd.randrange(8), 2)))] * rnd.choice([0, 0, 1, 2])
+                self.assertIsNone(log.add(tick, instance_id, actions))
+                expected.setdefault(tick, {})[instance_id] = actions
+            if tick >= 10:
+                log.confirm(tick-10)
+        self.assertEqual(log.confirmed_upto(), 289)
+        for tick in range(300):
+            self.assertEqual(log.actions(tick), expected[tick])
+        # Confirmed ticks can't be changed
+        self.assertEqual(log.add(5, 5, [('reset', ())]), expected[5][5])
+        self.assertEqual(log.actions(5), expected[5])
+        log.discard_before(100)
+        self.assertEqual(log.actions(99), {})
+        self.assertIsNone(log.add(99, 5, []))
+        self.assertFalse(log.has(99, 5))
+        for tick in range(100, 300):
+            self.assertEqual(log.actions(tick), expected[tick])
+        self.assertEqual(log.count(299), 2)
+
+    def test_memory(self):
+        self.check_log(ActionLog())
+
+    def test_file(self):
+        self.check_log(ActionLog(use_file=True))
+
+
+class TestPeerLink(unittest.TestCase):
+    def test_resend_after_loss(self):
+        link = PeerLink()
+        self.assertEqual(list(link.unacked_ticks(2, 0, 3)), [0, 1, 2])
+        # Only the new tick, until resend_after frames passed
+        self.assertEqual(list(link.unacked_ticks(3, 1, 3)), [3])
+        self.assertEqual(list(link.unacked_ticks(3, 2, 3)), [])
+        # The ticks sent in frame 0 are lost, tick 3 isn't late yet
+        self.assertEqual(list(link.unacked_ticks(3, 3, 3)), [0, 1, 2])
+        self.assertEqual(link.redundant_until, 6)
+        # After the loss everything unacknowledged is sent every frame
+        self.assertEqual(list(link.unacked_ticks(3, 4, 3)), [0, 1, 2, 3])
+        self.assertEqual(list(link.unacked_ticks(4, 5, 3)), [0, 1, 2, 3, 4])
+        # And then back to waiting
+        self.assertEqual(list(link.unacked_ticks(4, 6, 3)), [])
+        self.assertEqual(list(link.unacked_ticks(4, 8, 3)), [0, 1, 2, 3, 4])
+
+    def test_acks(self):
+        link = PeerLink()
+        list(link.unacked_ticks(4, 0, 3))
+        link.got_ack(1)
+        self.assertEqual(link.acked, 1)
+        self.assertEqual(sorted(link.sent_at), [2, 3, 4])
+        # Stale, missing and out of order acks don't go back
+        link.got_ack(0)
+        link.got_ack(None)
+        self.assertEqual(link.acked, 1)
+        link.got_ack(3)
+        link.got_ack(2)
+        self.assertEqual(link.acked, 3)
+        self.assertEqual(sorted(link.sent_at), [4])
+        # Acknowledged ticks are never resent
+        self.assertEqual(list(link.unacked_ticks(5, 3, 3)), [4, 5])
+
+
+    def test_byte_budget(self):
+        link = PeerLink()
+        actions = {i: [('msg', ('x' * 100,))] * (i % 3) for i in range(10)}
+        ticks = link.take_ticks(actions.__getitem__, 9, 0, 3, 60, 500)
+        self.assertEqual([i for i, _ in ticks], [0, 1, 2, 3, 4])
+        self.assertLessEqual(sum(wire.actions_size(acts) for _, acts in ticks), 500)
+        # The ticks that didn't fit go in the next packet, without waiting for a resend
+        ticks = link.take_ticks(actions.__getitem__, 9, 1, 3, 2, 500)
+        self.assertEqual([i for i, _ in ticks], [5, 6])
+        # A tick larger than the budget is still sent alone
+        self.assertEqual([i for i, _ in link.take_ticks(actions.__getitem__, 9, 2, 3, 60, 10)], [7])
+        self.assertEqual(link.take_ticks(actions.__getitem__, 9, 2, 3, 60, 10, at_least_one=False), [])
+
+    def test_long_messages(self):
+        game = headless_game()
+        game.add_action('msg', 'x' * 100000)
+        self.assertEqual(game.cur_actions, [])
+        # Long messages over UDP, where a packet longer than the receive buffer would arrive truncated
+        a, b = GameInstance(), GameInstance()
+        a.net_engine.peers = [('127.0.0.1', b.port)]
+        b.net_engine.peers = [('127.0.0.1', a.port)]
+        for tick in range(10):
+            a.game.add_action('msg', 'x' * 500)
+            self.assertEqual(len(a.game.cur_actions), 1)
+            a.net_engine.set_own_actions(tick, a.game.cur_actions)
+            a.game.cur_actions = []
+        for _ in range(100):
+            a.net_engine.communicate()
+            b.net_engine.communicate()
+            if b.net_engine.received_upto.get(a.net_engine.instance_id, -1) == 9:
+                break
+            time.sleep(0.001)
+        self.assertEqual(b.net_engine.received_upto[a.net_engine.instance_id], 9)
+        self.assertEqual(b.net_engine.bad_packets, 0)
+        for inst in [a, b]:
+            inst.net_engine.stop()
+
+class TestAdaptiveDelay(unittest.TestCase):
+    def test_propose_and_agree(self):
+        game = GameModel()
+        game.init()
+        game.mode = 'play'
+        net_engine = NetEngine(game)
+        net_engine.peers = [('127.0.0.1', 1)]
+        link = net_engine.links[net_engine.peers[0]] = PeerLink()
+        link.measure_rtt(0.01)
+        net_engine.propose_delay()
+        self.assertEqual(game.cur_actions, [('delay', (net_engine.latency-1, ))])
+        # A far peer proposes a bigger delay, which all peers agree on
+        net_engine.agree_delay(net_engine.instance_id, 4)
+        net_engine.agree_delay(1234, 9)
+        self.assertEqual(net_engine.latency, 9)
+        # Stalls increase the delay
+        net_engine.epoch_stall_frames = net_engine.delay_epoch
+        net_engine.propose_delay()
+        self.assertEqual(game.cur_actions[-1], ('delay', (10, )))
+
+
+class FakeMatchServer(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        command = self.path.split('/')[1]
+        body = {'register': b'bask dawn alan', 'lookup': b'', 'connect': b'1.2.3.4:5 6.7.8.9:10'}.get(command)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestControl(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeMatchServer)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.game = headless_game(mode=None)
+        self.net_engine = NetEngine(self.game)
+        self.net_engine.match_url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.net_engine.stun_servers = []
+        self.net_engine.my_addr = ('1.2.3.4', 5)
+
+    def tearDown(self):
+        self.net_engine.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def step_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            control.step(self.net_engine.loop)
+            time.sleep(0.001)
+        self.assertTrue(condition())
+
+    def test_connect(self):
+        self.net_engine.connect('other guy')
+        self.net_engine.spawn(self.net_engine.setup_addr_name())
+        self.step_until(lambda: self.net_engine.peers)
+        self.assertEqual(self.net_engine.address, 'bask dawn alan')
+        self.assertEqual(self.net_engine.peers, [('6.7.8.9', 10)])
+        self.assertEqual(self.game.player, 1)
+
+    def test_stop_cancels_promptly(self):
+        self.net_engine.spawn(self.net_engine.setup_addr_name())
+        self.step_until(lambda: self.net_engine.address)
+        self.net_engine.spawn(self.net_engine.wait_for_connections())
+        control.step(self.net_engine.loop)
+        start = time.time()
+        self.net_engine.stop()
+        self.assertLess(time.time() - start, 0.5)
+        self.assertFalse(self.net_engine.tasks)
+
+
+class TestMatchServer(unittest.TestCase):
+    def setUp(self):
+        self.server = MatchServer(('127.0.0.1', 0))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.net_engines = []
+        for port in [5, 6]:
+            game = headless_game(mode=None)
+            net_engine = NetEngine(game)
+            net_engine.match_url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+            net_engine.stun_servers = []
+            net_engine.my_addr = ('1.2.3.4', port)
+            self.net_engines.append(net_engine)
+
+    def tearDown(self):
+        for net_engine in self.net_engines:
+            net_engine.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pairing(self):
+        host, guest = self.net_engines
+        for net_engine in self.net_engines:
+            net_engine.spawn(net_engine.setup_addr_name())
+        while not (host.address_ready.done() and guest.address_ready.done()):
+            for net_engine in self.net_engines:
+                control.step(net_engine.loop)
+            time.sleep(0.001)
+        host.spawn(host.wait_for_connections())
+        # Let the host's lookup reach the server before connecting
+        time.sleep(0.1)
+        control.step(host.loop)
+        start = time.time()
+        guest.connect(host.address)
+        while not (host.peers and guest.peers) and time.time() - start < 5:
+            for net_engine in self.net_engines:
+                control.step(net_engine.loop)
+            time.sleep(0.001)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(host.peers, [('1.2.3.4', 6)])
+        self.assertEqual(guest.peers, [('1.2.3.4', 5)])
+        # The requests reused the connection to the server
+        for net_engine in self.net_engines:
+            self.assertEqual(net_engine.http.connections_opened, 1)
+
+    def test_unknown_game(self):
+        guest = self.net_engines[1]
+        guest.spawn(guest.setup_addr_name())
+        task = guest.spawn(guest.connect_to('no such game'))
+        while not task.done():
+            control.step(guest.loop)
+            time.sleep(0.001)
+        self.assertFalse(guest.peers)
+
+
+class FakeStunServer(object):
+    """Answers STUN binding requests after a delay, optionally reporting the port shifted as symmetric NATs do"""
+
+    def __init__(self, delay=0, port_shift=0):
+        self.delay = delay
+        self.port_shift = port_shift
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.address = self.socket.getsockname()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
         while True:
-            self.port = random.randint(1024, 65535)
             try:
-                self.net_engine.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self.net_engine.socket.bind(('127.0.0.1', self.port))
-            except socket.error:
-                print('retrying establishing server')
-                continue
-            break
+                data, (host, port) = self.socket.recvfrom(0x1000)
+            except OSError:
+                return
+            _, _, cookie, transaction_id = stun_probe.HEADER.unpack_from(data)
+            port += self.port_shift
+            value = stun_probe.ADDRESS.pack(
+                0, stun_probe.FAMILY_IPV4, port ^ (cookie >> 16),
+                bytes(a ^ b for a, b in zip(socket.inet_aton(host), stun_probe.MAGIC_COOKIE.to_bytes(4, 'big'))))
+            attribute = stun_probe.ATTRIBUTE.pack(stun_probe.XOR_MAPPED_ADDRESS, len(value)) + value
+            response = stun_probe.HEADER.pack(
+                stun_probe.BINDING_SUCCESS, len(attribute), cookie, transaction_id) + attribute
+            time.sleep(self.delay)
+            try:
+                self.socket.sendto(response, (host, port - self.port_shift))
+            except OSError:
+                return
+
+    def close(self):
+        self.socket.close()
+
+
+class TestStun(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+        self.net_engines = []
+        self.cache = stun_probe.MappingCache()
+
+    def tearDown(self):
+        for net_engine in self.net_engines:
+            net_engine.stop()
+        for server in self.servers:
+            server.close()
+
+    def server(self, **kwargs):
+        server = FakeStunServer(**kwargs)
+        self.servers.append(server)
+        return server.address
+
+    def setup_socket(self, servers):
+        net_engine = NetEngine(GameModel())
+        self.net_engines.append(net_engine)
+        net_engine.stun_servers = servers
+        net_engine.stun_cache = self.cache
+        task = net_engine.spawn(net_engine.setup_socket())
+        deadline = time.time() + 5
+        while not task.done() and time.time() < deadline:
+            control.step(net_engine.loop)
+            time.sleep(0.001)
+        self.assertTrue(task.done())
+        return net_engine
+
+    def test_first_answer_wins(self):
+        unreachable = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        unreachable.bind(('127.0.0.1', 0))
+        unreachable_address = unreachable.getsockname()
+        unreachable.close()
+        start = time.time()
+        net_engine = self.setup_socket([
+            unreachable_address, self.server(delay=3), self.server(), self.server(delay=0.05)])
+        self.assertLess(time.time() - start, 1)
+        mapping = net_engine.mapping
+        self.assertEqual(net_engine.my_addr, ('127.0.0.1', net_engine.transport.address[1]))
+        self.assertIn(mapping.server, [server.address for server in self.servers[1:]])
+        self.assertLess(mapping.elapsed, 1)
+        self.assertTrue(mapping.endpoint_independent)
+        self.assertFalse(mapping.cached)
+        # The socket is back to blocking for the game's use
+        self.assertTrue(net_engine.transport.socket.getblocking())
+
+    def test_cached_mapping(self):
+        first = self.setup_socket([self.server(), self.server()])
+        port = first.transport.address[1]
+        first.stop()
+        second = self.setup_socket([])
+        self.assertTrue(second.mapping.cached)
+        self.assertEqual(second.transport.address[1], port)
+        self.assertEqual(second.my_addr, first.my_addr)
+
+    def test_symmetric_nat_not_cached(self):
+        net_engine = self.setup_socket([self.server(), self.server(port_shift=1)])
+        self.assertFalse(net_engine.mapping.endpoint_independent)
+        self.assertIsNone(self.cache.get())
+
+
+class TestProfiler(unittest.TestCase):
+    def test_rolling_histogram(self):
+        histogram = profiler.Histogram(window=100)
+        for ms in range(200):
+            histogram.add((ms + 0.5) / 1000)
+        # Only the last 100 samples are kept
+        self.assertEqual(len(histogram.samples), 100)
+        self.assertEqual(histogram.total_count, 200)
+        self.assertAlmostEqual(histogram.percentile(0.5), 0.1505)
+        summary = histogram.summary()
+        self.assertAlmostEqual(summary['max_ms'], 199.5)
+        self.assertEqual(sum(summary['buckets'].values()), 100)
+        self.assertEqual(summary['buckets']['<133ms'], 33)
+        self.assertEqual(summary['buckets']['more'], 67)
+
+    def test_iteration_phases(self):
+        frames = profiler.frames
+        frames.reset()
+        inst = GameInstance()
+        start = time.perf_counter()
+        for _ in range(10):
+            inst.net_engine.iteration()
+        frames.end_frame(start)
+        self.assertEqual(frames.frames, 1)
+        for phase in ['control', 'communicate', 'act']:
+            self.assertEqual(frames.phases[phase].total_count, 10)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'profile.json')
+            frames.dump(path)
+            with open(path) as dump_file:
+                dump = json.load(dump_file)
+        self.assertEqual(len(dump['samples_ms']['act']), 10)
+        self.assertEqual(dump['phases']['frame']['count'], 1)
+        self.assertIn('communicate', frames.overlay_text())
+        inst.net_engine.stop()
+
+
+class TestBot(unittest.TestCase):
+    def setUp(self):
+        self.game = headless_game(mode='tutorial')
+        self.game.tutorial_messages = []
+
+    def hang_queen(self):
+        """Put White's queen where Black's pawns and knight can take it, and freeze the pawns"""
+        board = self.game.board
+        queen = board[(3, 0)]
+        del board[(3, 0)]
+        queen.pos = (2, 5)
+        board[queen.pos] = queen
+        self.game.version += 1
+        for pos in [(1, 6), (3, 6)]:
+            board[pos].freeze(1000)
+
+    def decide(self, black_bot, max_seconds=5):
+        deadline = time.time() + max_seconds
+        while not self.game.cur_actions and time.time() < deadline:
+            start = time.perf_counter()
+            black_bot.tick()
+            # The budget is checked between nodes, which take well under a millisecond
+            self.assertLess(time.perf_counter() - start, black_bot.budget + 0.01)
+            self.game.counter += 1
+        return self.game.cur_actions
+
+    def test_sight(self):
+        for player in range(2):
+            visible = self.game.sight_map.visible(player)
+            belief = bot.new_belief()
+            belief.restore(bot.sighted_position(self.game, player))
+            for pos, piece in self.game.board.items():
+                seen = piece.side() == player or pos in visible
+                self.assertEqual(pos in belief.board, seen)
+            self.assertLess(len(belief.board), len(self.game.board))
+
+    def test_takes_hanging_piece(self):
+        self.hang_queen()
+        black_bot = bot.Bot(self.game, player=1, seed=0)
+        # The pawns are frozen, so the knight takes the queen
+        self.assertEqual(self.decide(black_bot), [('move', ((1, 7), (2, 5)))])
+        stats = black_bot.stats()
+        self.assertEqual(stats['decisions'], 1)
+        self.assertGreater(stats['nodes_per_second'], 0)
+        self.assertEqual(stats['decision_latency']['count'], 1)
+
+    def test_worker(self):
+        self.hang_queen()
+        black_bot = bot.Bot(self.game, player=1, worker=True)
+        try:
+            self.assertEqual(self.decide(black_bot), [('move', ((1, 7), (2, 5)))])
+        finally:
+            black_bot.close()
+        self.assertIsNone(black_bot.process)
+
+    def test_practice_game(self):
+        # The bot's moves go through the network engine like the player's
+        net_engine = NetEngine(self.game)
+        black_bot = bot.Bot(self.game, player=1, seed=0)
+        for _ in range(600):
+            net_engine.iteration()
+            black_bot.tick()
+        moved = [piece for piece in self.game.board.values() if piece.last_move_time is not None]
+        self.assertGreater(black_bot.moves, 3)
+        self.assertGreater(len(moved), 3)
+        self.assertTrue(all(piece.player == 1 for piece in moved))
+
+
+class TestSelfPlay(unittest.TestCase):
+    def test_reproducible(self):
+        def play(seed):
+            result = selfplay.play_game(seed, max_ticks=600)
+            del result['search_seconds']
+            return result
+        self.assertEqual(play(0), play(0))
+        self.assertNotEqual(play(0), play(1))
+
+    def test_timings(self):
+        defaults = selfplay.current_timings()
+        result = selfplay.play_game(0, {'freeze_time': 10, 'player_freeze_time': 5}, max_ticks=600)
+        self.assertEqual(selfplay.current_timings(), defaults)
+        self.assertGreater(sum(result['moves']), 20)
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'results.json')
+            argv = ['--games', '4', '-j', '2', '--max-ticks', '300', '--freeze-time', '20', '--output', path]
+            self.assertEqual(selfplay.main(argv), 0)
+            with open(path) as results_file:
+                results = json.load(results_file)
+        self.assertEqual(results['timings']['freeze_time'], 20)
+        self.assertEqual([game['seed'] for game in results['games']], [0, 1, 2, 3])
+        summary = results['summary']
+        self.assertEqual(summary['games'], 4)
+        self.assertAlmostEqual(sum(summary['win_rate'].values()), 1)
+
+
+class TestHeadless(unittest.TestCase):
+    def test_core_imports_without_kivy(self):
+        code = 'import sys, bot, game_model, net_engine; assert "kivy" not in sys.modules'
+        subprocess.check_call([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+
 
 class TestSync(unittest.TestCase):
     def test_sync(self):
@@ -52,6 +924,141 @@ class TestSync(unittest.TestCase):
                 inst.game.add_action('move', src, dst)
             else:
                 inst.game.add_action('reset')
+        for inst in instances:
+            self.assertIsNone(inst.net_engine.desync_tick)
+
+    def test_stats(self):
+        instances = [GameInstance() for _ in range(2)]
+        for i in range(2):
+            instances[i].net_engine.peers = [('127.0.0.1', instances[1-i].port)]
+        a, b = instances
+        while min(inst.game.counter for inst in instances) < 100:
+            for inst in instances:
+                inst.net_engine.iteration()
+            time.sleep(0.001)
+        # b goes silent for a while, so a stalls until it's back
+        for _ in range(20):
+            a.net_engine.iteration()
+            time.sleep(0.001)
+        self.assertTrue(a.net_engine.stalled)
+        self.assertGreater(a.net_engine.stats()['stalled_seconds'], 0)
+        while min(inst.game.counter for inst in instances) < 200:
+            for inst in instances:
+                inst.net_engine.iteration()
+            time.sleep(0.001)
+        stats = a.net_engine.stats()
+        self.assertGreaterEqual(stats['stalls'], 1)
+        self.assertGreaterEqual(stats['stall_frames'], 10)
+        self.assertGreaterEqual(stats['stall_lengths']['count'], 1)
+        peer = stats['peers']['127.0.0.1:%d' % b.port]
+        self.assertIsNotNone(peer['rtt_ms'])
+        self.assertGreater(peer['packets_sent'], 100)
+        self.assertGreater(peer['bytes_received'], 0)
+        self.assertGreater(peer['packets_sent_per_second'], 0)
+        instance = stats['instances']['%016x' % b.net_engine.instance_id]
+        self.assertGreaterEqual(instance['received_upto'], 200)
+        self.assertGreaterEqual(instance['late_ticks'], 1)
+        self.assertIn('rtt', a.net_engine.stats_line())
+
+    def test_desync(self):
+        instances = [GameInstance() for _ in range(2)]
+        for i in range(2):
+            instances[i].net_engine.peers = [('127.0.0.1', instances[1-i].port)]
+        a, b = instances
+        corrupt_at = 200
+        corrupted = False
+        while min(inst.game.counter for inst in instances) < corrupt_at + 100:
+            if a.game.counter == corrupt_at and not corrupted:
+                corrupted = True
+                # A difference between the peers that isn't from their actions
+                piece = a.game.board[0, 0]
+                piece.freeze(piece.freeze_until + 1)
+            for inst in instances:
+                inst.net_engine.iteration()
+            time.sleep(0.001)
+        for inst in instances:
+            self.assertEqual(inst.net_engine.desync_tick, corrupt_at)
+            self.assertEqual(inst.net_engine.synced_upto, corrupt_at - 1)
+
+
+class TestSimSync(unittest.TestCase):
+    adverse = {'latency': 0.05, 'jitter': 0.05, 'loss': 0.1, 'duplicate': 0.05, 'reorder': 0.1}
+
+    def test_deterministic(self):
+        results = [sync_fuzz.run_seed(5, **self.adverse) for _ in range(2)]
+        for result in results:
+            del result['seconds']
+        self.assertEqual(results[0], results[1])
+        self.assertGreater(results[0]['network']['lost'], 0)
+
+    def test_adverse_conditions(self):
+        run = functools.partial(sync_fuzz.run_seed, ticks=900, **self.adverse)
+        with multiprocessing.Pool(4) as pool:
+            results = pool.map(run, range(8))
+        for result in results:
+            self.assertTrue(result['completed'], result)
+            self.assertTrue(result['synced'], result)
+            self.assertNotIn('truncated', result['network'])
+        # The input delay grew to cover the bad network
+        self.assertTrue(any(result['latency'] > NetEngine.initial_latency for result in results))
+
+    def test_relay(self):
+        result = sync_fuzz.run_seed(0, players=4, loss=0.05, reorder=0.05)
+        self.assertTrue(result['completed'], result)
+        self.assertTrue(result['synced'], result)
+        self.assertNotIn('truncated', result['network'])
+
+
+class TestRelay(unittest.TestCase):
+    def test_four_players(self):
+        rnd = random.Random(0)
+        relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        relay_socket.bind(('127.0.0.1', 0))
+        relay = Relay(UdpTransport(relay_socket), 4)
+        instances = [GameInstance() for _ in range(4)]
+        for inst in instances:
+            inst.net_engine.join_relay(relay_socket.getsockname())
+        while min(inst.game.counter for inst in instances) < 300:
+            relay.step()
+            for inst in instances:
+                if rnd.random() < 0.2 and inst.game.num_players == 4 and len(inst.game.cur_actions) < 3:
+                    src, piece = rnd.choice([
+                        (pos, piece) for pos, piece in inst.game.board.items() if piece.player == inst.game.player])
+                    opts = list(piece.moves())
+                    if opts:
+                        inst.game.add_action('move', src, rnd.choice(opts))
+                inst.net_engine.iteration()
+            time.sleep(0.001)
+        relay.close()
+        self.assertEqual(sorted(inst.game.player for inst in instances), [0, 1, 2, 3])
+        for inst in instances:
+            self.assertEqual(inst.game.num_players, 4)
+            self.assertIsNone(inst.net_engine.desync_tick)
+            # The state hashes went through the relay
+            self.assertGreaterEqual(inst.net_engine.synced_upto, 240)
+        tick = min(inst.net_engine.hashed_upto for inst in instances)
+        self.assertEqual(len({inst.net_engine.state_hashes[tick] for inst in instances}), 1)
+        self.assertTrue(any(piece.last_move_time for piece in instances[0].game.board.values()))
+        # Only the relay's traffic
+        self.assertEqual(len(instances[0].net_engine.links), 1)
+
+    def test_waiting_for_players(self):
+        relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        relay_socket.bind(('127.0.0.1', 0))
+        relay = Relay(UdpTransport(relay_socket), 3)
+        inst = GameInstance()
+        inst.net_engine.join_relay(relay_socket.getsockname())
+        for _ in range(50):
+            relay.step()
+            inst.net_engine.iteration()
+            time.sleep(0.001)
+        relay.close()
+        self.assertIsNone(inst.net_engine.members)
+        # Waiting for the other players to join isn't counted as stalls
+        self.assertEqual(inst.net_engine.stalls, 0)
+        self.assertEqual(inst.net_engine.stall_frames, 0)
+        inst.net_engine.stop()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,121 @@
+"""
+Transports for the network engine's packets: UDP, or a simulated network for tests.
+
+A transport sends datagrams to (host, port) addresses and returns the received ones without blocking.
+"""
+
+import collections
+import heapq
+import random
+import select
+
+# The largest datagram we send or receive: a UDP payload that fits in the usual MTU without fragmenting.
+# Larger datagrams arrive truncated.
+MAX_DATAGRAM = 1200
+
+
+def poll(sock):
+    return select.select([sock], [], [], 0)[0] != []
+
+
+class UdpTransport(object):
+    def __init__(self, sock):
+        self.socket = sock
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def send(self, data, address):
+        self.socket.sendto(data, 0, address)
+
+    def receive(self):
+        """The next received (data, address), or None if there isn't one"""
+        if not poll(self.socket):
+            return None
+        return self.socket.recvfrom(MAX_DATAGRAM)
+
+    def close(self):
+        self.socket.close()
+
+
+class SimNetwork(object):
+    """
+    An in-process network with a virtual clock, for fast and deterministic tests under adverse conditions.
+    Packets arrive after the latency plus a random jitter, and may be lost, duplicated,
+    or held back by up to another latency so that they arrive after later ones.
+    Datagrams longer than MAX_DATAGRAM arrive truncated, as from a UdpTransport.
+    The same seed gives the same deliveries.
+    """
+
+    def __init__(self, seed=0, latency=0.03, jitter=0.01, loss=0, duplicate=0, reorder=0):
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.now = 0.0
+        # Heap of (delivery time, sequence number, data, source address, destination address)
+        self.in_flight = []
+        self.sequence = 0
+        self.transports = {}
+        self.counts = collections.Counter()
+
+    def clock(self):
+        return self.now
+
+    def transport(self):
+        """A transport at a new address"""
+        address = ('10.0.%d.%d' % divmod(len(self.transports) + 1, 256), 5000)
+        transport = self.transports[address] = SimTransport(self, address)
+        return transport
+
+    def send(self, data, source, destination):
+        self.counts['sent'] += 1
+        if self.random.random() < self.loss:
+            self.counts['lost'] += 1
+            return
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.counts['duplicated'] += 1
+            copies = 2
+        for _ in range(copies):
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.reorder:
+                self.counts['reordered'] += 1
+                delay += self.random.uniform(0, self.latency)
+            self.sequence += 1
+            heapq.heappush(self.in_flight, (self.now + delay, self.sequence, bytes(data), source, destination))
+
+    def advance(self, seconds):
+        """Move the clock forward, delivering the packets which arrived by then"""
+        self.now += seconds
+        while self.in_flight and self.in_flight[0][0] <= self.now:
+            _, _, data, source, destination = heapq.heappop(self.in_flight)
+            transport = self.transports.get(destination)
+            if transport is None:
+                self.counts['unreachable'] += 1
+                continue
+            self.counts['delivered'] += 1
+            if len(data) > MAX_DATAGRAM:
+                # Like UdpTransport's receive buffer
+                self.counts['truncated'] += 1
+                data = data[:MAX_DATAGRAM]
+            transport.inbox.append((data, source))
+
+
+class SimTransport(object):
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.inbox = collections.deque()
+
+    def send(self, data, address):
+        self.network.send(data, self.address, address)
+
+    def receive(self):
+        return self.inbox.popleft() if self.inbox else None
+
+    def close(self):
+        self.network.transports.pop(self.address, None)
@@ -0,0 +1,246 @@
+"""
+A NumPy backend for the sight map: what each side sees, where each player's pieces can move, and the squares
+each side attacks, computed for the whole board at once rather than piece by piece.
+
+Along each of the eight line directions a square can only be reached by the nearest piece behind it,
+so the moves of the sliding pieces, kings and pawns come from a table of the nearest occupied square
+in each direction, found for all the squares at once with a running maximum along the board's lines.
+A king sees the pieces threatening it, which are the moves ending on its square.
+
+Its results are the same as SightMap's (bench.py compares their speed), and it is used instead when
+CHESS2_VECTOR_SIGHT is set. It needs NumPy, which the game doesn't otherwise depend on.
+"""
+
+import numpy
+
+import chess
+
+KING, PAWN, KNIGHT, BISHOP, ROOK, QUEEN = [piece_type.type_code for piece_type in chess.piece_types]
+COLORS = numpy.array([piece_type.sight_color for piece_type in chess.piece_types], dtype=float)
+
+DIRECTIONS = chess.Queen.directions
+DX = numpy.array([dx for dx, _ in DIRECTIONS])[:, None]
+DY = numpy.array([dy for _, dy in DIRECTIONS])[:, None]
+DIAGONAL = (DX != 0) & (DY != 0)
+# Which piece types slide along each direction
+SLIDES = numpy.array([
+    [piece_type.slides and direction in piece_type.directions for piece_type in chess.piece_types]
+    for direction in DIRECTIONS])
+
+
+class _Tables(object):
+    """Index tables of a board size"""
+
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.squares = numpy.arange(width * height)
+        self.x = self.squares % width
+        self.y = self.squares // width
+        # Going along a direction, each square's previous square in its line
+        self.step = (DX + DY * width)
+        # The squares of each direction's lines in order, padded with an index past the board's squares.
+        # The rows are much longer than the other lines on wide boards, so they are a separate group.
+        self.line_groups = []
+        rows = [i for i, (_, dy) in enumerate(DIRECTIONS) if dy == 0]
+        for group in [rows, [i for i in range(len(DIRECTIONS)) if i not in rows]]:
+            lines = [self.direction_lines(*DIRECTIONS[i]) for i in group]
+            num_lines = max(len(direction_lines) for direction_lines in lines)
+            length = max(len(line) for direction_lines in lines for line in direction_lines)
+            padded = numpy.full((len(group), num_lines, length), width * height)
+            for i, direction_lines in enumerate(lines):
+                for j, line in enumerate(direction_lines):
+                    padded[i, j, :len(line)] = line
+            self.line_groups.append((numpy.array(group)[:, None, None], padded))
+        # Each square's source square for each knight jump (-1 where it's off the board)
+        self.knight_sources = numpy.stack([
+            numpy.where(
+                (self.x - dx >= 0) & (self.x - dx < width) & (self.y - dy >= 0) & (self.y - dy < height),
+                self.squares - dx - dy * width, -1)
+            for dx, dy in chess.Knight.directions])
+
+    def direction_lines(self, dx, dy):
+        """The lines of squares going in a direction, each from the edge of the board"""
+        width, height = self.width, self.height
+        lines = []
+        for y in range(height):
+            for x in range(width):
+                if 0 <= x - dx < width and 0 <= y - dy < height:
+                    continue
+                line = []
+                line_x, line_y = x, y
+                while 0 <= line_x < width and 0 <= line_y < height:
+                    line.append(line_x + line_y * width)
+                    line_x += dx
+                    line_y += dy
+                lines.append(line)
+        return lines
+
+    def nearest(self, occupied):
+        """For each direction and square, the nearest occupied square behind it along the direction (or -1)"""
+        # The padding squares are empty
+        occupied = numpy.append(occupied, False)
+        result = numpy.empty((len(DIRECTIONS), self.width * self.height + 1), dtype=numpy.int64)
+        for directions, lines in self.line_groups:
+            previous = numpy.full(lines.shape, -1)
+            previous[..., 1:] = numpy.where(occupied[lines[..., :-1]], numpy.arange(lines.shape[-1] - 1), -1)
+            position = numpy.maximum.accumulate(previous, axis=-1)
+            result[directions, lines] = numpy.where(
+                position >= 0, numpy.take_along_axis(lines, position.clip(0), axis=-1), -1)
+        return result[:, :-1]
+
+
+_tables = {}
+
+
+class VectorSight(object):
+    """The sight, moves and coverage of all the pieces, for one state of the game"""
+
+    def __init__(self, game):
+        board = self.board = game.board
+        tables = _tables.get(board.size)
+        if tables is None:
+            tables = _tables[board.size] = _Tables(board.width, board.height)
+        squares = tables.squares
+        side_at = numpy.frombuffer(bytes(board.side_at), dtype=numpy.uint8).astype(numpy.int64)
+        occupied = side_at != 0
+        self.side_of = side_at - 1
+        self.type_of = numpy.full(len(squares), -1)
+        self.player_of = numpy.full(len(squares), -1)
+        self.active = numpy.zeros(len(squares), dtype=bool)
+        castles_owner = []
+        castles_dst = []
+        for sq, piece in enumerate(board.squares):
+            if piece is None:
+                continue
+            self.type_of[sq] = piece.type_code
+            self.player_of[sq] = piece.player
+            self.active[sq] = game.counter >= max(piece.freeze_until, game.player_freeze.get(piece.player, 0))
+            if piece.type_code == KING and piece.last_move_time is None:
+                x, y = board.positions[sq]
+                for direction in [-1, 1]:
+                    if piece.castling(x, y, direction) and board.side_at[sq + 2 * direction] != piece.side() + 1:
+                        castles_owner.append(sq)
+                        castles_dst.append(sq + 2 * direction)
+
+        # Moves along the lines, by the nearest piece behind each square
+        nearest = tables.nearest(occupied)
+        found = nearest >= 0
+        source = numpy.where(found, nearest, 0)
+        source_type = numpy.where(found, self.type_of[source], -1)
+        source_side = self.side_of[source]
+        not_own = side_at[None] != source_side + 1
+        adjacent = found & (nearest == squares - tables.step)
+        pawn_forward = numpy.where(source_side == 1, -1, 1)
+        pawns = source_type == PAWN
+        pawn_diagonals = adjacent & pawns & DIAGONAL & (DY == pawn_forward)
+        pawn_advances = pawns & (DX == 0) & (DY == pawn_forward) & ~occupied & (adjacent | (
+            (nearest == squares - 2 * tables.step) & (tables.y[source] == numpy.where(source_side == 1, 6, 1))))
+        slides = found & SLIDES[numpy.arange(len(DIRECTIONS))[:, None], source_type.clip(0)]
+        steps = adjacent & ((source_type == KING) | (pawn_diagonals & occupied))
+        line_moves = ((slides | steps) & not_own) | pawn_advances
+        # Knight jumps
+        knight_found = tables.knight_sources >= 0
+        knight_source = numpy.where(knight_found, tables.knight_sources, 0)
+        knight_moves = knight_found & (self.type_of[knight_source] == KNIGHT) & (
+            side_at[None] != self.side_of[knight_source] + 1)
+
+        line_dirs, line_dst = numpy.nonzero(line_moves)
+        knight_dirs, knight_dst = numpy.nonzero(knight_moves)
+        # Each move as the square of the piece moving and its destination
+        self.move_owner = numpy.concatenate([
+            nearest[line_dirs, line_dst], tables.knight_sources[knight_dirs, knight_dst],
+            numpy.array(castles_owner, dtype=numpy.int64)])
+        self.move_dst = numpy.concatenate([line_dst, knight_dst, numpy.array(castles_dst, dtype=numpy.int64)])
+        # A pawn sees diagonally forward, and a king sees the pieces that can capture it
+        diagonal_dirs, diagonal_dst = numpy.nonzero(pawn_diagonals)
+        threats = self.type_of[self.move_dst] == KING
+        threat_owner = self.move_dst[threats]
+        threat_dst = self.move_owner[threats]
+        self.sight_owner = numpy.concatenate([self.move_owner, nearest[diagonal_dirs, diagonal_dst], threat_owner])
+        self.sight_dst = numpy.concatenate([self.move_dst, diagonal_dst, threat_dst])
+        # The coverage counts squares as many times as they are seen,
+        # so again for a pawn's captures and for the adjacent pieces threatening a king
+        captures = pawn_diagonals[diagonal_dirs, diagonal_dst] & occupied[diagonal_dst] & not_own[
+            diagonal_dirs, diagonal_dst]
+        near_king = (abs(tables.x[threat_owner] - tables.x[threat_dst]) <= 1) & (
+            abs(tables.y[threat_owner] - tables.y[threat_dst]) <= 1)
+        self.cover_owner = numpy.concatenate([
+            self.move_owner, nearest[diagonal_dirs, diagonal_dst][captures], threat_owner[near_king]])
+        self.cover_dst = numpy.concatenate([self.move_dst, diagonal_dst[captures], threat_dst[near_king]])
+
+    def seen(self, side):
+        """Bool array of the squares a side sees (its pieces' squares and their sight), by square index"""
+        seen = self.side_of == side
+        seen[self.sight_dst[self.side_of[self.sight_owner] == side]] = True
+        return seen
+
+    def attacks(self, side):
+        """Array of how many of a side's pieces (frozen or not) can move to each square, by square index"""
+        dst = self.move_dst[self.side_of[self.move_owner] == side]
+        return numpy.bincount(dst, minlength=len(self.side_of))
+
+    def visible(self, player):
+        """Positions visible to the player (to everyone when player is None)"""
+        seen = self.seen(0) | self.seen(1) if player is None else self.seen(player % 2)
+        positions = self.board.positions
+        return {positions[sq] for sq in numpy.flatnonzero(seen)}
+
+    def coverage(self, player):
+        """Positions of the player's pieces and where they can move to, with their summed sight colors"""
+        selected = (self.player_of[self.cover_owner] == player) & self.active[self.cover_owner]
+        dst = self.cover_dst[selected]
+        colors = COLORS[self.type_of[self.cover_owner[selected]]]
+        size = len(self.side_of)
+        sums = numpy.stack([numpy.bincount(dst, colors[:, i], minlength=size) for i in range(3)], axis=1)
+        positions = self.board.positions
+        result = {positions[sq]: sums[sq].tolist() for sq in numpy.unique(dst)}
+        for sq in numpy.flatnonzero(self.player_of == player):
+            result[positions[sq]] = list(self.board.squares[sq].sight_color)
+        return result
+
+
+class VectorSightMap(object):
+    """SightMap's interface over VectorSight, recomputed for the whole board when the game changed"""
+
+    def __init__(self, game):
+        self.game = game
+        self.version = 0
+        self.key = None
+        self.counter = None
+        self.next_thaw = None
+        self.sight = None
+        self._cache = {}
+
+    def reset(self):
+        self.key = None
+        self.update()
+
+    def update(self):
+        game = self.game
+        board = game.board
+        key = (board, game.version, board.hash, tuple(sorted(game.player_freeze.items())))
+        if key == self.key and game.counter >= self.counter and (
+                self.next_thaw is None or game.counter < self.next_thaw):
+            self.counter = game.counter
+            return
+        self.key = key
+        self.counter = game.counter
+        self.sight = VectorSight(game)
+        thaws = [max(piece.freeze_until, game.player_freeze.get(piece.player, 0)) for piece in board.pieces()]
+        self.next_thaw = min((until for until in thaws if until > game.counter), default=None)
+        self._cache = {}
+        self.version += 1
+
+    def visible(self, player):
+        self.update()
+        key = ('visible', player)
+        if key not in self._cache:
+            self._cache[key] = self.sight.visible(player)
+        return self._cache[key]
+
+    def coverage(self, player):
+        self.update()
+        key = ('coverage', player)
+        if key not in self._cache:
+            self._cache[key] = self.sight.coverage(player)
+        return self._cache[key]
@@ -0,0 +1,150 @@
+"""
+Replay recorded games headless, as fast as possible.
+
+Usage:
+    python verify.py [-j JOBS] [--hashes] [--json] REPLAY_FILE ...
+    python verify.py --diff REPLAY_FILE REPLAY_FILE
+
+For each replay file, reports the replay speed in ticks per second and a hash of the final state.
+With --hashes also prints the hash of the state before each tick,
+and --diff finds the first tick at which the states of two recordings of a game differ.
+Useful for checking that rules changes don't change the outcome of a corpus of recorded games.
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+
+from game_model import headless_game
+from replay_file import ReplayReader
+
+
+def state_hash(game):
+    return '%016x' % game.state_hash()
+
+
+def replay_states(reader, game):
+    """
+    Replay the file's ticks, yielding each tick before executing it.
+    Actions are executed as a spectator's, so that recordings by different peers have the same states.
+    """
+    checkpoint = reader.checkpoint(reader.first_tick)
+    if checkpoint is None:
+        game.init()
+        game.counter = reader.first_tick
+    else:
+        game.restore(checkpoint[1])
+    game.player = None
+    for tick, acts in reader.ticks():
+        yield tick
+        if acts:
+            game.execute(sorted(acts.items()))
+        game.counter += 1
+
+
+def verify(path, hashes=False):
+    """Replay a file, returning a summary of the result"""
+    game = headless_game(mode=None)
+    with ReplayReader(path) as reader:
+        if not len(reader):
+            return {'path': path, 'ticks': 0}
+        tick_hashes = [] if hashes else None
+        start = time.perf_counter()
+        for tick in replay_states(reader, game):
+            if hashes:
+                tick_hashes.append((tick, state_hash(game)))
+        duration = time.perf_counter() - start
+    result = {
+        'path': path,
+        'ticks': len(reader),
+        'seconds': duration,
+        'ticks_per_second': len(reader) / duration if duration else None,
+        'final_tick': game.counter,
+        'final_hash': state_hash(game),
+        'pieces': len(game.board),
+        }
+    if hashes:
+        result['hashes'] = tick_hashes
+    return result
+
+
+def first_divergence(path_a, path_b):
+    """The first tick at which the two recordings' states differ, or None"""
+    with ReplayReader(path_a) as reader_a, ReplayReader(path_b) as reader_b:
+        game_a = headless_game(mode=None)
+        game_b = headless_game(mode=None)
+        states_a = replay_states(reader_a, game_a)
+        states_b = replay_states(reader_b, game_b)
+        tick_a = next(states_a, None)
+        tick_b = next(states_b, None)
+        # Start from the tick both recordings have
+        while tick_a is not None and tick_b is not None and tick_a != tick_b:
+            if tick_a < tick_b:
+                tick_a = next(states_a, None)
+            else:
+                tick_b = next(states_b, None)
+        while tick_a is not None and tick_b is not None:
+            if state_hash(game_a) != state_hash(game_b):
+                return tick_a
+            tick_a = next(states_a, None)
+            tick_b = next(states_b, None)
+        if tick_a is None and tick_b is None and state_hash(game_a) != state_hash(game_b):
+            return game_a.counter
+    return None
+
+
+def _verify_with_hashes(path):
+    return verify(path, hashes=True)
+
+
+def report(results, args):
+    total_ticks = 0
+    start = time.perf_counter()
+    for result in results:
+        total_ticks += result['ticks']
+        if args.json:
+            print(json.dumps(result))
+            continue
+        if not result['ticks']:
+            print('%s: empty' % result['path'])
+            continue
+        print('%s: %d ticks in %.2fs (%.0f ticks/s), final state at tick %d: %s, %d pieces' % (
+            result['path'], result['ticks'], result['seconds'], result['ticks_per_second'] or 0,
+            result['final_tick'], result['final_hash'], result['pieces']))
+        for tick, tick_hash in result.get('hashes', ()):
+            print('%d %s' % (tick, tick_hash))
+    if not args.json and len(args.files) > 1:
+        duration = time.perf_counter() - start
+        print('total: %d ticks in %.2fs (%.0f ticks/s)' % (total_ticks, duration, total_ticks / duration))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay recorded games headless.')
+    parser.add_argument('files', nargs='+', metavar='REPLAY_FILE')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes to verify files in')
+    parser.add_argument('--hashes', action='store_true', help="print the state's hash before each tick")
+    parser.add_argument('--json', action='store_true', help='print the results as JSON lines')
+    parser.add_argument('--diff', action='store_true', help='find where the states of two recordings diverge')
+    args = parser.parse_args(argv)
+
+    if args.diff:
+        if len(args.files) != 2:
+            parser.error('--diff takes two replay files')
+        tick = first_divergence(*args.files)
+        print('no divergence' if tick is None else 'first divergence at tick %d' % tick)
+        return 0 if tick is None else 1
+
+    func = _verify_with_hashes if args.hashes else verify
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs) as pool:
+            results = pool.imap(func, args.files)
+            report(results, args)
+    else:
+        report(map(func, args.files), args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,409 @@
+"""
+Binary wire format of the network engine's packets.
+
+A packet is a fixed header (magic, format version, sender id) followed by sections.
+Each section starts with its type and length, so that a decoder can skip sections it doesn't know.
+
+Numbers are variable length (LEB128) and signed ones are zigzag encoded.
+Ticks are encoded as deltas from the previous tick and squares as deltas from the previous square
+of the same action, so the common case of a move takes a handful of bytes.
+Action types are encoded as codes from a registry, and actions that don't fit the compact encoding
+(unregistered parameter types) fall back to marshal.
+"""
+
+import marshal
+import struct
+
+VERSION = 1
+MAGIC = b'C2'
+
+HEADER = struct.Struct('!2sBQ')
+SECTION = struct.Struct('!BH')
+ID = struct.Struct('!Q')
+HASH = struct.Struct('!Q')
+TIMING = struct.Struct('!IIH')
+NO_ECHO = 0xffff
+# Bound on the encoded actions of a single tick, so that any tick fits in a packet's section
+MAX_TICK_BYTES = 512
+
+SECTION_ACTIONS = 1
+SECTION_ACKS = 2
+SECTION_TIMING = 3
+SECTION_HASHES = 4
+SECTION_RELAYED = 5
+SECTION_MEMBERS = 6
+
+ACTION_UNREGISTERED = 0
+ACTION_MARSHAL = 255
+
+PARAM_STR = 0
+PARAM_INT = 1
+PARAM_SQUARE = 2
+PARAM_SQUARE_DELTA = 3
+
+action_codes = {}
+action_names = {}
+
+
+class WireError(ValueError):
+    """Malformed or incompatible packet"""
+
+
+class Packet(object):
+    __slots__ = ['sender', 'ticks', 'acks', 'timing', 'hashes', 'relayed', 'members']
+
+    def __init__(self, sender, ticks=(), acks=None, timing=None, hashes=(), relayed=(), members=None):
+        self.sender = sender
+        # List of (tick, actions)
+        self.ticks = ticks
+        # For each instance id, up to which tick the sender has all of its actions
+        self.acks = {} if acks is None else acks
+        # (send time, echoed time of the receiver's last packet, time held since receiving it), in milliseconds.
+        # The hold time is NO_ECHO when there's nothing to echo.
+        self.timing = timing
+        # List of (tick, the sender's game state hash after executing the tick)
+        self.hashes = hashes
+        # Other instances' ticks and hashes forwarded by a relay, as a list of (instance id, ticks, hashes)
+        self.relayed = relayed
+        # The instance ids of all the players in a relayed game, once they are all connected
+        self.members = members
+
+
+def register_action(name, code):
+    """Give an action type a compact code. Codes must be the same for all peers."""
+    assert 0 < code < ACTION_MARSHAL
+    assert action_names.get(code, name) == name and action_codes.get(name, code) == code
+    action_codes[name] = code
+    action_names[code] = name
+
+
+for _code, _name in enumerate(['move', 'msg', 'reset', 'become', 'credits', 'delay'], 1):
+    register_action(_name, _code)
+
+
+def put_uint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def put_int(out, value):
+    put_uint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+
+
+def _put_bytes(out, data):
+    put_uint(out, len(data))
+    out += data
+
+
+def _is_int(param):
+    # Larger numbers are longer than Reader.uint accepts
+    return type(param) is int and -2**63 <= param < 2**63
+
+
+def _is_square(param):
+    return type(param) is tuple and len(param) == 2 and _is_int(param[0]) and _is_int(param[1])
+
+
+def _compact_action(action):
+    """Whether an action fits the compact encoding"""
+    if type(action) is not tuple or len(action) != 2:
+        return False
+    action_type, params = action
+    return type(action_type) is str and type(params) is tuple and all(
+        type(param) is str or _is_int(param) or _is_square(param) for param in params)
+
+
+def _put_action(out, action):
+    if not _compact_action(action):
+        out.append(ACTION_MARSHAL)
+        _put_bytes(out, marshal.dumps(action))
+        return
+    action_type, params = action
+    code = action_codes.get(action_type)
+    if code is None:
+        out.append(ACTION_UNREGISTERED)
+        _put_bytes(out, action_type.encode('utf-8'))
+    else:
+        out.append(code)
+    put_uint(out, len(params))
+    prev = None
+    for param in params:
+        if type(param) is str:
+            out.append(PARAM_STR)
+            _put_bytes(out, param.encode('utf-8'))
+        elif type(param) is int:
+            out.append(PARAM_INT)
+            put_int(out, param)
+        elif prev is None:
+            out.append(PARAM_SQUARE)
+            put_int(out, param[0])
+            put_int(out, param[1])
+            prev = param
+        else:
+            out.append(PARAM_SQUARE_DELTA)
+            put_int(out, param[0] - prev[0])
+            put_int(out, param[1] - prev[1])
+            prev = param
+
+
+def _put_section(out, section_type, payload):
+    if len(payload) > 0xffff:
+        raise WireError('section too long')
+    out += SECTION.pack(section_type, len(payload))
+    out += payload
+
+
+def put_actions(out, actions):
+    put_uint(out, len(actions))
+    for action in actions:
+        _put_action(out, action)
+
+
+def actions_size(actions):
+    """Encoded size of a tick's actions"""
+    out = bytearray()
+    put_actions(out, actions)
+    return len(out)
+
+
+def _put_ticks(out, ticks):
+    put_uint(out, len(ticks))
+    prev = 0
+    for tick, actions in ticks:
+        put_int(out, tick - prev)
+        prev = tick
+        put_actions(out, actions)
+
+
+def _put_acks(out, acks):
+    put_uint(out, len(acks))
+    for instance_id, tick in acks.items():
+        out += ID.pack(instance_id)
+        put_int(out, tick)
+
+
+def _put_hashes(out, hashes):
+    put_uint(out, len(hashes))
+    prev = 0
+    for tick, state_hash in hashes:
+        put_int(out, tick - prev)
+        prev = tick
+        out += HASH.pack(state_hash)
+
+
+def _put_relayed(out, relayed):
+    put_uint(out, len(relayed))
+    for instance_id, ticks, hashes in relayed:
+        out += ID.pack(instance_id)
+        _put_ticks(out, ticks)
+        _put_hashes(out, hashes)
+
+
+def _put_members(out, members):
+    put_uint(out, len(members))
+    for instance_id in members:
+        out += ID.pack(instance_id)
+
+
+def encode(sender, ticks, acks=None, timing=None, hashes=(), relayed=(), members=None):
+    """
+    Encode a packet from `sender` with its actions for each of the `ticks` (list of (tick, actions)),
+    acknowledgements of the ticks it has received (dict of instance id to last contiguous tick),
+    round trip time measurement stamps (see Packet.timing),
+    game state hashes for detecting desyncs (list of (tick, hash)),
+    and for packets from relays, the other instances' ticks and the players (see Packet).
+    """
+    out = bytearray(HEADER.pack(MAGIC, VERSION, sender))
+    payload = bytearray()
+    _put_ticks(payload, ticks)
+    _put_section(out, SECTION_ACTIONS, payload)
+    if acks:
+        payload = bytearray()
+        _put_acks(payload, acks)
+        _put_section(out, SECTION_ACKS, payload)
+    if timing is not None:
+        _put_section(out, SECTION_TIMING, TIMING.pack(*timing))
+    if hashes:
+        payload = bytearray()
+        _put_hashes(payload, hashes)
+        _put_section(out, SECTION_HASHES, payload)
+    if relayed:
+        payload = bytearray()
+        _put_relayed(payload, relayed)
+        _put_section(out, SECTION_RELAYED, payload)
+    if members is not None:
+        payload = bytearray()
+        _put_members(payload, members)
+        _put_section(out, SECTION_MEMBERS, payload)
+    return bytes(out)
+
+
+class Reader(object):
+    """Reads values from a buffer without copying it"""
+    __slots__ = ['buf', 'pos', 'end']
+
+    def __init__(self, buf, pos, end):
+        self.buf = buf
+        self.pos = pos
+        self.end = end
+
+    def byte(self):
+        if self.pos >= self.end:
+            raise WireError('truncated packet')
+        value = self.buf[self.pos]
+        self.pos += 1
+        return value
+
+    def uint(self):
+        buf, pos, end = self.buf, self.pos, self.end
+        if pos < end and buf[pos] < 0x80:
+            # Fast path for the common single byte numbers
+            self.pos = pos + 1
+            return buf[pos]
+        value = 0
+        shift = 0
+        while True:
+            if pos >= end or shift > 63:
+                raise WireError('bad number')
+            b = buf[pos]
+            pos += 1
+            value |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        return value
+
+    def id(self):
+        if self.pos + ID.size > self.end:
+            raise WireError('truncated packet')
+        value, = ID.unpack_from(self.buf, self.pos)
+        self.pos += ID.size
+        return value
+
+    def int(self):
+        value = self.uint()
+        return -((value + 1) >> 1) if value & 1 else value >> 1
+
+    def bytes(self):
+        size = self.uint()
+        start = self.pos
+        if start + size > self.end:
+            raise WireError('truncated packet')
+        self.pos = start + size
+        return self.buf[start:self.pos]
+
+    def str(self):
+        try:
+            return str(self.bytes(), 'utf-8')
+        except UnicodeDecodeError:
+            raise WireError('bad string')
+
+    def action(self):
+        code = self.byte()
+        if code == ACTION_MARSHAL:
+            try:
+                return marshal.loads(self.bytes())
+            except (EOFError, ValueError, TypeError):
+                raise WireError('bad marshalled action')
+        if code == ACTION_UNREGISTERED:
+            action_type = self.str()
+        else:
+            action_type = action_names.get(code)
+            if action_type is None:
+                raise WireError('unknown action code %d' % code)
+        params = []
+        prev = None
+        for _ in range(self.uint()):
+            tag = self.byte()
+            if tag == PARAM_STR:
+                params.append(self.str())
+            elif tag == PARAM_INT:
+                params.append(self.int())
+            elif tag == PARAM_SQUARE:
+                prev = (self.int(), self.int())
+                params.append(prev)
+            elif tag == PARAM_SQUARE_DELTA and prev is not None:
+                prev = (prev[0] + self.int(), prev[1] + self.int())
+                params.append(prev)
+            else:
+                raise WireError('bad parameter')
+        return action_type, tuple(params)
+
+    def actions(self):
+        return [self.action() for _ in range(self.uint())]
+
+    def ticks(self):
+        ticks = []
+        tick = 0
+        for _ in range(self.uint()):
+            tick += self.int()
+            ticks.append((tick, self.actions()))
+        return ticks
+
+    def hashes(self):
+        hashes = []
+        tick = 0
+        for _ in range(self.uint()):
+            tick += self.int()
+            if self.pos + HASH.size > self.end:
+                raise WireError('truncated packet')
+            hashes.append((tick, HASH.unpack_from(self.buf, self.pos)[0]))
+            self.pos += HASH.size
+        return hashes
+
+    def relayed(self):
+        return [(self.id(), self.ticks(), self.hashes()) for _ in range(self.uint())]
+
+    def members(self):
+        return [self.id() for _ in range(self.uint())]
+
+    def acks(self):
+        acks = {}
+        for _ in range(self.uint()):
+            instance_id = self.id()
+            acks[instance_id] = self.int()
+        return acks
+
+
+def decode(data):
+    """Decode a packet, raising WireError if it's malformed or of another version of the format"""
+    buf = memoryview(data)
+    if len(buf) < HEADER.size:
+        raise WireError('truncated packet')
+    magic, version, sender = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise WireError('not a game packet')
+    if version != VERSION:
+        raise WireError('unsupported wire format version %d' % version)
+    packet = Packet(sender)
+    pos = HEADER.size
+    while pos < len(buf):
+        if pos + SECTION.size > len(buf):
+            raise WireError('truncated packet')
+        section_type, size = SECTION.unpack_from(buf, pos)
+        pos += SECTION.size
+        end = pos + size
+        if end > len(buf):
+            raise WireError('truncated packet')
+        reader = Reader(buf, pos, end)
+        if section_type == SECTION_ACTIONS:
+            packet.ticks = reader.ticks()
+        elif section_type == SECTION_ACKS:
+            packet.acks = reader.acks()
+        elif section_type == SECTION_TIMING:
+            if size != TIMING.size:
+                raise WireError('bad timing section')
+            packet.timing = TIMING.unpack_from(buf, pos)
+        elif section_type == SECTION_HASHES:
+            packet.hashes = reader.hashes()
+        elif section_type == SECTION_RELAYED:
+            packet.relayed = reader.relayed()
+        elif section_type == SECTION_MEMBERS:
+            packet.members = reader.members()
+        if reader.pos > end:
+            raise WireError('section overflow')
+        pos = end
+    return packet
@@ -0,0 +1,30 @@
+"""
+Zobrist hashing of the game state.
+
+Each feature of the state (a piece of some type, player, movement status and freeze time on a square,
+or a player's freeze time) has a pseudo-random 64 bit key, and the state's hash is the xor of its features' keys.
+So the hash is updated incrementally by xoring the keys of the features that changed.
+
+Keys are computed by mixing the feature's description with splitmix64 rather than looked up in tables,
+so that they are the same for all peers and for any board size.
+"""
+
+MASK = (1 << 64) - 1
+
+
+def mix(value):
+    """splitmix64's finalizer"""
+    value = (value + 0x9e3779b97f4a7c15) & MASK
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & MASK
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & MASK
+    return value ^ (value >> 31)
+
+
+def piece_key(piece, sq):
+    moved = piece.last_move_time is not None
+    feature = ((sq * 8 + piece.type_code) * 16 + piece.player) * 2 + moved
+    return mix(feature ^ mix(piece.freeze_until & MASK))
+
+
+def player_freeze_key(player, until):
+    return mix((1 << 63) | player << 40 | (until & 0xffffffffff))